@@ -20,6 +20,7 @@ import pathlib
 import pickle
 from tqdm import tqdm
 import json, logging
+from RRAG.dataset.packing import pack_documents
 
 T = TypeVar("T")
 logger = logging.getLogger()
@@ -52,7 +53,7 @@ def get_qa_instruction(
     return prompt_template.format(question=question, search_results="\n".join(formatted_documents))
 
 
-def get_instruction_dataset(dataset, max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN, sample_answer=True):
+def get_instruction_dataset(dataset, max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN, sample_answer=True, pack_prompts=False, reserved_tokens=0):
     instruction_dataset = []
     for input_example in tqdm(dataset):
         input_example = deepcopy(input_example)
@@ -69,11 +70,29 @@ def get_instruction_dataset(dataset, max_prompt_length, tokenizer, retrieval_awa
             )
         
         input_example['instruction'] = prompt
+        input_example['doc_mask'] = [1] * len(paragraphs)
 
         answers = [input_example['answer']] if sample_answer else [input_example['answer']] + input_example['answer_aliases']
         for ans in answers:
             prompt_length = len(tokenizer(prompt + ans)["input_ids"])
-            if max_prompt_length < prompt_length:
+            if pack_prompts and max_prompt_length < prompt_length + reserved_tokens:
+                # shrink the passages (dropping the lowest-ranked documents if needed) to fit
+                # the budget instead of skipping the example
+                render = lambda docs: get_qa_instruction(question, docs, retrieval_aware=retrieval_aware, RETRIEVAL_TOKEN=RETRIEVAL_TOKEN, use_cot=use_cot)
+                packed = pack_documents(
+                    tokenizer, lambda docs: render(docs) + ans, paragraphs,
+                    lambda d: d['paragraph_text'], lambda d, text: dict(d, paragraph_text=text),
+                    max_prompt_length - reserved_tokens,
+                )
+                if packed is not None:
+                    data = deepcopy(input_example)
+                    data['instruction'] = render(packed[0])
+                    data['doc_mask'] = packed[1]
+                    data['output'] = ans
+                    instruction_dataset.append(data)
+                    continue
+            # with packing the instruction wrapper must fit too, so an example packing could not shrink enough is skipped
+            if max_prompt_length < prompt_length + (reserved_tokens if pack_prompts else 0):
                 print(
                             f"Skipping prompt ... with length {prompt_length}, which "
                             f"is greater than maximum prompt length {max_prompt_length}"
@@ -84,6 +103,11 @@ def get_instruction_dataset(dataset, max_prompt_length, tokenizer, retrieval_awa
             instruction_dataset.append(data)
     return instruction_dataset
 
+def get_pruned_instruction(example, keep, RETRIEVAL_TOKEN):
+    # rebuild the retrieval-aware prompt with only the documents in `keep` (retriever order)
+    paragraphs = [example['paragraphs'][i] for i in keep]
+    return get_qa_instruction(example['question'], paragraphs, retrieval_aware=True, use_cot=False, RETRIEVAL_TOKEN=RETRIEVAL_TOKEN)
+
 def get_embeds(dataset):
     for data in dataset:
         data['embeds'] = [[float(d['rerank_score']), float(d['rerank_nb_score']), float(d['rerank_precedent_score'])] for d in data['paragraphs']]
@@ -103,10 +127,10 @@ def load_musique_data(input_path):
     return train_data, test_data
 
 
-def load_musique_dataset(input_path, max_prompt_length, tokenizer, retrieval_aware, use_cot=False, RETRIEVAL_TOKEN='<R>'):
+def load_musique_dataset(input_path, max_prompt_length, tokenizer, retrieval_aware, use_cot=False, RETRIEVAL_TOKEN='<R>', pack_prompts=False, reserved_tokens=0):
     train_data, test_data = load_musique_data(input_path)
-    instruction_dataset_train = get_instruction_dataset(train_data[:], max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN)
-    instruction_dataset_test = get_instruction_dataset(test_data[:], max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN)
+    instruction_dataset_train = get_instruction_dataset(train_data[:], max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN, pack_prompts=pack_prompts, reserved_tokens=reserved_tokens)
+    instruction_dataset_test = get_instruction_dataset(test_data[:], max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN, pack_prompts=pack_prompts, reserved_tokens=reserved_tokens)
 
     instruction_dataset_train = get_embeds(instruction_dataset_train)
     instruction_dataset_test = get_embeds(instruction_dataset_test)
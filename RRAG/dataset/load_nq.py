@@ -21,6 +21,8 @@ import pathlib
 import pickle
 from tqdm import tqdm
 import json, logging
+import dataclasses
+from RRAG.dataset.packing import pack_documents
 from copy import deepcopy
 
 T = TypeVar("T")
@@ -81,7 +83,7 @@ def get_qa_instruction(
     return prompt_template.format(question=question, search_results="\n".join(formatted_documents))
 
 
-def get_instruction_dataset(dataset, idx, max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN, sample_answer=True):
+def get_instruction_dataset(dataset, idx, max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN, sample_answer=True, pack_prompts=False, reserved_tokens=0):
     instruction_dataset = []
     for i in tqdm(idx):
         input_example = deepcopy(dataset[i])
@@ -100,11 +102,29 @@ def get_instruction_dataset(dataset, idx, max_prompt_length, tokenizer, retrieva
             )
         
         input_example['instruction'] = prompt
+        input_example['doc_mask'] = [1] * len(documents)
 
         answers = random.sample(input_example['answers'], 1) if sample_answer else input_example['answers']
         for ans in answers:
             prompt_length = len(tokenizer(prompt + ans)["input_ids"])
-            if max_prompt_length < prompt_length:
+            if pack_prompts and max_prompt_length < prompt_length + reserved_tokens:
+                # shrink the passages (dropping the lowest-ranked documents if needed) to fit
+                # the budget instead of skipping the example
+                render = lambda docs: get_qa_instruction(question, docs, retrieval_aware=retrieval_aware, RETRIEVAL_TOKEN=RETRIEVAL_TOKEN, use_cot=use_cot)
+                packed = pack_documents(
+                    tokenizer, lambda docs: render(docs) + ans, documents,
+                    lambda d: d.text, lambda d, text: dataclasses.replace(d, text=text),
+                    max_prompt_length - reserved_tokens,
+                )
+                if packed is not None:
+                    data = deepcopy(input_example)
+                    data['instruction'] = render(packed[0])
+                    data['doc_mask'] = packed[1]
+                    data['output'] = ans
+                    instruction_dataset.append(data)
+                    continue
+            # with packing the instruction wrapper must fit too, so an example packing could not shrink enough is skipped
+            if max_prompt_length < prompt_length + (reserved_tokens if pack_prompts else 0):
                 logger.info(
                             f"Skipping prompt ... with length {prompt_length}, which "
                             f"is greater than maximum prompt length {max_prompt_length}"
@@ -115,6 +135,11 @@ def get_instruction_dataset(dataset, idx, max_prompt_length, tokenizer, retrieva
             instruction_dataset.append(data)
     return instruction_dataset
 
+def get_pruned_instruction(example, keep, RETRIEVAL_TOKEN):
+    # rebuild the retrieval-aware prompt with only the documents in `keep` (retriever order)
+    documents = [Document.from_dict(deepcopy(example['ctxs'][i])) for i in keep]
+    return get_qa_instruction(example['question'], documents, retrieval_aware=True, use_cot=False, RETRIEVAL_TOKEN=RETRIEVAL_TOKEN)
+
 def get_embeds(dataset):
     for data in dataset:
         data['embeds'] = [[float(d['rerank_score']), float(d['rerank_nb_score']), float(d['rerank_precedent_score'])] for d in data['ctxs']]
@@ -134,10 +159,10 @@ def load_nq_data(input_path, dataset_seed=42):
     return examples, train_index, test_index
 
 
-def load_nq_dataset(input_path, max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN='<R>', dataset_seed=42):
+def load_nq_dataset(input_path, max_prompt_length, tokenizer, retrieval_aware, use_cot=False, RETRIEVAL_TOKEN='<R>', dataset_seed=42, pack_prompts=False, reserved_tokens=0):
     examples, train_index, test_index = load_nq_data(input_path, dataset_seed)
-    instruction_dataset_train = get_instruction_dataset(examples, train_index, max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN)
-    instruction_dataset_test = get_instruction_dataset(examples, test_index, max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN)
+    instruction_dataset_train = get_instruction_dataset(examples, train_index, max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN, pack_prompts=pack_prompts, reserved_tokens=reserved_tokens)
+    instruction_dataset_test = get_instruction_dataset(examples, test_index, max_prompt_length, tokenizer, retrieval_aware, use_cot, RETRIEVAL_TOKEN, pack_prompts=pack_prompts, reserved_tokens=reserved_tokens)
 
     instruction_dataset_train = get_embeds(instruction_dataset_train)
     instruction_dataset_test = get_embeds(instruction_dataset_test)
@@ -0,0 +1,90 @@
+"""Token-budget-aware prompt packing.
+
+`get_instruction_dataset` used to skip every example whose prompt did not fit
+in `max_prompt_length`. `pack_documents` instead shrinks the prompt to the
+budget: every passage is truncated at a token boundary, with the budget going
+to the highest-priority documents first (retriever rank by default), and the
+lowest-priority documents are dropped when the rest would otherwise not keep at
+least `min_passage_tokens` of their passage. The returned `doc_mask` marks the
+kept documents so the injected R-Former rows stay aligned with the retrieval
+slots left in the prompt.
+"""
+
+
+def count_tokens(tokenizer, text):
+    return len(tokenizer(text)["input_ids"])
+
+
+def pack_documents(
+    tokenizer, render, documents, get_text, set_text, budget,
+    priorities=None, min_passage_tokens=16, max_iters=4,
+):
+    """Returns `(packed_documents, doc_mask)` with `count_tokens(render(packed_documents)) <= budget`,
+    or `None` if even a single document without its passage does not fit.
+
+    `render(documents)` builds the full text that is measured (prompt + answer),
+    `get_text` / `set_text(doc, text)` read and replace a document's passage, and
+    `priorities` (higher is kept first, e.g. R-Former scores) default to retriever rank.
+    """
+    num_docs = len(documents)
+    if priorities is None:
+        priorities = [-i for i in range(num_docs)]
+    order = sorted(range(num_docs), key=lambda i: -priorities[i])
+    passage_ids = [tokenizer(get_text(d), add_special_tokens=False)["input_ids"] for d in documents]
+
+    def rendered_length(kept, alloc):
+        docs = [set_text(documents[i], truncate(i, alloc[i])) for i in kept]
+        return count_tokens(tokenizer, render(docs)), docs
+
+    def truncate(i, num_tokens):
+        if num_tokens >= len(passage_ids[i]):
+            return get_text(documents[i])
+        if num_tokens <= 0:
+            return ''
+        return tokenizer.decode(passage_ids[i][:num_tokens], skip_special_tokens=True).strip()
+
+    # drop the lowest-priority documents until titles + retrieval slots + a floor of
+    # `min_passage_tokens` of every kept passage fit
+    kept = sorted(order)
+    empty = {i: 0 for i in range(num_docs)}
+    floors = {i: min(len(passage_ids[i]), min_passage_tokens) for i in range(num_docs)}
+    fixed, _ = rendered_length(kept, empty)
+    while fixed + sum(floors[i] for i in kept) > budget and len(kept) > 1:
+        kept.remove(min(kept, key=lambda i: priorities[i]))
+        fixed, _ = rendered_length(kept, empty)
+    if fixed > budget:
+        return None
+
+    # floors first, then the rest of the budget by priority
+    available = budget - fixed
+    alloc = dict(empty)
+    remaining = available
+    for i in kept:
+        alloc[i] = min(floors[i], remaining)
+        remaining -= alloc[i]
+    for i in order:
+        if i in kept and remaining > 0:
+            extra = min(len(passage_ids[i]) - alloc[i], remaining)
+            alloc[i] += extra
+            remaining -= extra
+
+    # decoding and re-tokenizing a truncated passage can merge differently at the
+    # boundaries; take the overflow back from the lowest-priority passages
+    for _ in range(max_iters):
+        length, docs = rendered_length(kept, alloc)
+        if length <= budget:
+            break
+        overflow = length - budget
+        for i in sorted(kept, key=lambda i: priorities[i]):
+            take = min(alloc[i], overflow)
+            alloc[i] -= take
+            overflow -= take
+            if overflow <= 0:
+                break
+    else:
+        length, docs = rendered_length(kept, alloc)
+        if length > budget:
+            return None
+    doc_mask = [1 if i in kept else 0 for i in range(num_docs)]
+    return docs, doc_mask
+
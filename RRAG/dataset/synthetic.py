@@ -0,0 +1,230 @@
+"""Synthetic, schema-correct datasets for load/stress testing.
+
+Writes the same pickles that `load_nq_data`, `load_hotpotqa_data` and
+`load_musique_data` read, at any scale and k, without the real datasets:
+
+    python -m RRAG.dataset.synthetic --format nq --num_examples 1000000 --num_k 30 --output_dir synthetic/
+    python -m RRAG.dataset.synthetic --format hotpotqa --num_examples 100000 --output_dir synthetic/
+
+Examples are written one at a time, so generating a large file keeps memory flat.
+"""
+import os
+import random
+import pickle
+import argparse
+from tqdm import tqdm
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'ten', 'su', 'vor', 'na', 'el', 'dri', 'po', 'qu', 'an', 'is', 'ber', 'gal', 'th', 'or', 'wen', 'zy']
+STOPWORDS = ['the', 'of', 'and', 'in', 'was', 'is', 'a', 'to', 'by', 'for', 'on', 'with']
+
+
+class StreamingListPickler:
+    """Writes a pickled `list` one element at a time.
+
+    The result is an ordinary pickle (`pickle.load` returns the list), but the
+    list is never materialized: each element is pickled without a memo and
+    appended between MARK / APPENDS opcodes.
+    """
+
+    def __init__(self, path, batch_size=1000):
+        self.fout = open(path, 'wb')
+        self.batch_size = batch_size
+        self.num_pending = 0
+        self.num_items = 0
+        self.fout.write(pickle.PROTO + bytes([2]) + pickle.EMPTY_LIST)
+
+    def append(self, obj):
+        if self.num_pending == 0:
+            self.fout.write(pickle.MARK)
+        data = pickle.dumps(obj, protocol=2, fix_imports=False)
+        # strip PROTO 2 header and STOP; protocol 2 has no framing
+        self.fout.write(data[2:-1])
+        self.num_pending += 1
+        self.num_items += 1
+        if self.num_pending == self.batch_size:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        if self.num_pending:
+            self.fout.write(pickle.APPENDS)
+            self.num_pending = 0
+
+    def close(self):
+        self._flush_batch()
+        self.fout.write(pickle.STOP)
+        self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SyntheticGenerator:
+    def __init__(self, seed=42, vocab_size=5000, num_words=60, text_pool_size=10000):
+        self.rng = random.Random(seed)
+        self.num_words = num_words
+        self.vocab = self._make_vocab(vocab_size)
+        # passages are drawn from a fixed pool so generation stays fast at 1M+ examples
+        self.text_pool = [self.random_text(num_words) for _ in range(text_pool_size)]
+
+    def _make_vocab(self, vocab_size):
+        vocab = set()
+        while len(vocab) < vocab_size:
+            vocab.add(''.join(self.rng.choice(SYLLABLES) for _ in range(self.rng.randint(2, 4))))
+        return sorted(vocab)
+
+    def random_text(self, num_words):
+        words = self.rng.choices(self.vocab, k=num_words)
+        for i in range(0, num_words, 5):
+            words[i] = self.rng.choice(STOPWORDS)
+        return ' '.join(words)
+
+    def title(self):
+        return ' '.join(w.title() for w in self.rng.choices(self.vocab, k=self.rng.randint(1, 3)))
+
+    def answer(self):
+        return ' '.join(w.title() for w in self.rng.choices(self.vocab, k=self.rng.randint(1, 3)))
+
+    def question(self):
+        return 'what ' + self.random_text(self.rng.randint(6, 14)) + '?'
+
+    def passage(self, answer=None):
+        text = self.rng.choice(self.text_pool)
+        if answer is None:
+            return text
+        cut = self.rng.randrange(len(text))
+        return f'{text[:cut]} {answer} {text[cut:]}'
+
+    def rerank_features(self, num_k, gold_mask):
+        # cosine-like scores: gold documents score higher on average; documents are
+        # returned in retriever order, i.e. sorted by rerank_score as feature_extraction does
+        scores = [min(1.0, max(-1.0, self.rng.gauss(0.65 if g else 0.4, 0.12))) for g in gold_mask]
+        order = sorted(range(num_k), key=lambda j: -scores[j])
+        features = []
+        for rank, j in enumerate(order):
+            nb_score = min(1.0, max(-1.0, self.rng.gauss(0.5, 0.1)))
+            precedent_score = 1.0 if rank == 0 else min(1.0, max(-1.0, self.rng.gauss(0.55, 0.1)))
+            features.append((j, scores[j], nb_score, precedent_score))
+        return features
+
+    def nq_example(self, num_k, gold_at=None):
+        answers = [self.answer() for _ in range(self.rng.randint(1, 3))]
+        gold = self.rng.randrange(num_k) if gold_at is None else gold_at
+        gold_mask = [j == gold for j in range(num_k)]
+        ctxs = []
+        for j, rerank_score, nb_score, precedent_score in self.rerank_features(num_k, gold_mask):
+            ctxs.append({
+                'id': str(self.rng.randrange(10 ** 8)),
+                'title': self.title(),
+                'text': self.passage(answers[0] if gold_mask[j] else None),
+                'score': rerank_score,
+                'hasanswer': gold_mask[j],
+                'isgold': gold_mask[j],
+                'original_retrieval_index': j,
+                'rerank_score': rerank_score,
+                'rerank_nb_score': nb_score,
+                'rerank_precedent_score': precedent_score,
+            })
+        return {'question': self.question(), 'answers': answers, 'ctxs': ctxs}
+
+    def hotpotqa_example(self, num_k=10, num_supporting=2):
+        answer = self.answer()
+        titles = []
+        while len(titles) < num_k:
+            title = self.title()
+            if title not in titles:
+                titles.append(title)
+        supporting = self.rng.sample(range(num_k), num_supporting)
+        gold_mask = [j in supporting for j in range(num_k)]
+        context = []
+        for j, rerank_score, nb_score, precedent_score in self.rerank_features(num_k, gold_mask):
+            text = self.passage(answer if j == supporting[0] else None)
+            sentences = [s.strip() + '.' for s in text.split(' and ') if s.strip()]
+            context.append([titles[j], sentences, (rerank_score, nb_score, precedent_score)])
+        return {
+            '_id': f'{self.rng.randrange(16 ** 24):024x}',
+            'question': self.question(),
+            'answer': answer,
+            'type': self.rng.choice(['bridge', 'comparison']),
+            'level': self.rng.choice(['easy', 'medium', 'hard']),
+            'supporting_facts': [[titles[j], 0] for j in supporting],
+            'context': context,
+        }
+
+    def musique_example(self, num_k=20, num_supporting=None):
+        num_supporting = num_supporting or self.rng.randint(2, 4)
+        answer = self.answer()
+        supporting = self.rng.sample(range(num_k), num_supporting)
+        gold_mask = [j in supporting for j in range(num_k)]
+        paragraphs = []
+        for j, rerank_score, nb_score, precedent_score in self.rerank_features(num_k, gold_mask):
+            paragraphs.append({
+                'idx': j,
+                'title': self.title(),
+                'paragraph_text': self.passage(answer if j == supporting[-1] else None),
+                'is_supporting': gold_mask[j],
+                'rerank_score': rerank_score,
+                'rerank_nb_score': nb_score,
+                'rerank_precedent_score': precedent_score,
+            })
+        return {
+            'id': f'{num_supporting}hop__{self.rng.randrange(10 ** 6)}',
+            'question': self.question(),
+            'answer': answer,
+            'answer_aliases': [self.answer() for _ in range(self.rng.randint(0, 2))],
+            'answerable': True,
+            'paragraphs': paragraphs,
+        }
+
+    def examples(self, format, num_examples, num_k):
+        for _ in range(num_examples):
+            if format == 'nq':
+                yield self.nq_example(num_k)
+            elif format == 'hotpotqa':
+                yield self.hotpotqa_example(num_k)
+            elif format == 'musique':
+                yield self.musique_example(num_k)
+            else:
+                raise ValueError(format)
+
+
+def write_examples(path, examples, total=None):
+    with StreamingListPickler(path) as writer:
+        for example in tqdm(examples, total=total, desc=os.path.basename(path)):
+            writer.append(example)
+    print(f'wrote {writer.num_items} examples to {path}')
+    return path
+
+
+DEFAULT_NUM_K = {'nq': 10, 'hotpotqa': 10, 'musique': 20}
+
+def main(format, num_examples, num_k, output_dir, test_ratio=0.2, seed=42, num_words=60, text_pool_size=10000):
+    num_k = num_k or DEFAULT_NUM_K[format]
+    os.makedirs(output_dir, exist_ok=True)
+    generator = SyntheticGenerator(seed=seed, num_words=num_words, text_pool_size=text_pool_size)
+    if format == 'nq':
+        # load_nq_data does its own train/test split
+        path = os.path.join(output_dir, f'synthetic_nq_{num_k}_{num_examples}.pkl')
+        return [write_examples(path, generator.examples(format, num_examples, num_k), num_examples)]
+    num_test = int(num_examples * test_ratio)
+    paths = []
+    for split, n in [('train', num_examples - num_test), ('test', num_test)]:
+        path = os.path.join(output_dir, f'synthetic_{format}_{num_k}_{split}.pkl')
+        paths.append(write_examples(path, generator.examples(format, n, num_k), n))
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic RRAG datasets")
+    parser.add_argument('--format', type=str, required=True, choices=['nq', 'hotpotqa', 'musique'], help='On-disk format to produce')
+    parser.add_argument('--num_examples', type=int, default=10000, help='Number of examples (train + test for hotpotqa/musique)')
+    parser.add_argument('--num_k', type=int, default=None, help='Documents per example (default: nq 10, hotpotqa 10, musique 20)')
+    parser.add_argument('--output_dir', type=str, default='synthetic', help='Directory to write the .pkl files to')
+    parser.add_argument('--test_ratio', type=float, default=0.2, help='Test split size for hotpotqa/musique')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    parser.add_argument('--num_words', type=int, default=60, help='Words per passage')
+    parser.add_argument('--text_pool_size', type=int, default=10000, help='Distinct passages to sample document texts from')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,177 @@
+"""Continuous batching for greedy RRAG / RAG generation.
+
+Request-at-a-time `generate` keeps decoding until the longest answer in the
+batch is done, and factoid answers finish after a handful of tokens.
+`ContinuousBatchingScheduler` keeps a running batch instead: every step it
+admits waiting requests (each with its own prefill, including the R-Former
+embedding injection of `encode_inputs`), decodes one token for all running
+sequences, and evicts the ones that hit EOS or their token limit.
+
+The running sequences share one left-padded KV cache (legacy per-layer
+`(key, value)` tuples of shape [batch, heads, time, head_dim]); admitting a
+sequence pads it (or the batch) on the left, evicting one drops its row and
+any leading columns that are padding for every remaining row.
+"""
+import time
+from collections import deque
+
+import torch
+import torch.nn.functional as F
+
+from RRAG.utils.profiling import profiler
+
+
+class ContinuousBatchingScheduler:
+    def __init__(self, model, max_batch_size=8, max_new_tokens=100, eos_token_id=None):
+        self.model = model
+        self.llm = model.llama_model
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        if eos_token_id is None:
+            eos_token_id = self.llm.generation_config.eos_token_id
+        self.eos_token_ids = set([eos_token_id] if isinstance(eos_token_id, int) else (eos_token_id or []))
+        self.waiting = deque()
+        self.failed = []  # (request_id, exception) of requests whose prefill raised, see step
+        self.reset()
+
+    def reset(self):
+        self.running = []  # per row: {'id', 'tokens', 'max_new_tokens'}
+        self.past_key_values = None
+        self.attention_mask = None
+        self.position_ids = None
+        self.next_tokens = None
+
+    def submit(self, request_id, inputs, max_new_tokens=None):
+        # `inputs` as built for `model.generate`: input_ids [1, L] plus embeds / inject_embeds / doc_mask
+        self.waiting.append((request_id, inputs, max_new_tokens or self.max_new_tokens))
+
+    def has_work(self):
+        return bool(self.waiting or self.running)
+
+    @torch.no_grad()
+    def prefill(self, inputs):
+        input_ids = inputs['input_ids']
+        if 'embeds' in inputs or 'inject_embeds' in inputs:
+            inputs_embeds, _ = self.model.encode_inputs(
+                input_ids, inputs.get('embeds'), inject_embeds=inputs.get('inject_embeds'), doc_mask=inputs.get('doc_mask'))
+        else:
+            inputs_embeds, _ = self.model.encode_inputs(input_ids)
+        attention_mask = inputs.get('attention_mask')
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        start = time.perf_counter()
+        outputs = self.llm(inputs_embeds=inputs_embeds, attention_mask=attention_mask, use_cache=True, return_dict=True)
+        profiler.add_time('prefill', start, time.perf_counter())
+        next_tokens = outputs.logits[:, -1].argmax(-1, keepdim=True)
+        position_ids = attention_mask.sum(-1, keepdim=True)
+        return outputs.past_key_values, attention_mask, position_ids, next_tokens
+
+    def admit(self, request_id, inputs, max_new_tokens):
+        # the running batch is only modified once the prefill succeeded
+        past_key_values, attention_mask, position_ids, next_tokens = self.prefill(inputs)
+        row = {'id': request_id, 'tokens': [int(next_tokens[0, 0])], 'max_new_tokens': max_new_tokens}
+        if self.past_key_values is None:
+            self.past_key_values, self.attention_mask = past_key_values, attention_mask
+            self.position_ids, self.next_tokens = position_ids, next_tokens
+            self.running.append(row)
+            return
+        # left-pad the shorter side so both caches end at the same column
+        batch_len, new_len = self.attention_mask.shape[1], attention_mask.shape[1]
+        length = max(batch_len, new_len)
+        merged = []
+        for (batch_k, batch_v), (new_k, new_v) in zip(self.past_key_values, past_key_values):
+            merged.append((
+                torch.cat([F.pad(batch_k, (0, 0, length - batch_len, 0)), F.pad(new_k, (0, 0, length - new_len, 0))]),
+                torch.cat([F.pad(batch_v, (0, 0, length - batch_len, 0)), F.pad(new_v, (0, 0, length - new_len, 0))]),
+            ))
+        self.past_key_values = tuple(merged)
+        self.attention_mask = torch.cat([F.pad(self.attention_mask, (length - batch_len, 0)), F.pad(attention_mask, (length - new_len, 0))])
+        self.position_ids = torch.cat([self.position_ids, position_ids])
+        self.next_tokens = torch.cat([self.next_tokens, next_tokens])
+        self.running.append(row)
+
+    def is_finished(self, row):
+        return row['tokens'][-1] in self.eos_token_ids or len(row['tokens']) >= row['max_new_tokens']
+
+    def evict(self):
+        finished = [(row['id'], row['tokens']) for row in self.running if self.is_finished(row)]
+        if not finished:
+            return finished
+        keep = [i for i, row in enumerate(self.running) if not self.is_finished(row)]
+        self.running = [self.running[i] for i in keep]
+        if not keep:
+            self.reset()
+            return finished
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # drop leading columns that are padding for every remaining row
+        first = int(attention_mask.any(0).nonzero()[0, 0])
+        self.attention_mask = attention_mask[:, first:]
+        self.past_key_values = tuple(
+            (k.index_select(0, index)[:, :, first:], v.index_select(0, index)[:, :, first:]) for k, v in self.past_key_values
+        )
+        self.position_ids = self.position_ids.index_select(0, index)
+        self.next_tokens = self.next_tokens.index_select(0, index)
+        return finished
+
+    @torch.no_grad()
+    def decode(self):
+        start = time.perf_counter()
+        attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        outputs = self.llm(
+            input_ids=self.next_tokens,
+            attention_mask=attention_mask,
+            position_ids=self.position_ids,
+            past_key_values=self.past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        self.past_key_values = outputs.past_key_values
+        self.attention_mask = attention_mask
+        self.position_ids = self.position_ids + 1
+        self.next_tokens = outputs.logits[:, -1].argmax(-1, keepdim=True)
+        for row, token in zip(self.running, self.next_tokens[:, 0].tolist()):
+            row['tokens'].append(token)
+        profiler.add_time('decode', start, time.perf_counter())
+        profiler.count('decode_tokens', len(self.running))
+        profiler.count('decode_steps')
+
+    def step(self):
+        """Admits waiting requests up to `max_batch_size`, decodes one token for the
+        running batch and returns the `(request_id, token_ids)` that finished.
+
+        A request whose prefill raises is not admitted: it goes to `failed` as
+        `(request_id, exception)` for the caller, and the running batch is left as it was."""
+        finished = []
+        while self.waiting and len(self.running) < self.max_batch_size:
+            request_id, inputs, max_new_tokens = self.waiting.popleft()
+            try:
+                self.admit(request_id, inputs, max_new_tokens)
+            except Exception as e:
+                self.failed.append((request_id, e))
+                continue
+            # a request can finish on its prefill token
+            finished.extend(self.evict())
+        if self.running:
+            self.decode()
+            finished.extend(self.evict())
+        return finished
+
+    def run(self, requests):
+        """Streams `(request_id, inputs)` pairs through the scheduler, pulling new ones as
+        slots free up, and yields `(request_id, token_ids)` in completion order."""
+        requests = iter(requests)
+        exhausted = False
+        while True:
+            while not exhausted and len(self.waiting) + len(self.running) < self.max_batch_size:
+                try:
+                    self.submit(*next(requests))
+                except StopIteration:
+                    exhausted = True
+            if not self.has_work():
+                return
+            finished = self.step()
+            if self.failed:
+                raise self.failed[0][1]
+            for request_id, tokens in finished:
+                yield request_id, tokens
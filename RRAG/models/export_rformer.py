@@ -0,0 +1,83 @@
+"""Export a trained R-Former + llama_proj as a standalone inference module.
+
+Reads the `config.json` and `RRAGLlama_pytorch_model.bin` written by
+`RRAGLlamaForCausalLM.save_model` (the LLM is not loaded) and writes a
+TorchScript or ONNX file mapping retrieval features [batch, num_k, input_dim]
+to injected embeddings [batch, num_k, hidden_size] (plus relevance logits
+with --with_scores), so features can be scored in a separate CPU process:
+
+    python -m RRAG.models.export_rformer --pretrained_model_name output/rrag/Rrag-Llama-2-7b --format torchscript --output rformer.pt
+"""
+import os
+import time
+import argparse
+import torch
+import torch.nn as nn
+
+from RRAG.models.modeling_rrag import RRAGLlamaConfig, RFormer, RFormerInference
+
+
+def load_inference_rformer(pretrained_model_name, with_scores=False):
+    config = RRAGLlamaConfig.from_pretrained(pretrained_model_name)
+    r_former = RFormer(input_dim=config.input_dim, num_k=config.num_k, d_model=config.d_model)
+    llama_proj = nn.Linear(config.d_model, config.hidden_size)
+    model_dict = torch.load(os.path.join(pretrained_model_name, 'RRAGLlama_pytorch_model.bin'), map_location='cpu')
+    r_former.load_state_dict(model_dict['r_former'])
+    llama_proj.load_state_dict(model_dict['llama_proj'])
+    return RFormerInference.from_rformer(r_former, llama_proj, with_scores=with_scores), config
+
+
+def export_rformer(module, config, output, format='torchscript', batch_size=1):
+    example = torch.randn(batch_size, config.num_k, config.input_dim)
+    with torch.no_grad():
+        if format == 'torchscript':
+            exported = torch.jit.trace(module, example, check_trace=False)
+            exported.save(output)
+        elif format == 'onnx':
+            output_names = ['inject_embeds', 'scores'] if module.with_scores else ['inject_embeds']
+            torch.onnx.export(
+                module, (example,), output,
+                input_names=['features'],
+                output_names=output_names,
+                dynamic_axes={name: {0: 'batch'} for name in ['features'] + output_names},
+                opset_version=17,
+            )
+        else:
+            raise ValueError(format)
+    print('export_save_path', output)
+    return output
+
+
+def benchmark(module, config, batch_size=1, repeat=200):
+    x = torch.randn(batch_size, config.num_k, config.input_dim)
+    with torch.no_grad():
+        for _ in range(10):
+            module(x)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            module(x)
+    latency_us = (time.perf_counter() - start) / repeat * 1e6
+    print(f'batch={batch_size}: {latency_us:.1f} us/call')
+    return latency_us
+
+
+def main(pretrained_model_name, output, format, with_scores, num_threads, benchmark_latency):
+    torch.set_num_threads(num_threads)
+    module, config = load_inference_rformer(pretrained_model_name, with_scores=with_scores)
+    export_rformer(module, config, output, format=format)
+    if benchmark_latency:
+        loaded = torch.jit.load(output) if format == 'torchscript' else module
+        for batch_size in (1, 8, 32):
+            benchmark(loaded, config, batch_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the R-Former + projection for standalone inference")
+    parser.add_argument('--pretrained_model_name', type=str, required=True, help='Directory written by RRAGLlamaForCausalLM.save_model')
+    parser.add_argument('--output', type=str, required=True, help='Path of the exported module')
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx'], help='Export format')
+    parser.add_argument('--with_scores', action='store_true', help='Also output the per-document relevance logits')
+    parser.add_argument('--num_threads', type=int, default=1, help='torch threads for the latency benchmark')
+    parser.add_argument('--benchmark_latency', action='store_true', help='Print per-call CPU latency of the exported module')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,122 @@
+"""Per-family settings for the base LLM.
+
+Everything the runner used to hard-code for Llama (and special-case for Qwen
+on dureader) lives here: the token used as the retrieval placeholder that
+`encode_inputs` overwrites, tokenizer padding, the `chat` prompt template,
+the LoRA target modules and whether the model needs remote code. The family
+is detected from the base model's `config.json` (`model_type`), so smaller
+models (TinyLlama, Qwen2-0.5B/1.5B, Phi-2, Phi-3) run without editing the
+runner; pass `--model_family` to override the detection.
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from transformers import AutoConfig
+
+INSTRUCTION_TEMPLATE = "### Instruction: \n{instruction}\n\n### Response:\n"
+RETRIEVAL_PLACEHOLDER = '<|retrieval|>'
+
+
+@dataclass(frozen=True)
+class ModelFamily:
+    name: str
+    model_types: List[str]
+    chat_template: str
+    # None: use the tokenizer's own unk token. A token missing from the vocabulary is
+    # added as a special token (see setup_tokenizer)
+    placeholder_token: Optional[str] = None
+    # in-vocabulary placeholder for tokenizers that refuse new special tokens
+    reserved_placeholder: Optional[str] = None
+    pad_token: Optional[str] = None  # None: eos
+    padding_side: str = 'left'
+    lora_target_modules: List[str] = field(default_factory=lambda: ['q_proj', 'v_proj'])
+    trust_remote_code: bool = False
+
+
+MODEL_FAMILIES = {}
+
+def register_model_family(family):
+    MODEL_FAMILIES[family.name] = family
+    return family
+
+
+register_model_family(ModelFamily(
+    name='llama',
+    model_types=['llama', 'mistral'],  # Llama-2, TinyLlama, Mistral
+    chat_template="[INST] {instruction} [/INST]",
+))
+register_model_family(ModelFamily(
+    name='qwen',  # Qwen-1 (remote code), as used for dureader
+    model_types=['qwen'],
+    chat_template="<|im_start|>user\n{instruction}<|im_end|>\n<|im_start|>assistant\n",
+    # not <|im_end|>: the chat template uses it, so it would count as one more retrieval slot
+    placeholder_token=RETRIEVAL_PLACEHOLDER,
+    reserved_placeholder='<|extra_0|>',  # the remote-code tokenizer only accepts its reserved tokens
+    trust_remote_code=True,
+    lora_target_modules=['c_attn'],
+))
+register_model_family(ModelFamily(
+    name='qwen2',
+    model_types=['qwen2', 'qwen2_moe'],
+    chat_template="<|im_start|>user\n{instruction}<|im_end|>\n<|im_start|>assistant\n",
+    placeholder_token=RETRIEVAL_PLACEHOLDER,
+    pad_token='<|endoftext|>',
+))
+register_model_family(ModelFamily(
+    name='phi',
+    model_types=['phi'],  # Phi-1.5 / Phi-2
+    chat_template="Instruct: {instruction}\nOutput:",
+    placeholder_token=RETRIEVAL_PLACEHOLDER,
+))
+register_model_family(ModelFamily(
+    name='phi3',
+    model_types=['phi3'],
+    chat_template="<|user|>\n{instruction}<|end|>\n<|assistant|>\n",
+    lora_target_modules=['qkv_proj'],
+))
+
+
+def get_model_family(name):
+    if name not in MODEL_FAMILIES:
+        raise ValueError(f'unknown model family {name}, choose from {list(MODEL_FAMILIES)}')
+    return MODEL_FAMILIES[name]
+
+
+def load_base_config(model_name, family=None):
+    trust_remote_code = family.trust_remote_code if family is not None else False
+    return AutoConfig.from_pretrained(model_name, trust_remote_code=trust_remote_code)
+
+
+def detect_model_family(model_name):
+    try:
+        model_type = load_base_config(model_name).model_type
+    except ValueError as e:
+        raise ValueError(f'could not read the config of {model_name} ({e}), pass --model_family') from e
+    for family in MODEL_FAMILIES.values():
+        if model_type in family.model_types:
+            return family
+    print(f'no model family registered for model_type {model_type}, using llama settings')
+    return MODEL_FAMILIES['llama']
+
+
+def setup_tokenizer(tokenizer, family):
+    # returns (placeholder_token, placeholder_token_id) after padding / placeholder setup
+    tokenizer.padding_side = family.padding_side
+    tokenizer.pad_token = family.pad_token or tokenizer.eos_token
+    placeholder = family.placeholder_token or tokenizer.unk_token
+    if placeholder is None:
+        placeholder = RETRIEVAL_PLACEHOLDER
+    if placeholder not in tokenizer.get_vocab():
+        try:
+            tokenizer.add_special_tokens({'additional_special_tokens': [placeholder]})
+        except ValueError:
+            if family.reserved_placeholder is None:
+                raise
+            placeholder = family.reserved_placeholder
+    placeholder_id = tokenizer.convert_tokens_to_ids(placeholder)
+    if placeholder_id == tokenizer.pad_token_id:
+        raise ValueError(f'retrieval placeholder {placeholder} must differ from the pad token')
+    # every occurrence in the prompt is a retrieval slot, so the template must not contain it
+    if placeholder in family.chat_template:
+        raise ValueError(f'retrieval placeholder {placeholder} must not appear in the {family.name} chat template')
+    return placeholder, placeholder_id
@@ -1,7 +1,9 @@
 import random, os
 import torch
 import torch.nn as nn
-from transformers import PreTrainedModel, AutoModelForCausalLM, PretrainedConfig
+from transformers import PreTrainedModel, AutoModelForCausalLM, PretrainedConfig, LogitsProcessorList
+from RRAG.utils.profiling import profiler, GenerationTimingProcessor
+from RRAG.models.static_generation import StaticShapeGenerator, DEFAULT_BUCKETS
 
 class RAGLlamaConfig(PretrainedConfig):
     model_type = "ragllama"
@@ -12,11 +14,15 @@ class RAGLlamaConfig(PretrainedConfig):
         model_name_or_path='',
         load_in_8bit=True,
         freeze_llm=True,
+        device_map='auto',
+        trust_remote_code=False,
         **kwargs,
     ):
         self.model_name_or_path = model_name_or_path
         self.load_in_8bit = load_in_8bit
         self.freeze_llm = freeze_llm
+        self.device_map = device_map
+        self.trust_remote_code = trust_remote_code
         super().__init__(
             **kwargs,
         )
@@ -25,16 +31,26 @@ class RAGLlamaForCausalLM(PreTrainedModel):
     config_class = RAGLlamaConfig
     base_model_prefix = "model"
     supports_gradient_checkpointing = True
-    def __init__(self, config):
+    def __init__(self, config, llama_model=None):
         super().__init__(config)
-        self.llama_model = AutoModelForCausalLM.from_pretrained(
-            config.model_name_or_path, 
-            device_map="auto",
-            load_in_8bit=config.load_in_8bit,
-            )
+        if llama_model is None:
+            llama_model = AutoModelForCausalLM.from_pretrained(
+                config.model_name_or_path, 
+                device_map=config.device_map,
+                load_in_8bit=config.load_in_8bit,
+                trust_remote_code=config.trust_remote_code,
+                )
+        self.llama_model = llama_model
         if config.freeze_llm:
             for name, param in self.llama_model.named_parameters():
                 param.requires_grad = False
+        self.static_generator = None
+
+    def enable_static_generation(self, buckets=DEFAULT_BUCKETS, compile=True):
+        # greedy decoding with prompt-length buckets, a static KV cache and a compiled
+        # decode step, falling back to llama_model.generate otherwise (see static_generation.py)
+        self.static_generator = StaticShapeGenerator(self.llama_model, buckets=buckets, compile=compile)
+        return self.static_generator
 
     def get_input_embeddings(self):
         return self.llama_model.get_input_embeddings()
@@ -58,7 +74,8 @@ class RAGLlamaForCausalLM(PreTrainedModel):
         input_ids: torch.Tensor, 
     ):
         embed_tokens = self.get_input_embeddings()
-        input_embeds = embed_tokens(input_ids)
+        with profiler.stage('embed_lookup'):
+            input_embeds = embed_tokens(input_ids)
         return input_embeds, None
 
     def forward(
@@ -76,5 +93,14 @@ class RAGLlamaForCausalLM(PreTrainedModel):
         **kwargs
     ):
         inputs_embeds, loss = self.encode_inputs(inputs['input_ids'])
-        outputs = self.llama_model.generate(inputs_embeds=inputs_embeds, **kwargs)
+        if self.static_generator is not None:
+            with profiler.stage('generate'):
+                outputs = self.static_generator.generate(inputs_embeds, inputs.get('attention_mask'), **kwargs)
+            profiler.count('generated_tokens', outputs.numel())
+            return outputs
+        if profiler.enabled:
+            kwargs['logits_processor'] = LogitsProcessorList(list(kwargs.get('logits_processor') or []) + [GenerationTimingProcessor(profiler)])
+        with profiler.stage('generate'):
+            outputs = self.llama_model.generate(inputs_embeds=inputs_embeds, **kwargs)
+        profiler.count('generated_tokens', outputs.numel())
         return outputs
\ No newline at end of file
@@ -1,8 +1,10 @@
 import random, os
 import torch
 import torch.nn as nn
-from transformers import PreTrainedModel, AutoModelForCausalLM, PretrainedConfig
+from transformers import PreTrainedModel, AutoModelForCausalLM, PretrainedConfig, LogitsProcessorList
 from typing import Any, Dict, List, Optional, Tuple
+from RRAG.utils.profiling import profiler, GenerationTimingProcessor
+from RRAG.models.static_generation import StaticShapeGenerator, DEFAULT_BUCKETS
 
 class RRAGLlamaConfig(PretrainedConfig):
     model_type = "rragllama"
@@ -20,6 +22,8 @@ class RRAGLlamaConfig(PretrainedConfig):
         freeze_llm=False,
         num_k=10,
         d_model=256,
+        device_map='auto',
+        trust_remote_code=False,
         **kwargs,
     ):
         self.model_name_or_path = model_name_or_path
@@ -32,6 +36,8 @@ class RRAGLlamaConfig(PretrainedConfig):
         self.freeze_llm = freeze_llm
         self.num_k = num_k
         self.d_model = d_model
+        self.device_map = device_map
+        self.trust_remote_code = trust_remote_code
         super().__init__(
             **kwargs,
         )
@@ -61,29 +67,106 @@ class RFormer(nn.Module):
         pe = self.position_embeddings(position_ids)
         x = x + pe
         x = self.attention_layer(x.permute(1, 0, 2)).permute(1, 0, 2)
+        if not self.training:
+            # outside training the relevance head is only used for pruning, see score_retrieval_data
+            return x, None
         y = self.classifier_layer(x)
         if label is not None:
             label = label.to(y.dtype)
-        loss = self.classification_loss(y, label) if self.training else None
+        loss = self.classification_loss(y, label)
         return x, loss
 
+class RFormerInference(nn.Module):
+    """Inference-only R-Former fused with `llama_proj`.
+
+    Same parameters as `RFormer` + `llama_proj`, but batch-first so
+    `nn.TransformerEncoderLayer` can take its fused fast path under no_grad,
+    no permutes, and no classifier head unless `with_scores` is set (then the
+    per-document relevance logits are returned as well). Traceable, so it can
+    be compiled or exported to TorchScript/ONNX on its own.
+    """
+    def __init__(self, input_dim, num_k, hidden_size, d_model=256, n_head=4, num_layers=1, dropout=0.1, with_scores=False) -> None:
+        super().__init__()
+        self.num_k = num_k
+        self.with_scores = with_scores
+        self.input_layer = nn.Linear(in_features=input_dim, out_features=d_model)
+        self.position_embeddings = nn.Embedding(num_k, d_model)
+        encoder_layer = nn.TransformerEncoderLayer(d_model=d_model, nhead=n_head, dropout=dropout, batch_first=True)
+        self.attention_layer = nn.TransformerEncoder(encoder_layer, num_layers=num_layers, enable_nested_tensor=False)
+        self.classifier_layer = nn.Linear(in_features=d_model, out_features=1)
+        self.llama_proj = nn.Linear(d_model, hidden_size)
+
+    def forward(self, x):
+        if x.dim() == 2:
+            x = x.unsqueeze(0)
+        x = self.input_layer(x) + self.position_embeddings.weight[:x.shape[1]]
+        x = self.attention_layer(x)
+        inject_embeds = self.llama_proj(x)
+        if self.with_scores:
+            return inject_embeds, self.classifier_layer(x).squeeze(-1)
+        return inject_embeds
+
+    @classmethod
+    def from_rformer(cls, r_former, llama_proj, with_scores=False):
+        module = cls(
+            input_dim=r_former.input_dim,
+            num_k=r_former.num_k,
+            hidden_size=llama_proj.out_features,
+            d_model=r_former.d_model,
+            n_head=r_former.n_head,
+            num_layers=r_former.num_layers,
+            dropout=r_former.dropout,
+            with_scores=with_scores,
+        )
+        state_dict = dict(r_former.state_dict())
+        state_dict.update({f'llama_proj.{k}': v for k, v in llama_proj.state_dict().items()})
+        module.load_state_dict(state_dict)
+        return module.to(device=llama_proj.weight.device, dtype=llama_proj.weight.dtype).eval()
+
 class RRAGLlamaForCausalLM(PreTrainedModel):
     config_class = RRAGLlamaConfig
     base_model_prefix = "model"
     supports_gradient_checkpointing = True
-    def __init__(self, config):
+    def __init__(self, config, llama_model=None):
         super().__init__(config)
-        self.llama_model = AutoModelForCausalLM.from_pretrained(
-            config.model_name_or_path, 
-            device_map="auto",
-            load_in_8bit=config.load_in_8bit,
-            )
+        if llama_model is None:
+            llama_model = AutoModelForCausalLM.from_pretrained(
+                config.model_name_or_path, 
+                device_map=config.device_map,
+                load_in_8bit=config.load_in_8bit,
+                trust_remote_code=config.trust_remote_code,
+                )
+        # an already loaded LLM can be passed in and shared, e.g. across sweep runs
+        self.llama_model = llama_model
+        if config.hidden_size is None:
+            config.hidden_size = self.llama_model.config.hidden_size
+        if config.unk_token_id >= self.llama_model.get_input_embeddings().num_embeddings:
+            # the retrieval placeholder was added to the tokenizer (see model_families.setup_tokenizer);
+            # its embedding row is always overwritten by the R-Former output
+            self.llama_model.resize_token_embeddings(config.unk_token_id + 1)
         if config.freeze_llm:
             print('freeze_llm')
             for name, param in self.llama_model.named_parameters():
                 param.requires_grad = False
         self.r_former = RFormer(input_dim=config.input_dim, num_k=config.num_k, d_model=config.d_model).to(self.llama_model.device)
         self.llama_proj = nn.Linear(config.d_model, config.hidden_size, device=self.llama_model.device)
+        self.r_former_inference = None
+        self.static_generator = None
+
+    def build_inference_rformer(self, with_scores=False, compile=False):
+        # fused, eval-only copy of r_former + llama_proj used by encode_retrieval_data outside training;
+        # rebuild after the weights change (e.g. after training or from_pretrained)
+        module = RFormerInference.from_rformer(self.r_former, self.llama_proj, with_scores=with_scores)
+        for param in module.parameters():
+            param.requires_grad = False
+        self.r_former_inference = torch.compile(module, dynamic=True) if compile else module
+        return self.r_former_inference
+
+    def enable_static_generation(self, buckets=DEFAULT_BUCKETS, compile=True):
+        # greedy decoding with prompt-length buckets, a static KV cache and a compiled
+        # decode step, falling back to llama_model.generate otherwise (see static_generation.py)
+        self.static_generator = StaticShapeGenerator(self.llama_model, buckets=buckets, compile=compile)
+        return self.static_generator
 
     def get_input_embeddings(self):
         return self.llama_model.get_input_embeddings()
@@ -112,28 +195,62 @@ class RRAGLlamaForCausalLM(PreTrainedModel):
             embeds = embeds.unsqueeze(-1)
         if label is not None and label.dim() <= 2:
             label = label.unsqueeze(-1)
-        logits, loss = self.r_former(embeds, label)
-        inject_embeds = self.llama_proj(logits)
+        if self.r_former_inference is not None and not self.training:
+            with profiler.stage('rformer'), torch.no_grad():
+                inject_embeds = self.r_former_inference(embeds.to(self.llama_proj.weight.dtype))
+                if isinstance(inject_embeds, tuple):
+                    inject_embeds = inject_embeds[0]
+            return inject_embeds, None
+        with profiler.stage('rformer'):
+            logits, loss = self.r_former(embeds, label)
+            inject_embeds = self.llama_proj(logits)
         return inject_embeds, loss
 
+    def score_retrieval_data(
+        self,
+        embeds: torch.Tensor,
+        ):
+        # one R-Former pass giving both the injected embeddings and the per-document
+        # relevance logits of the classifier head, for pruning documents at inference
+        if embeds.dim() <= 2 and self.config.input_dim == 1:
+            embeds = embeds.unsqueeze(-1)
+        with profiler.stage('rformer'), torch.no_grad():
+            if self.r_former_inference is not None and getattr(self.r_former_inference, 'with_scores', False):
+                return self.r_former_inference(embeds.to(self.llama_proj.weight.dtype))
+            x, _ = self.r_former(embeds)
+            scores = self.r_former.classifier_layer(x).squeeze(-1)
+            inject_embeds = self.llama_proj(x)
+        return inject_embeds, scores
+
     def encode_inputs(self, 
         input_ids: torch.Tensor, 
         embeds: Optional[torch.Tensor] = None,
         label: Optional[torch.Tensor] = None,
+        inject_embeds: Optional[torch.Tensor] = None,
+        doc_mask: Optional[torch.Tensor] = None,
     ):
         embed_tokens = self.get_input_embeddings()
-        input_embeds = embed_tokens(input_ids)
-        if embeds is not None:
-            inject_embeds, loss = self.encode_retrieval_data(embeds, label)
+        with profiler.stage('embed_lookup'):
+            input_embeds = embed_tokens(input_ids)
+        if embeds is not None or inject_embeds is not None:
+            if inject_embeds is None:
+                inject_embeds, loss = self.encode_retrieval_data(embeds, label)
+            else:
+                loss = None
             unk_token_id = self.config.unk_token_id
             if input_embeds.dim() == 2:
                 raise ValueError('dim error')
             elif input_embeds.dim() == 3:
-                updated_input_embeds = input_embeds.clone()
-                replace_idx = torch.nonzero(input_ids==unk_token_id).squeeze()
-                inject_embeds = inject_embeds.reshape([-1, inject_embeds.shape[-1]])
-                updated_input_embeds[replace_idx[:, 0], replace_idx[:, 1]] = inject_embeds.to(input_embeds.dtype)
-                return updated_input_embeds.contiguous(), loss
+                with profiler.stage('embed_scatter'):
+                    updated_input_embeds = input_embeds.clone()
+                    replace_idx = torch.nonzero(input_ids==unk_token_id)
+                    if doc_mask is not None:
+                        # packed prompts keep a retrieval slot only for the documents in doc_mask
+                        inject_embeds = inject_embeds[doc_mask.to(inject_embeds.device).bool()]
+                    inject_embeds = inject_embeds.reshape([-1, inject_embeds.shape[-1]])
+                    updated_input_embeds[replace_idx[:, 0], replace_idx[:, 1]] = inject_embeds.to(input_embeds.dtype)
+                    updated_input_embeds = updated_input_embeds.contiguous()
+                return updated_input_embeds, loss
         else:
             return input_embeds, None
 
@@ -143,13 +260,14 @@ class RRAGLlamaForCausalLM(PreTrainedModel):
         input_ids: torch.Tensor,
         embeds: Optional[torch.Tensor] = None,
         label: Optional[torch.Tensor] = None,
+        doc_mask: Optional[torch.Tensor] = None,
         **kwargs,
     ):
         if embeds is None:
             raise ValueError('embeds is None')
         if label is None:
             raise ValueError('label is None')
-        inputs_embeds, loss = self.encode_inputs(input_ids, embeds, label)
+        inputs_embeds, loss = self.encode_inputs(input_ids, embeds, label, doc_mask=doc_mask)
         if 'inputs_embeds' in kwargs:
             _ = kwargs.pop('inputs_embeds')
         outputs = self.llama_model(inputs_embeds=inputs_embeds, **kwargs)
@@ -162,12 +280,21 @@ class RRAGLlamaForCausalLM(PreTrainedModel):
         inputs: torch.Tensor,
         **kwargs
     ):
-        if 'embeds' not in inputs.keys():
+        if 'embeds' not in inputs.keys() and 'inject_embeds' not in inputs.keys():
             raise ValueError('embeds is None')
-        inputs_embeds, loss = self.encode_inputs(inputs['input_ids'], inputs['embeds'])
+        inputs_embeds, loss = self.encode_inputs(inputs['input_ids'], inputs.get('embeds'), inject_embeds=inputs.get('inject_embeds'), doc_mask=inputs.get('doc_mask'))
         if 'inputs_embeds' in kwargs:
             _ = kwargs.pop('inputs_embeds')
-        outputs = self.llama_model.generate(inputs_embeds=inputs_embeds, **kwargs)
+        if self.static_generator is not None:
+            with profiler.stage('generate'):
+                outputs = self.static_generator.generate(inputs_embeds, inputs.get('attention_mask'), **kwargs)
+            profiler.count('generated_tokens', outputs.numel())
+            return outputs
+        if profiler.enabled:
+            kwargs['logits_processor'] = LogitsProcessorList(list(kwargs.get('logits_processor') or []) + [GenerationTimingProcessor(profiler)])
+        with profiler.stage('generate'):
+            outputs = self.llama_model.generate(inputs_embeds=inputs_embeds, **kwargs)
+        profiler.count('generated_tokens', outputs.numel())
         return outputs
 
     def save_model(self, save_directory):
@@ -189,16 +316,15 @@ class RRAGLlamaForCausalLM(PreTrainedModel):
         if config is None:
             raise ValueError("Configuration must be provided with `config` argument.")
         
-        model = cls(config)
+        llama_model = kwargs.pop('llama_model', None)
+        if not config.freeze_llm:
+            # the fine-tuned LLM was saved next to the R-Former; a frozen one is the base model
+            print(f'Load LLM params from: {pretrained_model_path}')
+            llama_model = AutoModelForCausalLM.from_pretrained(pretrained_model_path, device_map=config.device_map, load_in_8bit=config.load_in_8bit, trust_remote_code=config.trust_remote_code)
+        model = cls(config, llama_model=llama_model)
 
-        llm_path = config.model_name_or_path if config.freeze_llm else pretrained_model_path
-        print(f'Load LLM params from: {llm_path}')
-        llama_model_class = AutoModelForCausalLM.from_pretrained
-        llama_model = llama_model_class(llm_path, device_map="auto", load_in_8bit=config.load_in_8bit)
-        model.llama_model = llama_model
-        
         model_path = os.path.join(pretrained_model_path, 'RRAGLlama_pytorch_model.bin')
-        other_model_dict = torch.load(model_path)
+        other_model_dict = torch.load(model_path, map_location=model.llama_proj.weight.device)
         model.r_former.load_state_dict(other_model_dict['r_former'])
         model.llama_proj.load_state_dict(other_model_dict['llama_proj'])
         return model
@@ -0,0 +1,146 @@
+"""Static-shape greedy generation for `torch.compile`.
+
+`generate` on `inputs_embeds` sees a different prompt length every call, so a
+compiled forward is retraced for every prompt. `StaticShapeGenerator` rounds
+the prompt length up to a fixed bucket, keeps a preallocated `StaticCache` of
+`bucket + max_new_tokens` slots per bucket and runs a decode step whose shapes
+only depend on the bucket, so `torch.compile` traces it once per bucket. The
+prefill itself stays on the regular path (it runs once per prompt and is
+already a single large batched forward).
+
+Only greedy decoding (`do_sample=False, num_beams=1`) on models with static
+cache support (Llama-style models in transformers 4.40) goes through this
+path; everything else falls back to the eager `generate`.
+"""
+import time
+import torch
+from transformers import LogitsProcessorList
+from transformers.cache_utils import StaticCache
+
+from RRAG.utils.profiling import profiler, GenerationTimingProcessor
+
+DEFAULT_BUCKETS = (256, 512, 1024, 2048, 4096)
+
+
+class StaticShapeGenerator:
+    def __init__(self, llm, buckets=DEFAULT_BUCKETS, compile=True):
+        self.llm = llm
+        self.buckets = sorted(buckets)
+        self.compile = compile
+        self.caches = {}
+        self.decode_fns = {}
+        self.disabled = not hasattr(llm, '_setup_cache') or not hasattr(getattr(llm, 'model', None), 'layers')
+        if self.disabled:
+            print(f'static generation is not supported by {type(llm).__name__}, using eager generate')
+        if compile:
+            # one graph per bucket
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * len(self.buckets))
+
+    def get_bucket(self, length):
+        for bucket in self.buckets:
+            if length <= bucket:
+                return bucket
+        return None
+
+    def can_generate(self, inputs_embeds, kwargs):
+        max_new_tokens = kwargs.get('max_new_tokens')
+        if self.disabled or max_new_tokens is None or inputs_embeds.shape[0] != 1:
+            return False
+        if kwargs.get('do_sample') or kwargs.get('num_beams', 1) != 1:
+            return False
+        if kwargs.get('repetition_penalty', 1.0) != 1.0 or kwargs.get('logits_processor'):
+            return False
+        bucket = self.get_bucket(inputs_embeds.shape[1])
+        return bucket is not None and bucket + max_new_tokens <= self.llm.config.max_position_embeddings
+
+    def set_cache(self, bucket, max_new_tokens, batch_size):
+        key = (bucket, max_new_tokens, batch_size)
+        if key not in self.caches:
+            self.llm._setup_cache(StaticCache, batch_size, bucket + max_new_tokens)
+            self.caches[key] = [layer.self_attn.past_key_value for layer in self.llm.model.layers]
+        for layer, cache in zip(self.llm.model.layers, self.caches[key]):
+            layer.self_attn.past_key_value = cache
+        return key
+
+    def release_cache(self):
+        # layers holding a `past_key_value` attribute are treated as static-cache layers by
+        # the eager path, so detach the buffers between calls
+        for layer in self.llm.model.layers:
+            if hasattr(layer.self_attn, 'past_key_value'):
+                del layer.self_attn.past_key_value
+
+    def decode_step(self, input_ids, position_ids, cache_position, attention_mask):
+        outputs = self.llm(
+            input_ids=input_ids,
+            position_ids=position_ids,
+            cache_position=cache_position,
+            attention_mask=attention_mask,
+            use_cache=False,
+            return_dict=True,
+        )
+        return outputs.logits[:, -1]
+
+    def get_decode_fn(self, key):
+        if key not in self.decode_fns:
+            self.decode_fns[key] = torch.compile(self.decode_step, dynamic=False) if self.compile else self.decode_step
+        return self.decode_fns[key]
+
+    def generate(self, inputs_embeds, attention_mask=None, **kwargs):
+        if self.can_generate(inputs_embeds, kwargs):
+            eos_token_id = kwargs.get('eos_token_id', self.llm.generation_config.eos_token_id)
+            try:
+                return self.static_generate(inputs_embeds, attention_mask, kwargs['max_new_tokens'], eos_token_id)
+            except Exception as e:
+                print(f'static generation failed ({type(e).__name__}: {e}), falling back to eager generate')
+                self.disabled = True
+        return self.eager_generate(inputs_embeds, **kwargs)
+
+    def eager_generate(self, inputs_embeds, **kwargs):
+        if profiler.enabled:
+            kwargs['logits_processor'] = LogitsProcessorList(list(kwargs.get('logits_processor') or []) + [GenerationTimingProcessor(profiler)])
+        return self.llm.generate(inputs_embeds=inputs_embeds, **kwargs)
+
+    @torch.no_grad()
+    def static_generate(self, inputs_embeds, attention_mask=None, max_new_tokens=100, eos_token_id=None):
+        batch_size, length, _ = inputs_embeds.shape
+        device = inputs_embeds.device
+        bucket = self.get_bucket(length)
+        if attention_mask is None:
+            attention_mask = torch.ones(batch_size, length, dtype=torch.long, device=device)
+        eos_token_ids = torch.tensor([eos_token_id] if isinstance(eos_token_id, int) else (eos_token_id or []), device=device)
+
+        # the prefill runs on the regular (dynamic-cache) path, so it is exactly the eager
+        # prefill; its keys/values are then copied into the bucket's static cache, whose
+        # size (bucket + max_new_tokens) fixes every decode-step shape
+        self.release_cache()
+        start = time.perf_counter()
+        prefill = self.llm(inputs_embeds=inputs_embeds, attention_mask=attention_mask, use_cache=True, return_dict=True)
+        next_tokens = prefill.logits[:, -1].argmax(-1, keepdim=True)
+        profiler.add_time('prefill', start, time.perf_counter())
+        outputs = [next_tokens]
+
+        key = self.set_cache(bucket, max_new_tokens, batch_size)
+        try:
+            for cache, (key_states, value_states) in zip(self.caches[key], prefill.past_key_values):
+                cache.key_cache[:, :, :length] = key_states
+                cache.value_cache[:, :, :length] = value_states
+            del prefill
+            cache_mask = torch.zeros(batch_size, bucket + max_new_tokens, dtype=torch.long, device=device)
+            cache_mask[:, :length] = attention_mask
+            next_position = attention_mask.sum(-1, keepdim=True)
+            decode_fn = self.get_decode_fn(key)
+            for step in range(max_new_tokens - 1):
+                if eos_token_ids.numel() and bool(torch.isin(next_tokens, eos_token_ids).all()):
+                    break
+                step_start = time.perf_counter()
+                cache_position = torch.tensor([length + step], device=device)
+                cache_mask[:, length + step] = 1
+                logits = decode_fn(next_tokens, next_position, cache_position, cache_mask)
+                next_tokens = logits.argmax(-1, keepdim=True)
+                next_position = next_position + 1
+                outputs.append(next_tokens)
+                profiler.add_time('decode', step_start, time.perf_counter())
+                profiler.count('decode_tokens', batch_size)
+        finally:
+            self.release_cache()
+        return torch.cat(outputs, dim=-1)
@@ -0,0 +1,91 @@
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EvalResultLog:
+    """Append-only JSONL log of `(index, response, metrics)` rows.
+
+    The first line is a meta row describing the run; every finished sample is
+    appended and flushed right away, so a crashed evaluation can be resumed by
+    skipping the indices already in the log.
+    """
+
+    def __init__(self, path, meta=None, resume=False):
+        self.path = path
+        self.meta = meta or {}
+        self.completed = {}
+        self.metric_sums = {}
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            if not resume:
+                raise ValueError(f'results log {path} already exists, pass resume=True (--resume) to continue it')
+            self._load()
+            self.fout = open(path, 'a', encoding='utf-8')
+        else:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.fout = open(path, 'w', encoding='utf-8')
+            self._write_line({'meta': self.meta})
+
+    def _load(self):
+        with open(self.path, 'r', encoding='utf-8') as fin:
+            lines = fin.readlines()
+        for line_num, line in enumerate(lines):
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                # a crash can leave a partially written last line behind
+                logger.warning(f'skipping unreadable line {line_num} in {self.path}')
+                continue
+            if 'meta' in row:
+                for key, value in self.meta.items():
+                    if key in row['meta'] and row['meta'][key] != value:
+                        raise ValueError(f'results log {self.path} was written with {key}={row["meta"][key]}, current run has {key}={value}')
+                continue
+            self._add(row)
+        if lines and not lines[-1].endswith('\n'):
+            # terminate a truncated last line so appended rows stay parseable
+            with open(self.path, 'a', encoding='utf-8') as fout:
+                fout.write('\n')
+        print(f'resume from {self.path}: {len(self.completed)} samples already done')
+
+    def _add(self, row):
+        if row['index'] in self.completed:
+            return
+        self.completed[row['index']] = row
+        for name, value in row['metrics'].items():
+            self.metric_sums[name] = self.metric_sums.get(name, 0.0) + value
+
+    def _write_line(self, row):
+        self.fout.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self.fout.flush()
+
+    def __contains__(self, index):
+        return index in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def write(self, index, response, metrics):
+        row = {'index': int(index), 'response': response, 'metrics': metrics}
+        self._write_line(row)
+        self._add(row)
+
+    def running_means(self):
+        if not self.completed:
+            return {}
+        return {name: total / len(self.completed) for name, total in self.metric_sums.items()}
+
+    def responses(self):
+        return {index: row['response'] for index, row in self.completed.items()}
+
+    def close(self):
+        self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
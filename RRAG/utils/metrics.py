@@ -2,44 +2,54 @@
 import argparse
 import json
 import logging
+import os
 import statistics
 import sys
 import string
+import time
 import jieba
 import regex
+import multiprocessing
 from copy import deepcopy
+from functools import lru_cache, partial
 from tqdm import tqdm, trange
 from xopen import xopen
 from typing import List
 from rouge import Rouge
 
+# Ground truths repeat across examples and metrics, so their normalized /
+# segmented forms are cached; predictions go through the same caches.
+CACHE_SIZE = 2 ** 18
+# Below this many examples a process pool costs more than it saves.
+PARALLEL_MIN_EXAMPLES = 2000
+
+ARTICLES_REGEX = regex.compile(r"\b(a|an|the)\b")
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+CN_PUNCTUATION = "！？｡。＂＃＄％＆＇（）＊＋，－／：；＜＝＞＠［＼］＾＿｀｛｜｝～｟｠｢｣､、〃》「」『』【】〔〕〖〗〘〙〚〛〜〝〞〟〰〾〿–—‘’‛“”„‟…‧﹏."
+ZH_PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation + CN_PUNCTUATION)
+
 def normalize_answer(s: str) -> str:
     """Normalization from the SQuAD evaluation script.
 
     See https://worksheets.codalab.org/rest/bundles/0x6b567e1cf2e041ec80d7098f031c5c9e/contents/blob/
     """
+    # lower -> remove_punc -> remove_articles -> white_space_fix
+    return " ".join(ARTICLES_REGEX.sub(" ", s.lower().translate(PUNCTUATION_TABLE)).split())
 
-    def remove_articles(text):
-        return regex.sub(r"\b(a|an|the)\b", " ", text)
-
-    def white_space_fix(text):
-        return " ".join(text.split())
-
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return "".join(ch for ch in text if ch not in exclude)
+@lru_cache(maxsize=CACHE_SIZE)
+def cached_normalize_answer(s: str) -> str:
+    return normalize_answer(s)
 
-    def lower(text):
-        return text.lower()
-
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+@lru_cache(maxsize=CACHE_SIZE)
+def cached_answer_tokens(s: str) -> tuple:
+    return tuple(cached_normalize_answer(s).split())
 
 
 def best_subspan_em(prediction: str, ground_truths: List[str]) -> float:
     normalized_prediction = normalize_answer(prediction)
 
     for ground_truth in ground_truths:
-        normalized_ground_truth = normalize_answer(ground_truth)
+        normalized_ground_truth = cached_normalize_answer(ground_truth)
         if normalized_ground_truth.lower() in normalized_prediction.lower():
             return 1.0
     return 0.0
@@ -56,13 +66,10 @@ def f1_score(prediction: str, ground_truth: List[str]) -> float:
     return f1
 
 def qa_f1_score(prediction, ground_truths):
-    normalized_prediction = normalize_answer(prediction)
+    prediction_tokens = normalize_answer(prediction).split()
     score = []
     for ground_truth in ground_truths:
-        normalized_ground_truth = normalize_answer(ground_truth)
-
-        prediction_tokens = normalized_prediction.split()
-        ground_truth_tokens = normalized_ground_truth.split()
+        ground_truth_tokens = cached_answer_tokens(ground_truth)
         score.append(f1_score(prediction_tokens, ground_truth_tokens))
     return max(score)
 
@@ -70,45 +77,42 @@ def qa_f1_score(prediction, ground_truths):
 logger = logging.getLogger(__name__)
 
 def normalize_zh_answer(s):
-    def white_space_fix(text):
-        return "".join(text.split())
+    # lower -> remove_punc -> white_space_fix
+    return "".join(s.lower().translate(ZH_PUNCTUATION_TABLE).split())
 
-    def remove_punc(text):
-        cn_punctuation = "！？｡。＂＃＄％＆＇（）＊＋，－／：；＜＝＞＠［＼］＾＿｀｛｜｝～｟｠｢｣､、〃》「」『』【】〔〕〖〗〘〙〚〛〜〝〞〟〰〾〿–—‘’‛“”„‟…‧﹏."
-        all_punctuation = set(string.punctuation + cn_punctuation)
-        return "".join(ch for ch in text if ch not in all_punctuation)
+@lru_cache(maxsize=CACHE_SIZE)
+def jieba_cut(s: str) -> tuple:
+    return tuple(jieba.cut(s, cut_all=False))
 
-    def lower(text):
-        return text.lower()
-
-    return white_space_fix(remove_punc(lower(s)))
+@lru_cache(maxsize=CACHE_SIZE)
+def zh_answer_tokens(s: str) -> tuple:
+    tokens = [normalize_zh_answer(token) for token in jieba_cut(s)]
+    return tuple(token for token in tokens if len(token) > 0)
 
 def best_subspan_em_zh(prediction: str, ground_truths: List[str]) -> float:
-    prediction_tokens = list(jieba.cut(prediction, cut_all=False))
-    prediction_tokens = [normalize_zh_answer(token) for token in prediction_tokens]
-    prediction_tokens = [token for token in prediction_tokens if len(token) > 0]
+    prediction_text = ''.join(zh_answer_tokens(prediction))
     for ground_truth in ground_truths:
-        ground_truth_tokens = list(jieba.cut(ground_truth, cut_all=False))
-        ground_truth_tokens = [normalize_zh_answer(token) for token in ground_truth_tokens]
-        ground_truth_tokens = [token for token in ground_truth_tokens if len(token) > 0]
-        if ''.join(prediction_tokens) in ''.join(ground_truth_tokens):
+        if prediction_text in ''.join(zh_answer_tokens(ground_truth)):
             return 1.0
     return 0.0
 
 def qa_f1_zh_score(prediction, ground_truths, **kwargs):
-    prediction_tokens = list(jieba.cut(prediction, cut_all=False))
-    prediction_tokens = [normalize_zh_answer(token) for token in prediction_tokens]
-    prediction_tokens = [token for token in prediction_tokens if len(token) > 0]
+    prediction_tokens = zh_answer_tokens(prediction)
     score = []
     for ground_truth in ground_truths:
-        ground_truth_tokens = list(jieba.cut(ground_truth, cut_all=False))
-        ground_truth_tokens = [normalize_zh_answer(token) for token in ground_truth_tokens]
-        ground_truth_tokens = [token for token in ground_truth_tokens if len(token) > 0]
+        ground_truth_tokens = zh_answer_tokens(ground_truth)
         score.append(f1_score(prediction_tokens, ground_truth_tokens))
     return max(score)
 
+_rouge = None
+def get_rouge():
+    global _rouge
+    if _rouge is None:
+        _rouge = Rouge()
+    return _rouge
+
 def rouge_score(prediction, ground_truth, **kwargs):
-    rouge = Rouge()
+    rouge = get_rouge()
     try:
         scores = rouge.get_scores([prediction], [ground_truth], avg=True)
     except:
@@ -116,10 +120,10 @@ def rouge_score(prediction, ground_truth, **kwargs):
     return scores["rouge-l"]["f"]
 
 def rouge_zh_score(prediction, ground_truths):
-    prediction = " ".join(list(jieba.cut(prediction, cut_all=False)))
+    prediction = " ".join(jieba_cut(prediction))
     score = []
     for ground_truth in ground_truths:
-        ground_truth = " ".join(list(jieba.cut(ground_truth, cut_all=False))) 
+        ground_truth = " ".join(jieba_cut(ground_truth))
         score.append(rouge_score(prediction, ground_truth))
     return max(score)
 
@@ -151,20 +155,42 @@ def get_metrics_for_example(example, METRICS):
         example_metrics[metric_name] = metric(prediction=model_answer, ground_truths=gold_answers)
     return (example_metrics, example)
 
-def evaluation_from_list(responses, answers, dataset_name):
+def get_metrics_for_dataset(dataset_name):
     if 'nq' in dataset_name:
-        METRICS = METRICS_NQ
+        return METRICS_NQ
     elif 'dureader' in dataset_name:
-        METRICS = METRICS_ZH
-    else:
-        METRICS = METRICS_EN
+        return METRICS_ZH
+    return METRICS_EN
+
+def evaluation_from_list(responses, answers, dataset_name, num_proc=None, chunksize=256):
+    """Scores `responses` against `answers` and prints the averaged metrics.
+
+    `num_proc=None` fans out over a process pool only for large eval sets
+    (>= PARALLEL_MIN_EXAMPLES); pass `num_proc=1` to force serial scoring.
+    Results are returned in input order and are identical either way.
+    """
+    METRICS = get_metrics_for_dataset(dataset_name)
 
     logger.info("Computing metrics")
-    all_example_metrics = []
     if len(responses) != len(answers):
         raise ValueError
-    for i in trange(len(responses)):
-        all_example_metrics.append(get_metrics_for_example({'model_answer': responses[i], 'answers': answers[i]}, METRICS))
+    examples = [{'model_answer': responses[i], 'answers': answers[i]} for i in range(len(responses))]
+    if num_proc is None:
+        num_proc = min(os.cpu_count() or 1, 8) if len(examples) >= PARALLEL_MIN_EXAMPLES else 1
+
+    start_time = time.perf_counter()
+    if num_proc > 1:
+        with multiprocessing.Pool(num_proc) as pool:
+            all_example_metrics = list(tqdm(
+                pool.imap(partial(get_metrics_for_example, METRICS=METRICS), examples, chunksize=chunksize),
+                total=len(examples),
+            ))
+    else:
+        all_example_metrics = [get_metrics_for_example(examples[i], METRICS) for i in trange(len(examples))]
+    elapsed = time.perf_counter() - start_time
+    throughput = len(examples) / elapsed if elapsed > 0 else float('inf')
+    logger.info(f"scored {len(examples)} examples in {elapsed:.2f}s ({throughput:.1f} examples/s, num_proc={num_proc})")
+    print(f"scored {len(examples)} examples in {elapsed:.2f}s ({throughput:.1f} examples/s, num_proc={num_proc})")
 
     # Average metrics across examples
 
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import threading
+import statistics
+from contextlib import contextmanager, nullcontext
+
+import torch
+from transformers import LogitsProcessor
+
+_NULL_CONTEXT = nullcontext()
+
+
+class Profiler:
+    """Per-stage wall-clock timers, counters and a Chrome-trace event list.
+
+    Disabled by default: `stage()` then returns a shared no-op context and
+    `count()` returns immediately, so instrumented code pays almost nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sync_cuda = True
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.counters = {}
+        self.events = []
+        self.start_time = time.perf_counter()
+        self.torch_profiler = None
+
+    def enable(self, sync_cuda=True, use_torch_profiler=False):
+        self.reset()
+        self.enabled = True
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        if use_torch_profiler:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.torch_profiler.__enter__()
+
+    def disable(self):
+        if self.torch_profiler is not None:
+            self.torch_profiler.__exit__(None, None, None)
+        self.enabled = False
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name) if self.torch_profiler is not None else _NULL_CONTEXT:
+            try:
+                yield
+            finally:
+                if self.sync_cuda:
+                    torch.cuda.synchronize()
+                self.add_time(name, start, time.perf_counter())
+
+    def add_time(self, name, start, end):
+        if not self.enabled:
+            return
+        self.timings.setdefault(name, []).append(end - start)
+        self.events.append({
+            'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+            'ts': (start - self.start_time) * 1e6, 'dur': (end - start) * 1e6,
+        })
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        stages = {}
+        for name, values in self.timings.items():
+            ordered = sorted(values)
+            stages[name] = {
+                'count': len(values),
+                'total_s': sum(values),
+                'mean_ms': statistics.mean(values) * 1e3,
+                'p50_ms': ordered[len(ordered) // 2] * 1e3,
+                'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1e3,
+            }
+        counters = dict(self.counters)
+        if counters.get('padded_tokens'):
+            counters['pad_ratio'] = counters.get('pad_tokens', 0) / counters['padded_tokens']
+        decode_s = stages.get('decode', {}).get('total_s', 0)
+        if decode_s > 0:
+            counters['decode_tokens_per_s'] = counters.get('decode_tokens', 0) / decode_s
+        return {
+            'wall_time_s': time.perf_counter() - self.start_time,
+            'stages': stages,
+            'counters': counters,
+        }
+
+    def save(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        summary_path = os.path.join(output_dir, 'profile_summary.json')
+        with open(summary_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        with open(os.path.join(output_dir, 'trace.json'), 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        if self.torch_profiler is not None:
+            self.disable()
+            self.torch_profiler.export_chrome_trace(os.path.join(output_dir, 'torch_trace.json'))
+        print('profile_save_path', summary_path)
+        return summary_path
+
+
+class GenerationTimingProcessor(LogitsProcessor):
+    """Splits `generate` into prefill and decode time.
+
+    Called once per generation step right after the model forward, so the
+    first call closes the prefill and every later call closes a decode step.
+    """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.last_time = time.perf_counter()
+        self.num_steps = 0
+
+    def __call__(self, input_ids, scores):
+        if self.profiler.sync_cuda:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.profiler.add_time('prefill' if self.num_steps == 0 else 'decode', self.last_time, now)
+        if self.num_steps > 0:
+            self.profiler.count('decode_tokens', scores.shape[0])
+        self.last_time = now
+        self.num_steps += 1
+        return scores
+
+
+profiler = Profiler()
@@ -0,0 +1,227 @@
+"""Memory-budget-aware training configuration.
+
+`plan_training` probes the memory of the training device (or takes a budget),
+estimates the peak training memory of the model from its parameter count and
+the LLM shape, and picks the micro-batch size, gradient accumulation steps,
+gradient-checkpointing granularity (every k-th decoder layer) and optimizer
+that fit, preferring the least recomputation and a full-precision optimizer,
+so training fills the device instead of using fixed conservative settings.
+Mixed precision and the optimizer are always resolved against what the device
+supports (no bf16/tf32/paged optimizers on CPU).
+"""
+import os
+import math
+import importlib.util
+from dataclasses import dataclass
+from functools import partial
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+# optimizer state bytes per trainable parameter (Adam moments)
+OPTIMIZER_STATE_BYTES = {
+    'adamw_torch_fused': 8,
+    'adamw_torch': 8,
+    'paged_adamw_32bit': 8,
+    'adamw_bnb_8bit': 2,
+    'paged_adamw_8bit': 2,
+}
+BNB_OPTIMIZERS = ['adamw_bnb_8bit', 'paged_adamw_32bit', 'paged_adamw_8bit']
+# 0: no checkpointing, k: checkpoint every k-th decoder layer; ordered by recompute cost
+CHECKPOINT_CHOICES = [0, 4, 2, 1]
+
+
+@dataclass
+class TrainingPlan:
+    per_device_train_batch_size: int
+    gradient_accumulation_steps: int
+    checkpoint_every: int
+    optim: str
+    bf16: bool
+    fp16: bool
+    tf32: bool
+    estimated_bytes: int
+    budget_bytes: int
+
+    def training_arguments(self):
+        return dict(
+            per_device_train_batch_size=self.per_device_train_batch_size,
+            gradient_accumulation_steps=self.gradient_accumulation_steps,
+            optim=self.optim,
+            bf16=self.bf16,
+            fp16=self.fp16,
+            tf32=self.tf32,
+        )
+
+    def __str__(self):
+        return (f'micro_batch={self.per_device_train_batch_size} accumulation={self.gradient_accumulation_steps} '
+                f'checkpoint_every={self.checkpoint_every} optim={self.optim} bf16={self.bf16} fp16={self.fp16} tf32={self.tf32} '
+                f'estimated={self.estimated_bytes / 2**30:.2f}GiB budget={self.budget_bytes / 2**30:.2f}GiB')
+
+
+def probe_memory(device):
+    # bytes currently available on `device`
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def get_supported_optimizers(device):
+    device = torch.device(device)
+    optimizers = ['adamw_torch']
+    if device.type == 'cuda':
+        optimizers.insert(0, 'adamw_torch_fused')
+        if importlib.util.find_spec('bitsandbytes') is not None:
+            optimizers += BNB_OPTIMIZERS
+    return optimizers
+
+
+def resolve_optimizer(optim, device):
+    # the requested optimizer if the device supports it, else the closest supported one
+    supported = get_supported_optimizers(device)
+    if optim in supported:
+        return optim
+    fallback = supported[0] if OPTIMIZER_STATE_BYTES.get(optim, 8) == 8 else supported[-1]
+    print(f'optimizer {optim} is not supported on {device}, using {fallback}')
+    return fallback
+
+
+def get_precision(device):
+    # (bf16, fp16, tf32) mixed-precision flags for TrainingArguments
+    device = torch.device(device)
+    if device.type != 'cuda':
+        return False, False, False
+    bf16 = torch.cuda.is_bf16_supported()
+    tf32 = torch.cuda.get_device_capability(device)[0] >= 8
+    return bf16, not bf16, tf32
+
+
+def get_model_stats(model, llm):
+    config = llm.config
+    return {
+        'param_bytes': sum(p.numel() * p.element_size() for p in model.parameters()),
+        'trainable_params': sum(p.numel() for p in model.parameters() if p.requires_grad),
+        'hidden_size': config.hidden_size,
+        'num_layers': config.num_hidden_layers,
+        'num_heads': config.num_attention_heads,
+        'vocab_size': config.vocab_size,
+    }
+
+
+def estimate_training_memory(stats, micro_batch, seq_length, checkpoint_every, optim, activation_bytes=2, attention_scores=True):
+    """Peak bytes for one training step: weights, fp32 gradients and optimizer states of the
+    trainable parameters, decoder activations (Korthikanti et al., 2022: s*b*h*(34 + 5*a*s/h)
+    half-precision bytes per layer, only the layer input for checkpointed layers plus one
+    layer being recomputed) and the fp32 logits with their gradient."""
+    h, a, s, b = stats['hidden_size'], stats['num_heads'], seq_length, micro_batch
+    scale = activation_bytes / 2
+    full_layer = s * b * h * (34 + (5 * a * s / h if attention_scores else 0)) * scale
+    layer_input = s * b * h * activation_bytes
+    num_layers = stats['num_layers']
+    if checkpoint_every:
+        checkpointed = math.ceil(num_layers / checkpoint_every)
+        activations = checkpointed * layer_input + (num_layers - checkpointed) * full_layer + full_layer
+    else:
+        activations = num_layers * full_layer
+    logits = 2 * s * b * stats['vocab_size'] * 4
+    states = stats['trainable_params'] * (4 + OPTIMIZER_STATE_BYTES[optim])
+    return int(stats['param_bytes'] + states + activations + logits)
+
+
+def get_micro_batch_sizes(global_batch_size):
+    # micro-batch sizes that divide the global batch, largest first
+    return [b for b in range(global_batch_size, 0, -1) if global_batch_size % b == 0]
+
+
+def plan_training(
+    model, llm, device, seq_length, global_batch_size,
+    memory_budget=None, memory_fraction=0.9, optim=None, checkpoint_every=None,
+):
+    """Picks the TrainingPlan with the largest micro batch that fits `memory_budget` bytes
+    (default: `memory_fraction` of the probed free memory), trying the cheapest settings first:
+    no checkpointing before every 4th / 2nd / every layer, 32-bit before 8-bit optimizers.
+    `optim` / `checkpoint_every` fix that choice instead of searching it."""
+    device = torch.device(device)
+    bf16, fp16, tf32 = get_precision(device)
+    if memory_budget is None:
+        memory_budget = int(probe_memory(device) * memory_fraction)
+    stats = get_model_stats(model, llm)
+    activation_bytes = 2 if (bf16 or fp16) else 4
+    # the math SDPA kernel used on CPU materializes the attention scores
+    estimate = partial(estimate_training_memory, stats, seq_length=seq_length, activation_bytes=activation_bytes,
+                       attention_scores=device.type != 'cuda')
+
+    optimizers = [resolve_optimizer(optim, device)] if optim else get_supported_optimizers(device)
+    optimizers = sorted(optimizers, key=lambda o: -OPTIMIZER_STATE_BYTES[o])
+    checkpoints = [checkpoint_every] if checkpoint_every is not None else CHECKPOINT_CHOICES
+    micro_batches = get_micro_batch_sizes(global_batch_size)
+
+    best = None
+    for opt in optimizers:
+        for every in checkpoints:
+            for micro_batch in micro_batches:
+                needed = estimate(micro_batch=micro_batch, checkpoint_every=every, optim=opt)
+                if needed <= memory_budget:
+                    if best is None or micro_batch > best[0]:
+                        best = (micro_batch, every, opt, needed)
+                    break
+            if best is not None and best[0] == global_batch_size:
+                break
+        if best is not None:
+            break
+    if best is None:
+        # nothing fits the estimate: smallest footprint and let the allocator decide
+        opt, every = optimizers[-1], checkpoints[-1]
+        best = (1, every, opt, estimate(micro_batch=1, checkpoint_every=every, optim=opt))
+        print(f'training needs ~{best[3] / 2**30:.2f}GiB at micro batch 1, more than the {memory_budget / 2**30:.2f}GiB budget')
+    micro_batch, every, opt, needed = best
+    return TrainingPlan(
+        per_device_train_batch_size=micro_batch,
+        gradient_accumulation_steps=global_batch_size // micro_batch,
+        checkpoint_every=every,
+        optim=opt,
+        bf16=bf16,
+        fp16=fp16,
+        tf32=tf32,
+        estimated_bytes=needed,
+        budget_bytes=memory_budget,
+    )
+
+
+def get_layer_index(fn, layers):
+    layer = getattr(fn, '__self__', None)
+    return layers.get(id(layer))
+
+
+def apply_gradient_checkpointing(llm, checkpoint_every):
+    """Checkpoints every `checkpoint_every`-th decoder layer of `llm` (1: all of them, 0: none)
+    through the transformers `_gradient_checkpointing_func` hook, non-reentrant so gradients
+    reach the injected R-Former embeddings even when the LLM is frozen."""
+    if not checkpoint_every:
+        if getattr(llm, 'is_gradient_checkpointing', False):
+            llm.gradient_checkpointing_disable()
+        return
+    llm.gradient_checkpointing_enable(gradient_checkpointing_kwargs={'use_reentrant': False})
+    if checkpoint_every == 1:
+        return
+    full = partial(checkpoint, use_reentrant=False)
+    for module in llm.modules():
+        if getattr(module, 'gradient_checkpointing', False) and hasattr(module, 'layers'):
+            layers = {id(layer): i for i, layer in enumerate(module.layers)}
+
+            def selective(fn, *args, layers=layers, **kwargs):
+                index = get_layer_index(fn, layers)
+                if index is None or index % checkpoint_every == 0:
+                    return full(fn, *args, **kwargs)
+                return fn(*args, **kwargs)
+
+            module._gradient_checkpointing_func = selective
@@ -55,8 +55,11 @@ class RRAGTrainer(SFTTrainer):
                 else:
                     self._dataset_sanity_checked = True
 
-            return {"input_ids": outputs["input_ids"], "attention_mask": outputs["attention_mask"], "embeds": element["embeds"], "label": element["label"]}
-        signature_columns = ["input_ids", "labels", "attention_mask", "embeds", "answers", "label"]
+            tokenized = {"input_ids": outputs["input_ids"], "attention_mask": outputs["attention_mask"], "embeds": element["embeds"], "label": element["label"]}
+            if "doc_mask" in element:
+                tokenized["doc_mask"] = element["doc_mask"]
+            return tokenized
+        signature_columns = ["input_ids", "labels", "attention_mask", "embeds", "answers", "label", "doc_mask"]
 
         extra_columns = list(set(dataset.column_names) - set(signature_columns))
         print('remove extra_columns:', extra_columns)
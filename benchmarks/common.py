@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import random
+import pathlib
+import statistics
+import tempfile
+
+import torch
+import numpy as np
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+# retrieval/ scripts import their helpers as top-level modules
+sys.path.insert(0, str(REPO_ROOT / 'retrieval'))
+# and so do the datasets/ scripts; appended so its modules never shadow installed ones
+sys.path.append(str(REPO_ROOT / 'datasets'))
+
+def seed_all(seed=42):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def time_fn(fn, repeat=10, warmup=2, items=1):
+    """Runs `fn` `warmup + repeat` times and returns latency stats in ms.
+
+    `items` is the amount of work done per call, used for throughput.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    ordered = sorted(times)
+    p50 = ordered[len(ordered) // 2]
+    return {
+        'repeat': repeat,
+        'mean_ms': statistics.mean(times) * 1e3,
+        'p50_ms': p50 * 1e3,
+        'min_ms': ordered[0] * 1e3,
+        'items_per_s': items / p50 if p50 > 0 else float('inf'),
+    }
+
+
+def make_generator(seed=42, num_words=40):
+    from RRAG.dataset.synthetic import SyntheticGenerator
+    return SyntheticGenerator(seed=seed, vocab_size=500, num_words=num_words, text_pool_size=256)
+
+
+def make_nq_examples(num_examples, num_k=10, num_words=40, seed=42):
+    return list(make_generator(seed, num_words).examples('nq', num_examples, num_k))
+
+
+VI_SYLLABLES = ['viêm', 'gan', 'đau', 'đầu', 'tiểu', 'đường', 'huyết', 'áp', 'cao', 'u', 'xơ', 'tử', 'cung', 'thai',
+                'kỳ', 'sốt', 'xuất', 'phổi', 'dạ', 'dày', 'thận', 'mãn', 'tính', 'cấp', 'hội', 'chứng', 'nhiễm', 'trùng']
+
+
+def make_vi_entities(num_entities, seed=42):
+    """Distinct Vietnamese-looking entity names of 2-4 syllables."""
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < num_entities:
+        name = ' '.join(rng.choice(VI_SYLLABLES) for _ in range(rng.randint(2, 4)))
+        names.add(name[0].upper() + name[1:])
+    return sorted(names)
+
+
+def make_vi_texts(entities, num_texts, num_words, seed=42):
+    # texts mixing random syllables with an entity name, half of them written without accents
+    from entity_matcher import normalize
+    rng = random.Random(seed)
+    texts = []
+    for i in range(num_texts):
+        words = [rng.choice(VI_SYLLABLES) for _ in range(num_words)]
+        words.insert(rng.randrange(num_words + 1), rng.choice(entities))
+        text = ' '.join(words)
+        texts.append(normalize(text) if i % 2 else text)
+    return texts
+
+
+def build_tiny_llama(output_dir=None, hidden_size=64, num_hidden_layers=2, vocab_size=512):
+    """Saves a randomly initialised Llama and a byte-level BPE tokenizer
+    (`<unk>` = 0, the retrieval placeholder) to `output_dir` and returns it."""
+    from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+    from transformers import PreTrainedTokenizerFast, LlamaConfig, LlamaForCausalLM
+
+    output_dir = output_dir or os.path.join(tempfile.gettempdir(), f'rrag-tiny-llama-{hidden_size}-{num_hidden_layers}-{vocab_size}')
+    if os.path.exists(os.path.join(output_dir, 'config.json')):
+        return output_dir
+    seed_all(0)
+    # same vocabulary as make_nq_examples() with its default seed
+    corpus = list(make_generator(seed=42).text_pool)
+    for prompt_file in (REPO_ROOT / 'RRAG' / 'prompts').glob('*.prompt'):
+        corpus.append(prompt_file.read_text(encoding='utf-8'))
+    tokenizer = Tokenizer(models.BPE(unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=['<unk>', '<s>', '</s>'],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(corpus, trainer)
+    hf_tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token='<unk>', bos_token='<s>', eos_token='</s>')
+    config = LlamaConfig(
+        vocab_size=len(hf_tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=4096,
+        bos_token_id=hf_tokenizer.bos_token_id,
+        eos_token_id=hf_tokenizer.eos_token_id,
+        pad_token_id=hf_tokenizer.eos_token_id,
+    )
+    hf_tokenizer.save_pretrained(output_dir)
+    LlamaForCausalLM(config).save_pretrained(output_dir)
+    return output_dir
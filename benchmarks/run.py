@@ -0,0 +1,368 @@
+"""CPU benchmarks for the RRAG hot paths on tiny synthetic inputs.
+
+Run from the repository root:
+
+    python -m benchmarks.run                      # run everything, compare with benchmarks/baseline.json
+    python -m benchmarks.run --only rformer_forward generate
+    python -m benchmarks.run --save_baseline      # refresh the stored baseline
+
+Exits with status 1 if any case is slower than the baseline by more than
+--threshold (relative best-of-N latency, which is less noisy than the
+median for millisecond-scale cases), so it can gate a deploy.
+"""
+import io
+import os
+import re
+import sys
+import json
+import argparse
+import platform
+import contextlib
+import unicodedata
+from collections import defaultdict
+from datetime import datetime
+
+import torch
+
+from benchmarks.common import REPO_ROOT, seed_all, time_fn, make_nq_examples, build_tiny_llama, make_vi_entities, make_vi_texts
+
+BASELINE_PATH = REPO_ROOT / 'benchmarks' / 'baseline.json'
+RETRIEVAL_TOKEN = '<R>'
+
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def load_tiny_model(model_path, num_k):
+    from RRAG.models.modeling_rrag import RRAGLlamaForCausalLM, RRAGLlamaConfig
+    config = RRAGLlamaConfig(
+        model_name_or_path=model_path,
+        load_in_8bit=False,
+        input_dim=3,
+        hidden_size=64,
+        unk_token='<unk>',
+        unk_token_id=0,
+        freeze_llm=True,
+        num_k=num_k,
+        device_map={'': 'cpu'},
+    )
+    with quiet():
+        model = RRAGLlamaForCausalLM(config)
+    return model.eval()
+
+
+def load_tiny_tokenizer(model_path):
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    tokenizer.padding_side = "left"
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def build_prompts(examples, tokenizer):
+    from RRAG.dataset.load_nq import get_instruction_dataset, get_embeds
+    with quiet():
+        from runner import RRAGRunner
+        dataset = get_instruction_dataset(examples, range(len(examples)), 1 << 20, tokenizer, True, False, RETRIEVAL_TOKEN)
+    dataset = get_embeds(dataset)
+    prompts = [RRAGRunner.format_instruction_for_response(d['instruction']) for d in dataset]
+    return dataset, prompts
+
+
+##### Benchmarks
+def bench_feature_extraction(args):
+    from retrieval_utils import get_precedent_sim, get_nb_sim
+    results = {}
+    for k in (10, 20, 30):
+        q_emb = torch.nn.functional.normalize(torch.randn(768), dim=-1)
+        c_emb = torch.nn.functional.normalize(torch.randn(k, 768), dim=-1)
+
+        def fn():
+            scores, rank_list, precedent_scores = get_precedent_sim(q_emb, c_emb)
+            get_nb_sim(c_emb, rank_list)
+        results[f'k={k}'] = time_fn(fn, repeat=args.repeat)
+    return results
+
+
+def bench_rformer_forward(args):
+    from RRAG.models.modeling_rrag import RFormer
+    results = {}
+    for k in (10, 20, 30):
+        r_former = RFormer(input_dim=3, num_k=k).eval()
+        for batch_size in (1, 8, 32):
+            x = torch.randn(batch_size, k, 3)
+
+            def fn():
+                with torch.no_grad():
+                    r_former(x)
+            results[f'batch={batch_size},k={k}'] = time_fn(fn, repeat=args.repeat, items=batch_size)
+    return results
+
+
+def bench_encode_inputs(args):
+    model_path = build_tiny_llama()
+    tokenizer = load_tiny_tokenizer(model_path)
+    results = {}
+    for k in (10, 30):
+        model = load_tiny_model(model_path, k)
+        dataset, prompts = build_prompts(make_nq_examples(1, num_k=k), tokenizer)
+        input_ids = tokenizer(prompts[0], return_tensors='pt', add_special_tokens=False)['input_ids']
+        embeds = torch.tensor(dataset[0]['embeds']).unsqueeze(0)
+
+        def fn():
+            with torch.no_grad():
+                model.encode_inputs(input_ids, embeds)
+        results[f'k={k}'] = time_fn(fn, repeat=args.repeat)
+    return results
+
+
+def bench_prompt_build(args):
+    from RRAG.dataset.load_nq import get_instruction_dataset
+    tokenizer = load_tiny_tokenizer(build_tiny_llama())
+    results = {}
+    for k in (10, 30):
+        examples = make_nq_examples(64, num_k=k)
+
+        def fn():
+            with quiet():
+                get_instruction_dataset(examples, range(len(examples)), 1 << 20, tokenizer, True, False, RETRIEVAL_TOKEN)
+        results[f'n=64,k={k}'] = time_fn(fn, repeat=max(1, args.repeat // 2), warmup=1, items=len(examples))
+    return results
+
+
+def bench_tokenization(args):
+    tokenizer = load_tiny_tokenizer(build_tiny_llama())
+    _, prompts = build_prompts(make_nq_examples(32, num_k=10), tokenizer)
+
+    def single():
+        for prompt in prompts:
+            tokenizer(prompt, return_tensors='pt', add_special_tokens=False)
+
+    def batched():
+        tokenizer(prompts, return_tensors='pt', padding='longest', add_special_tokens=False)
+    return {
+        'single,n=32': time_fn(single, repeat=args.repeat, items=len(prompts)),
+        'batch,n=32': time_fn(batched, repeat=args.repeat, items=len(prompts)),
+    }
+
+
+def bench_metrics(args):
+    from RRAG.utils.metrics import evaluation_from_list
+    examples = make_nq_examples(2000, num_k=1)
+    responses = [f"the answer is {e['answers'][0]}." for e in examples]
+    answers = [e['answers'] for e in examples]
+    results = {}
+    for dataset_name in ('nq_10', 'hotpotqa'):
+        def fn():
+            with quiet():
+                evaluation_from_list(responses, answers, dataset_name, num_proc=1)
+        results[f'{dataset_name},n=2000'] = time_fn(fn, repeat=max(1, args.repeat // 2), warmup=1, items=len(responses))
+    return results
+
+
+def bench_generate(args):
+    model_path = build_tiny_llama()
+    tokenizer = load_tiny_tokenizer(model_path)
+    model = load_tiny_model(model_path, 10)
+    dataset, prompts = build_prompts(make_nq_examples(1, num_k=10), tokenizer)
+    input_tokens = tokenizer(prompts[0], return_tensors='pt', add_special_tokens=False)
+    inputs = {
+        'input_ids': input_tokens['input_ids'],
+        'attention_mask': input_tokens['attention_mask'],
+        'embeds': torch.tensor(dataset[0]['embeds']).unsqueeze(0),
+    }
+    max_new_tokens = 16
+
+    def fn():
+        with torch.no_grad():
+            model.generate(inputs=inputs, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False, num_beams=1)
+    return {f'new_tokens={max_new_tokens}': time_fn(fn, repeat=max(1, args.repeat // 2), warmup=1, items=max_new_tokens)}
+
+
+def bench_generate_static(args):
+    # eager generate vs bucketed static-cache greedy decoding, eager and compiled decode step
+    from RRAG.models.static_generation import StaticShapeGenerator
+    model_path = build_tiny_llama()
+    tokenizer = load_tiny_tokenizer(model_path)
+    model = load_tiny_model(model_path, 10)
+    dataset, prompts = build_prompts(make_nq_examples(1, num_k=10), tokenizer)
+    input_tokens = tokenizer(prompts[0], return_tensors='pt', add_special_tokens=False)
+    with torch.no_grad():
+        inputs_embeds, _ = model.encode_inputs(input_tokens['input_ids'], torch.tensor(dataset[0]['embeds']).unsqueeze(0))
+    max_new_tokens = 32
+    kwargs = dict(max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False, num_beams=1)
+    results = {}
+
+    def eager():
+        with torch.no_grad():
+            model.llama_model.generate(inputs_embeds=inputs_embeds, **kwargs)
+    results[f'eager,new_tokens={max_new_tokens}'] = time_fn(eager, repeat=max(1, args.repeat // 2), warmup=1, items=max_new_tokens)
+    for compile in (False, True):
+        generator = StaticShapeGenerator(model.llama_model, compile=compile)
+
+        def static():
+            generator.static_generate(inputs_embeds, max_new_tokens=max_new_tokens)
+        name = 'static_compiled' if compile else 'static'
+        results[f'{name},new_tokens={max_new_tokens}'] = time_fn(static, repeat=max(1, args.repeat // 2), warmup=2, items=max_new_tokens)
+    return results
+
+
+def bench_entity_matching(args):
+    # the per-name `in` loops EntityMatcher replaced (test_gen.detect_entity, gom_benh.assign_disease) vs one automaton pass
+    # (ahocorasick_rs's when it is installed, the pure Python AhoCorasick otherwise)
+    import gom_benh
+    from entity_matcher import EntityMatcher, normalize
+
+    def previous_normalize(text):
+        # test_gen.normalize: accents stripped, đ kept
+        text = unicodedata.normalize('NFD', text)
+        text = re.sub(r'[\u0300-\u036f]', '', text)
+        return text.lower().strip()
+
+    def previous_detect_entity(question, entity_names):
+        q_norm = previous_normalize(question)
+        best_match = None
+        for name in entity_names:
+            if previous_normalize(name) in q_norm:
+                if best_match is None or len(name) > len(best_match):
+                    best_match = name
+        return best_match
+
+    def previous_assign_disease(passages, disease_list):
+        # first listed disease contained in the lowercased passage
+        groups = defaultdict(list)
+        for p in passages:
+            text = p["text"].lower()
+            matched = None
+            for d in disease_list:
+                if d.lower() in text:
+                    matched = d
+                    break
+            groups[matched if matched else "other"].append(p)
+        return groups
+
+    def loop_longest(text, names):
+        # the matching EntityMatcher implements (đ folded too), as a reference
+        t_norm = normalize(text)
+        matches = [name for name in names if normalize(name) and normalize(name) in t_norm]
+        return max(matches, key=len) if matches else None
+
+    results = {}
+    # questions against thousands of entities
+    entities = make_vi_entities(3000)
+    questions = make_vi_texts(entities, 50, 8)
+    matcher = EntityMatcher(entities)
+    if [loop_longest(t, entities) for t in questions] != [matcher.longest(t) for t in questions]:
+        raise ValueError('EntityMatcher disagrees with the reference loop')
+    case = f'questions,n={len(entities)}'
+    results[f'loop,{case}'] = time_fn(lambda: [previous_detect_entity(t, entities) for t in questions], repeat=max(1, args.repeat // 4), warmup=1, items=len(questions))
+    results[f'automaton,{case}'] = time_fn(lambda: [matcher.longest(t) for t in questions], repeat=args.repeat, items=len(questions))
+    results[f'build,{case}'] = time_fn(lambda: EntityMatcher(entities), repeat=max(1, args.repeat // 4), warmup=1)
+    # passages grouped by a disease list, gom_benh.assign_disease reusing its cached matcher
+    diseases = make_vi_entities(300)
+    passages = [{'text': t} for t in make_vi_texts(diseases, 50, 150)]
+    assigned = {id(p): d for d, ps in gom_benh.assign_disease(passages, diseases).items() for p in ps}
+    if [assigned[id(p)] for p in passages] != [loop_longest(p['text'], diseases) or 'other' for p in passages]:
+        raise ValueError('gom_benh.assign_disease disagrees with the reference loop')
+    case = f'passages,n={len(diseases)}'
+    results[f'loop,{case}'] = time_fn(lambda: previous_assign_disease(passages, diseases), repeat=args.repeat, warmup=1, items=len(passages))
+    results[f'automaton,{case}'] = time_fn(lambda: gom_benh.assign_disease(passages, diseases), repeat=args.repeat, items=len(passages))
+    results[f'build,{case}'] = time_fn(lambda: EntityMatcher(diseases), repeat=max(1, args.repeat // 4), warmup=1)
+    return results
+
+
+BENCHMARKS = {
+    'feature_extraction': bench_feature_extraction,
+    'rformer_forward': bench_rformer_forward,
+    'encode_inputs': bench_encode_inputs,
+    'prompt_build': bench_prompt_build,
+    'tokenization': bench_tokenization,
+    'metrics': bench_metrics,
+    'generate': bench_generate,
+    'generate_static': bench_generate_static,
+    'entity_matching': bench_entity_matching,
+}
+
+
+##### Baseline comparison
+def compare_with_baseline(results, baseline, threshold):
+    regressions = []
+    print(f"{'benchmark':<20} {'case':<22} {'min_ms':>10} {'baseline':>10} {'change':>8}")
+    for name, cases in results.items():
+        for case, stats in cases.items():
+            base = baseline.get(name, {}).get(case)
+            if base is None:
+                print(f"{name:<20} {case:<22} {stats['min_ms']:>10.3f} {'-':>10} {'new':>8}")
+                continue
+            change = stats['min_ms'] / base['min_ms'] - 1 if base['min_ms'] > 0 else 0.0
+            flag = '  REGRESSION' if change > threshold else ''
+            print(f"{name:<20} {case:<22} {stats['min_ms']:>10.3f} {base['min_ms']:>10.3f} {change:>+8.1%}{flag}")
+            if change > threshold:
+                regressions.append((name, case, change))
+    return regressions
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    names = args.only or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError(f'unknown benchmark {name}, choose from {list(BENCHMARKS)}')
+    os.chdir(REPO_ROOT)  # prompt templates are resolved relative to the repo root
+
+    results = {}
+    for name in names:
+        seed_all(42)
+        print(f'##### {name}')
+        results[name] = BENCHMARKS[name](args)
+        for case, stats in results[name].items():
+            print(f"  {case:<22} p50 {stats['p50_ms']:.3f} ms  ({stats['items_per_s']:.1f} items/s)")
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'num_threads': args.num_threads,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    output = args.output or str(REPO_ROOT / 'benchmarks' / 'results' / f"bench_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results_save_path', output)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('baseline_save_path', args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'no baseline at {args.baseline}, run with --save_baseline to create one')
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(results, baseline['results'], args.threshold)
+    if regressions:
+        print(f'{len(regressions)} case(s) regressed by more than {args.threshold:.0%}')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the RRAG hot paths on CPU")
+    parser.add_argument('--only', nargs='+', default=None, help=f'Subset of benchmarks to run: {list(BENCHMARKS)}')
+    parser.add_argument('--repeat', type=int, default=20, help='Timed repetitions per case')
+    parser.add_argument('--num_threads', type=int, default=1, help='torch intra-op threads, fixed for comparable numbers')
+    parser.add_argument('--output', type=str, default=None, help='Path of the results JSON (default: benchmarks/results/bench_<time>.json)')
+    parser.add_argument('--baseline', type=str, default=str(BASELINE_PATH), help='Baseline results JSON to compare against')
+    parser.add_argument('--save_baseline', action='store_true', help='Write these results as the new baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed relative slowdown of the best-of-N latency before a case counts as a regression')
+    args = parser.parse_args()
+    sys.exit(main(args))
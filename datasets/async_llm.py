@@ -0,0 +1,220 @@
+# async_llm.py
+"""Concurrent LLM generation for the synthetic QA scripts (test_gen.py, test_data_generation.py, synthesize.py).
+
+Requests go through an OpenAI-compatible AsyncOpenAI client with
+- at most `concurrency` requests in flight, and a token bucket of `rpm` requests per minute,
+- retries with exponential backoff and full jitter on rate limits, timeouts, connection and 5xx errors,
+- a local JSONL cache keyed by the hash of the request (model, prompt, sampling settings),
+  so a rerun only pays for prompts it has not seen.
+run_jobs() hands the records of every input item to a JSONL writer (resumable.py) as soon as
+they are ready, in input order or in completion order.
+
+Everything can be run offline against the stub server:
+    python datasets/stub_llm_server.py --port 8001
+    python datasets/synthesize.py --base_url http://127.0.0.1:8001/v1
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, Iterable, Optional
+
+import openai
+
+DEFAULT_MODEL = "qwen/qwen-2.5-72b-instruct"
+DEFAULT_BASE_URL = "https://openrouter.ai/api/v1"
+DEFAULT_CACHE = "datasets/llm_cache.jsonl"
+
+def make_client(base_url=None, api_key=None, timeout=120.0):
+    # retries are done by AsyncLLM (with jitter, under the shared rate limit), not by the client
+    return openai.AsyncOpenAI(api_key=api_key or os.getenv("OPENROUTER_API_KEY") or "EMPTY",
+                              base_url=base_url or DEFAULT_BASE_URL, max_retries=0, timeout=timeout)
+
+def add_llm_args(parser):
+    parser.add_argument("--base_url", default=DEFAULT_BASE_URL, help="OpenAI-compatible endpoint, e.g. the stub server http://127.0.0.1:8001/v1")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight")
+    parser.add_argument("--rpm", type=float, default=None, help="Requests per minute (token bucket), default: unlimited")
+    parser.add_argument("--max_retries", type=int, default=5)
+    parser.add_argument("--cache", default=DEFAULT_CACHE, help="Response cache (JSONL), empty string to disable")
+    parser.add_argument("--unordered", action="store_true", help="Write records in completion order instead of input order")
+    return parser
+
+def llm_from_args(args):
+    return AsyncLLM(make_client(args.base_url), args.model, args.concurrency, args.rpm, args.max_retries, cache_path=args.cache or None)
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        # rate: tokens per second; capacity: largest burst
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ResponseCache:
+    # append-only JSONL of {"key", "response"}; a line cut off by a crash is ignored
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.entries = {}
+        self.f = None
+        if not path:
+            return
+        complete = True
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    complete = line.endswith("\n")
+                    try:
+                        e = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[e["key"]] = e["response"]
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.f = open(path, "a", encoding="utf-8")
+        if not complete:
+            self.f.write("\n")
+
+    @staticmethod
+    def key(request: dict) -> str:
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, response):
+        self.entries[key] = response
+        if self.f:
+            self.f.write(json.dumps({"key": key, "response": response}, ensure_ascii=False) + "\n")
+            self.f.flush()
+
+    def close(self):
+        if self.f:
+            self.f.close()
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return isinstance(e, (openai.APIConnectionError, asyncio.TimeoutError))
+
+def retry_delay(e: Exception, attempt: int, backoff: float, max_backoff: float) -> float:
+    # full jitter: uniform in [0, backoff * 2^attempt], at least the server's Retry-After
+    delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+    response = getattr(e, "response", None)
+    try:
+        delay = max(delay, float(response.headers.get("retry-after")))
+    except (AttributeError, TypeError, ValueError):
+        pass
+    return delay
+
+class AsyncLLM:
+    def __init__(self, client, model=DEFAULT_MODEL, concurrency=8, rpm=None, max_retries=5, backoff=1.0, max_backoff=60.0, cache_path=DEFAULT_CACHE):
+        self.client = client
+        self.model = model
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rpm / 60.0, capacity=concurrency) if rpm else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cache = ResponseCache(cache_path)
+        self.stats = {"requests": 0, "cached": 0, "retries": 0, "failed": 0}
+
+    async def complete(self, prompt: str, max_tokens=400, temperature=0.08) -> str:
+        request = {"model": self.model, "messages": [{"role": "user", "content": prompt}], "temperature": temperature, "max_tokens": max_tokens}
+        key = ResponseCache.key(request)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.stats["cached"] += 1
+            return cached
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore:
+                    if self.bucket:
+                        await self.bucket.acquire()
+                    self.stats["requests"] += 1
+                    resp = await self.client.chat.completions.create(**request)
+                text = resp.choices[0].message.content.strip()
+                break
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    self.stats["failed"] += 1
+                    raise
+                self.stats["retries"] += 1
+                # the slot is released while waiting
+                await asyncio.sleep(retry_delay(e, attempt, self.backoff, self.max_backoff))
+        self.cache.put(key, text)
+        return text
+
+    async def aclose(self):
+        self.cache.close()
+        await self.client.close()
+
+async def run_jobs(items: Iterable, process: Callable[..., Awaitable], writer, workers=8, ordered=True, window=None, key: Optional[Callable] = None) -> dict:
+    """Runs `await process(item)` for every item with `workers` concurrent tasks and passes the
+    returned record(s) (a dict, a list of dicts, or None for nothing) to `writer.add(key, records)`
+    (resumable.JSONLWriter or ResumableWriter): in input order when `ordered` (at most `window`
+    finished items wait for a slower earlier one), otherwise as they complete. With `key`
+    (item -> input key), items the writer already has are skipped. An item whose `process`
+    raises is reported and left undone."""
+    window = window or 4 * workers
+    stats = {"items": 0, "skipped": 0, "errors": 0}
+
+    def todo():
+        for item in items:
+            k = key(item) if key else None
+            if k is not None and writer.is_done(k):
+                stats["skipped"] += 1
+                continue
+            yield k, item
+
+    jobs = enumerate(todo())
+    pending = {}
+    next_index = 0
+    cond = asyncio.Condition()
+
+    def write(entry):
+        k, records = entry
+        if records is not None:
+            writer.add(k, records)
+
+    async def worker():
+        nonlocal next_index
+        # the iterator is shared; next() never awaits, so every item goes to one worker
+        for i, (k, item) in jobs:
+            if ordered:
+                async with cond:
+                    await cond.wait_for(lambda: i - next_index < window)
+            try:
+                records = await process(item)
+                records = [] if records is None else records if isinstance(records, list) else [records]
+            except Exception as e:
+                print(f"[Warning] Bỏ qua item {i}: {e!r}")
+                stats["errors"] += 1
+                records = None
+            stats["items"] += 1
+            if not ordered:
+                write((k, records))
+                continue
+            async with cond:
+                pending[i] = (k, records)
+                while next_index in pending:
+                    write(pending.pop(next_index))
+                    next_index += 1
+                cond.notify_all()
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return stats
@@ -1,6 +1,9 @@
 # build_faiss.py
 import json
+import os
 import sys
+import hashlib
+import argparse
 import numpy as np
 import faiss
 from sentence_transformers import SentenceTransformer
@@ -12,11 +15,7 @@ def load_passages(path):
     ids = [p["id"] for p in passages]
     return texts, ids
 
-if __name__ == "__main__":
-    if len(sys.argv) < 4:
-        print("Usage: python datasets/build_faiss.py datasets/passages.jsonl datasets/out_faiss.index datasets/out_id_map.json")
-        sys.exit(1)
-    passages_path = sys.argv[1]
+def load_embedding_model():
     # tải từ HF Hub
     model = SentenceTransformer("AITeamVN/Vietnamese_Embedding_v2")
 
@@ -24,25 +23,133 @@ if __name__ == "__main__":
     model.save("D:/Documents/HuggingFace/Vietnamese_Embedding_v2")
 
     # lần sau chỉ cần load local
-    model = SentenceTransformer("D:/Documents/HuggingFace/Vietnamese_Embedding_v2")
-    out_faiss = sys.argv[2]
-    out_idmap = sys.argv[3]
+    return SentenceTransformer("D:/Documents/HuggingFace/Vietnamese_Embedding_v2")
 
-    texts, ids = load_passages(passages_path)
-    print(f"Loaded {len(texts)} passages")
-    
-    embs = model.encode(texts, batch_size=64, show_progress_bar=True, convert_to_numpy=True)
+def passage_int_id(pid: str) -> int:
+    # stable 63-bit FAISS id of a passage id, the same in full builds and incremental updates
+    return int.from_bytes(hashlib.blake2b(pid.encode("utf-8"), digest_size=8).digest(), "little") & (2**63 - 1)
 
+def source_hash(item: dict) -> str:
+    return hashlib.sha1((item["title"] + "\0" + item["text"]).encode("utf-8")).hexdigest()
+
+def embed(model, texts):
+    embs = model.encode(texts, batch_size=64, show_progress_bar=True, convert_to_numpy=True).astype(np.float32)
     # normalize for cosine (use inner product)
     faiss.normalize_L2(embs)
-    d = embs.shape[1]
-    index = faiss.IndexFlatIP(d)
-    index.add(embs)
-    faiss.write_index(index, out_faiss)
-    print(f"Saved FAISS index to {out_faiss}")
+    return embs
 
-    import json
-    Path(out_idmap).parent.mkdir(parents=True, exist_ok=True)
-    with open(out_idmap, "w", encoding="utf-8") as f:
-        json.dump(ids, f, ensure_ascii=False)
+def write_json_atomic(obj, path):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def write_index_atomic(index, path):
+    tmp_path = f"{path}.tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+def manifest_path(index_path):
+    return f"{index_path}.sources.json"
+
+def build_index(model, passages_path, out_faiss, out_idmap):
+    texts, ids = load_passages(passages_path)
+    print(f"Loaded {len(texts)} passages")
+    embs = embed(model, texts)
+    index = faiss.IndexIDMap2(faiss.IndexFlatIP(embs.shape[1]))
+    int_ids = np.array([passage_int_id(pid) for pid in ids], dtype=np.int64)
+    index.add_with_ids(embs, int_ids)
+    write_index_atomic(index, out_faiss)
+    print(f"Saved FAISS index to {out_faiss}")
+    write_json_atomic({str(i): pid for i, pid in zip(int_ids.tolist(), ids)}, out_idmap)
     print(f"Wrote id map to {out_idmap}")
+
+def update_index(model, source_csv, passages_path, out_faiss, out_idmap, chunking, workers=None):
+    """Re-chunks and re-embeds only the articles of `source_csv` whose content hash changed since the
+    last update (recorded in `<index>.sources.json`), removes the vectors of changed/deleted articles
+    and rewrites the passages file, index, id map and manifest atomically. Without a manifest (or with
+    different chunking settings) every article counts as changed."""
+    # the chunker (and langchain) is only needed in incremental mode
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from csv_to_passages import iter_csv_texts, iter_passages
+
+    manifest = {}
+    if os.path.exists(manifest_path(out_faiss)) and os.path.exists(out_faiss):
+        manifest = json.load(open(manifest_path(out_faiss), "r", encoding="utf-8"))
+    old_hashes = manifest.get("sources", {}) if manifest.get("chunking") == chunking else {}
+
+    hashes, changed_items = {}, []
+    for item in iter_csv_texts(source_csv):
+        hashes[item["source_id"]] = h = source_hash(item)
+        if old_hashes.get(item["source_id"]) != h:
+            changed_items.append(item)
+    changed = {it["source_id"] for it in changed_items}
+    removed = set(old_hashes) - set(hashes)
+    print(f"{len(hashes)} articles: {len(changed)} new or changed, {len(removed)} removed")
+    if not changed and not removed and old_hashes:
+        print("Index is up to date")
+        return
+
+    index, id_map = None, {}
+    if old_hashes:
+        index = faiss.read_index(out_faiss)
+        id_map = json.load(open(out_idmap, "r", encoding="utf-8"))
+        if not isinstance(id_map, dict):
+            raise ValueError(f"{out_faiss} was built without stable ids, rebuild it with --source_csv and no manifest")
+    # stale vectors come from the id map, not the passages file: after an update interrupted once the
+    # passages were replaced, the file no longer lists the old chunks of a changed or removed article
+    outdated = changed | removed
+    stale_ids = [int(i) for i, pid in id_map.items() if pid.rpartition("_p")[0] in outdated]
+
+    # passages of unchanged articles are kept as they are, the others are re-chunked
+    new_texts, new_ids = [], []
+    tmp_passages = f"{passages_path}.tmp"
+    with open(tmp_passages, "w", encoding="utf-8") as fout:
+        if old_hashes and os.path.exists(passages_path):
+            for line in open(passages_path, "r", encoding="utf-8"):
+                if json.loads(line)["meta"]["source_id"] not in outdated:
+                    fout.write(line)
+        for p in iter_passages(changed_items, chunking["chunk_size"], chunking["chunk_overlap"], chunking["tokenizer"], workers):
+            fout.write(json.dumps(p, ensure_ascii=False) + "\n")
+            new_texts.append(p["text"])
+            new_ids.append(p["id"])
+    print(f"{len(stale_ids)} stale passages, {len(new_ids)} new passages")
+
+    new_int_ids = np.array([passage_int_id(pid) for pid in new_ids], dtype=np.int64)
+    embs = embed(model, new_texts) if new_texts else None
+    if index is None:
+        d = embs.shape[1] if embs is not None else model.get_sentence_embedding_dimension()
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(d))
+    # removing the new ids too keeps a rerun after an interrupted update idempotent
+    index.remove_ids(np.array(stale_ids + new_int_ids.tolist(), dtype=np.int64))
+    if embs is not None:
+        index.add_with_ids(embs, new_int_ids)
+    for i in stale_ids:
+        id_map.pop(str(i), None)
+    id_map.update({str(i): pid for i, pid in zip(new_int_ids.tolist(), new_ids)})
+
+    os.replace(tmp_passages, passages_path)
+    write_index_atomic(index, out_faiss)
+    write_json_atomic(id_map, out_idmap)
+    # the manifest goes last: until it is written the next run redoes this update
+    write_json_atomic({"chunking": chunking, "sources": hashes}, manifest_path(out_faiss))
+    print(f"Updated {out_faiss} ({index.ntotal} vectors), {out_idmap} and {passages_path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed passages into a FAISS index with stable ids")
+    parser.add_argument("passages", help="e.g. datasets/passages.jsonl")
+    parser.add_argument("out_faiss", help="e.g. datasets/out_faiss.index")
+    parser.add_argument("out_idmap", help="e.g. datasets/out_id_map.json")
+    parser.add_argument("--source_csv", default=None, help="Incremental mode: articles CSV (e.g. datasets/formatted_posts.csv); only new/changed articles are re-chunked into `passages` and re-embedded")
+    parser.add_argument("--chunk_size", type=int, default=700, help="Incremental mode: chunk size, as in csv_to_passages.py")
+    parser.add_argument("--chunk_overlap", type=int, default=150, help="Incremental mode: chunk overlap, as in csv_to_passages.py")
+    parser.add_argument("--tokenizer", default=None, help="Incremental mode: tokenizer for token-based chunk sizes, as in csv_to_passages.py")
+    parser.add_argument("--workers", type=int, default=None, help="Incremental mode: chunking processes")
+    args = parser.parse_args()
+    model = load_embedding_model()
+    if args.source_csv:
+        chunking = {"chunk_size": args.chunk_size, "chunk_overlap": args.chunk_overlap, "tokenizer": args.tokenizer}
+        update_index(model, args.source_csv, args.passages, args.out_faiss, args.out_idmap, chunking, args.workers)
+    else:
+        build_index(model, args.passages, args.out_faiss, args.out_idmap)
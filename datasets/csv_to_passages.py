@@ -2,48 +2,116 @@
 import csv
 import json
 import os
-from typing import List
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-def load_csv_texts(path: str, title_col="Title", content_col="Content") -> List[dict]:
-    items = []
+def iter_csv_texts(path: str, title_col="Title", content_col="Content") -> Iterator[dict]:
+    # rows are read lazily; source_id is the row index, so ids stay stable across runs
     with open(path, newline='', encoding='utf-8') as f:
         reader = csv.DictReader(f)
         for i,row in enumerate(reader):
-            title = row.get(title_col, "").strip()
-            content = row.get(content_col, "").strip()
+            title = (row.get(title_col) or "").strip()
+            content = (row.get(content_col) or "").strip()
             if not content and not title:
                 continue
             # combine title + content to keep context
             text = (title + "\n\n" + content) if title else content
-            items.append({"source_id": str(i), "title": title, "text": text})
-    return items
+            yield {"source_id": str(i), "title": title, "text": text}
+
+def load_csv_texts(path: str, title_col="Title", content_col="Content") -> List[dict]:
+    return list(iter_csv_texts(path, title_col, content_col))
+
+def make_splitter(chunk_size=700, chunk_overlap=150, tokenizer: Optional[str] = None):
+    # tokenizer: name/path of the embedding model's tokenizer, chunk sizes are then counted in its tokens
+    if tokenizer:
+        from transformers import AutoTokenizer
+        return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            AutoTokenizer.from_pretrained(tokenizer), chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
 
-def chunk_texts(items: List[dict], chunk_size=700, chunk_overlap=150):
-    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+def chunk_item(splitter, it: dict) -> List[dict]:
+    passages = []
+    for idx, c in enumerate(splitter.split_text(it["text"])):
+        pid = f"{it['source_id']}_p{idx}"
+        meta = {"source_id": it["source_id"], "title": it["title"], "chunk_index": idx}
+        passages.append({"id": pid, "text": c, "meta": meta})
+    return passages
+
+def chunk_texts(items: Iterable[dict], chunk_size=700, chunk_overlap=150, tokenizer=None):
+    splitter = make_splitter(chunk_size, chunk_overlap, tokenizer)
     passages = []
     for it in items:
-        chunks = splitter.split_text(it["text"])
-        for idx, c in enumerate(chunks):
-            pid = f"{it['source_id']}_p{idx}"
-            meta = {"source_id": it["source_id"], "title": it["title"], "chunk_index": idx}
-            passages.append({"id": pid, "text": c, "meta": meta})
+        passages.extend(chunk_item(splitter, it))
     return passages
 
-def write_jsonl(passages: List[dict], out_path: str):
+# one splitter per worker process
+_splitter = None
+
+def _init_worker(chunk_size, chunk_overlap, tokenizer):
+    global _splitter
+    _splitter = make_splitter(chunk_size, chunk_overlap, tokenizer)
+
+def _chunk_batch(batch: List[dict]) -> List[dict]:
+    passages = []
+    for it in batch:
+        passages.extend(chunk_item(_splitter, it))
+    return passages
+
+def iter_batches(items: Iterable[dict], batch_size: int) -> Iterator[List[dict]]:
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def iter_passages(items: Iterable[dict], chunk_size=700, chunk_overlap=150, tokenizer=None, workers=None, batch_size=64) -> Iterator[dict]:
+    """Yields the passages of `items` in input order, splitting batches of rows in a process pool.
+
+    At most `2 * workers` batches are in flight, so memory stays bounded however large the CSV is.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        splitter = make_splitter(chunk_size, chunk_overlap, tokenizer)
+        for it in items:
+            yield from chunk_item(splitter, it)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(chunk_size, chunk_overlap, tokenizer)) as executor:
+        pending = deque()
+        for batch in iter_batches(items, batch_size):
+            pending.append(executor.submit(_chunk_batch, batch))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def write_jsonl(passages: Iterable[dict], out_path: str):
+    # written incrementally to a temporary file and renamed at the end, so readers never see a partial file
     os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
-    with open(out_path, "w", encoding="utf-8") as f:
+    tmp_path = out_path + ".tmp"
+    n = 0
+    with open(tmp_path, "w", encoding="utf-8") as f:
         for p in passages:
             f.write(json.dumps(p, ensure_ascii=False) + "\n")
-    print(f"Wrote {len(passages)} passages to {out_path}")
+            n += 1
+    os.replace(tmp_path, out_path)
+    print(f"Wrote {n} passages to {out_path}")
+    return n
 
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) < 3:
-        print("Usage: python datasets/csv_to_passages.py datasets/formatted_posts.csv datasets/data/passages.jsonl")
-        sys.exit(1)
-    in_csv = sys.argv[1]
-    out_jsonl = sys.argv[2]
-    items = load_csv_texts(in_csv)
-    passages = chunk_texts(items, chunk_size=700, chunk_overlap=150)
-    write_jsonl(passages, out_jsonl)
+    parser = argparse.ArgumentParser(description="Split the posts CSV into passages (JSONL with ids {source_id}_p{idx})")
+    parser.add_argument("in_csv", help="e.g. datasets/formatted_posts.csv")
+    parser.add_argument("out_jsonl", help="e.g. datasets/data/passages.jsonl")
+    parser.add_argument("--chunk_size", type=int, default=700, help="Chunk size in characters, or in tokens with --tokenizer")
+    parser.add_argument("--chunk_overlap", type=int, default=150, help="Chunk overlap in characters, or in tokens with --tokenizer")
+    parser.add_argument("--tokenizer", default=None, help="Embedding model (e.g. AITeamVN/Vietnamese_Embedding_v2) whose tokenizer measures chunk sizes")
+    parser.add_argument("--workers", type=int, default=None, help="Splitter processes (default: all CPUs, 1: no pool)")
+    parser.add_argument("--batch_size", type=int, default=64, help="Rows per task sent to a worker")
+    args = parser.parse_args()
+    items = iter_csv_texts(args.in_csv)
+    passages = iter_passages(items, args.chunk_size, args.chunk_overlap, args.tokenizer, args.workers, args.batch_size)
+    write_jsonl(passages, args.out_jsonl)
@@ -0,0 +1,168 @@
+# dedup_qas.py
+"""Streaming dedup of QA JSONL files (qas_synthetic_vi.jsonl, synthetic_qas.jsonl, ...).
+
+Records are read one line at a time and written straight to the cleaned output, so the file
+can be larger than RAM; only 64-bit hashes of the keys seen so far are kept in memory.
+- exact: the key fields as they are
+- normalized: lowercased, accents removed (đ -> d), punctuation and extra spaces dropped
+- near (optional): MinHash of character shingles with LSH banding; a record is a near-duplicate
+  of a kept one if their estimated Jaccard similarity is >= threshold
+  (keeps one signature of num_perm uint32 per kept record)
+Records without one of the key fields, or whose key fields are all empty, have no key: they are
+kept and counted as "unkeyed", never treated as duplicates of each other.
+
+    python datasets/dedup_qas.py datasets/qas_synthetic_vi.jsonl datasets/qas_synthetic_vi.dedup.jsonl --near --report dups.jsonl
+"""
+import os
+import re
+import json
+import zlib
+import hashlib
+import argparse
+from typing import Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+from entity_matcher import normalize as strip_accents
+
+def hash64(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+def normalize_text(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", strip_accents(text)).split())
+
+def record_key(record: dict, fields: Sequence[str]) -> Optional[str]:
+    # None when a key field is missing or all of them are empty: such records are never duplicates
+    if any(f not in record for f in fields) or all(record[f] in ("", None) for f in fields):
+        return None
+    return "\x1f".join(str(record[f]) for f in fields)
+
+def iter_jsonl(path: str) -> Iterator[Tuple[int, str, dict]]:
+    # (line number, raw line, record); blank lines are skipped
+    with open(path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if line.strip():
+                yield i, line, json.loads(line)
+
+##### MinHash LSH
+class MinHashLSH:
+    def __init__(self, num_perm=128, bands=32, threshold=0.8, shingle=4, seed=1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        rng = np.random.RandomState(seed)
+        # h(x) = (a * x + b) mod p over 32-bit shingle hashes, p > 2^32 so nothing overflows uint64
+        self.prime = np.uint64(4294967311)
+        self.a = rng.randint(1, 2**32 - 1, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 2**32 - 1, size=num_perm, dtype=np.uint64)
+        self.bands, self.rows = bands, num_perm // bands
+        self.threshold = threshold
+        self.shingle = shingle
+        self.buckets = [dict() for _ in range(bands)]  # band bytes -> ids of kept records
+        self.signatures = np.zeros((1024, num_perm), dtype=np.uint32)  # row i: kept record i, grown by doubling
+        self.size = 0
+
+    def signature(self, text: str) -> np.ndarray:
+        k = self.shingle
+        shingles = {text[i:i + k] for i in range(max(1, len(text) - k + 1))}
+        x = np.array([zlib.crc32(s.encode("utf-8")) for s in shingles], dtype=np.uint64)
+        return ((self.a[:, None] * x[None, :] + self.b[:, None]) % self.prime).min(axis=1).astype(np.uint32)
+
+    def query(self, sig: np.ndarray) -> Optional[int]:
+        # id of a kept record similar to sig, or None
+        candidates = set()
+        for band, bucket in enumerate(self.buckets):
+            candidates.update(bucket.get(sig[band * self.rows:(band + 1) * self.rows].tobytes(), ()))
+        if not candidates:
+            return None
+        candidates = np.array(sorted(candidates))
+        # estimated Jaccard similarity with every candidate at once; the most similar one (earliest on ties)
+        sims = (self.signatures[candidates] == sig).mean(axis=1)
+        best = int(np.argmax(sims))
+        return int(candidates[best]) if sims[best] >= self.threshold else None
+
+    def add(self, sig: np.ndarray) -> int:
+        idx = self.size
+        if idx == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.zeros_like(self.signatures)])
+        self.signatures[idx] = sig
+        self.size += 1
+        for band, bucket in enumerate(self.buckets):
+            bucket.setdefault(sig[band * self.rows:(band + 1) * self.rows].tobytes(), []).append(idx)
+        return idx
+
+##### Streaming dedup
+class Deduper:
+    """Decides for each key whether it was seen before: check() returns None for a new key,
+    else (kind, line of the kept record)."""
+    def __init__(self, normalized=True, near=False, threshold=0.8, num_perm=128, bands=32):
+        self.exact = {}  # hash64 -> line of the kept record
+        self.normalized = {} if normalized else None
+        self.lsh = MinHashLSH(num_perm, bands, threshold) if near else None
+        self.lsh_lines = []
+
+    def check(self, key: str, line_no: int):
+        h = hash64(key)
+        if h in self.exact:
+            return "exact", self.exact[h]
+        norm = normalize_text(key) if self.normalized is not None or self.lsh else None
+        if not norm:
+            norm = None  # only punctuation / spaces: compared exactly only
+        hn = hash64(norm) if self.normalized is not None and norm is not None else None
+        if hn is not None and hn in self.normalized:
+            self.exact[h] = self.normalized[hn]
+            return "normalized", self.normalized[hn]
+        sig = None
+        if self.lsh and norm is not None:
+            sig = self.lsh.signature(norm)
+            c = self.lsh.query(sig)
+            if c is not None:
+                return "near", self.lsh_lines[c]
+        self.exact[h] = line_no
+        if hn is not None:
+            self.normalized[hn] = line_no
+        if sig is not None:
+            self.lsh.add(sig)
+            self.lsh_lines.append(line_no)
+        return None
+
+def dedup_file(in_path: str, out_path: str, fields: Sequence[str] = ("question",), normalized=True, near=False,
+               threshold=0.8, num_perm=128, bands=32, report_path: Optional[str] = None) -> dict:
+    deduper = Deduper(normalized, near, threshold, num_perm, bands)
+    stats = {"records": 0, "kept": 0, "unkeyed": 0, "exact": 0, "normalized": 0, "near": 0}
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp_path = out_path + ".tmp"
+    report = open(report_path, "w", encoding="utf-8") if report_path else None
+    with open(tmp_path, "w", encoding="utf-8") as fout:
+        for line_no, line, record in iter_jsonl(in_path):
+            stats["records"] += 1
+            key = record_key(record, fields)
+            dup = deduper.check(key, line_no) if key is not None else None
+            if dup is None:
+                fout.write(line if line.endswith("\n") else line + "\n")
+                stats["kept"] += 1
+                stats["unkeyed"] += key is None
+                continue
+            kind, kept_line = dup
+            stats[kind] += 1
+            if report:
+                report.write(json.dumps({"line": line_no, "duplicate_of": kept_line, "kind": kind, "key": key}, ensure_ascii=False) + "\n")
+    if report:
+        report.close()
+    os.replace(tmp_path, out_path)
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streaming exact / normalized / MinHash near-duplicate removal for QA JSONL files")
+    parser.add_argument("in_jsonl")
+    parser.add_argument("out_jsonl")
+    parser.add_argument("--fields", nargs="+", default=["question"], help="Record fields forming the dedup key")
+    parser.add_argument("--exact_only", action="store_true", help="Only drop exact duplicates (no accent/case/punctuation normalization)")
+    parser.add_argument("--near", action="store_true", help="Also drop near-duplicates (MinHash LSH)")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Estimated Jaccard similarity of a near-duplicate")
+    parser.add_argument("--num_perm", type=int, default=128)
+    parser.add_argument("--bands", type=int, default=32, help="LSH bands; more bands find pairs of lower similarity")
+    parser.add_argument("--report", default=None, help="JSONL of dropped lines and the line they duplicate")
+    args = parser.parse_args()
+    stats = dedup_file(args.in_jsonl, args.out_jsonl, args.fields, not args.exact_only, args.near, args.threshold, args.num_perm, args.bands, args.report)
+    print(f"{stats['kept']}/{stats['records']} records kept -> {args.out_jsonl} "
+          f"({stats['unkeyed']} without a key field or with an empty key, kept as they are; dropped {stats['exact']} exact, {stats['normalized']} normalized, {stats['near']} near duplicates)")
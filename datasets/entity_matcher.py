@@ -0,0 +1,155 @@
+# entity_matcher.py
+"""Multi-pattern substring matching (Aho-Corasick) over entity names.
+
+The automaton is built once over all patterns; a single pass over a text then reports
+every pattern occurring in it, instead of one `pattern in text` test per pattern.
+EntityMatcher adds accent-insensitive matching of Vietnamese entity names on top, with
+ahocorasick_rs's compiled automata when it is installed (pip install ahocorasick-rs).
+"""
+import re
+import codecs
+import unicodedata
+from collections import deque
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+_HAS_AHOCORASICK_RS=True
+try:
+    import ahocorasick_rs
+except Exception:
+    _HAS_AHOCORASICK_RS=False
+
+class AhoCorasick:
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.fail = [0]
+        # out[node]: indices of the patterns ending at node, including those of its suffixes
+        self.out = [[]]
+        for i, p in enumerate(self.patterns):
+            node = 0
+            for ch in p:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append(i)
+        # failure links, breadth first so a node's suffix is done before the node
+        queue = deque(self.goto[0].values())
+        for node in queue:
+            self.out[node] = self.out[node] + self.out[0]
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+                queue.append(nxt)
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int]]:
+        # (end position, pattern index) of every occurrence; the match is text[end - len(pattern):end]
+        for i in self.out[0]:
+            yield 0, i
+        node = 0
+        for pos, ch in enumerate(text, 1):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for i in self.out[node]:
+                yield pos, i
+
+    def find(self, text: str) -> Set[int]:
+        # indices of the patterns occurring in text, i.e. {i for i, p in enumerate(patterns) if p in text}
+        return {i for _, i in self.iter_matches(text)}
+
+# --- Bỏ dấu tiếng Việt (kể cả đ -> d) để match không dấu ---
+def _strip_accents(text: str) -> str:
+    text = unicodedata.normalize('NFD', text)
+    text = re.sub(r'[\u0300-\u036f]', '', text)
+    return text.replace('đ', 'd').replace('Đ', 'D').lower()
+
+def normalize(text: str) -> str:
+    return _strip_accents(text).strip()
+
+# --- fold(): như normalize nhưng nhanh, cho việc tìm các key ASCII ---
+# Văn bản (đã lower) được encode bằng một charmap codec, mỗi ký tự -> một byte, rồi bytes.translate
+# đổi mỗi byte thành ký tự đã bỏ dấu; ký tự ngoài bảng đi qua error handler (chậm hơn, cùng kết quả).
+# Ký tự không phải ASCII còn lại sau khi bỏ dấu thành "\0", nên một key ASCII không chứa "\0"
+# xuất hiện trong fold(text) khi và chỉ khi nó xuất hiện trong normalize(text).
+def _fold_char(ch: str) -> str:
+    return ''.join(c if c.isascii() else '\0' for c in _strip_accents(ch))
+
+# chữ tiếng Việt thường, dấu tổ hợp tiếng Việt (văn bản dạng NFD), chữ Latin-1 thường, dấu câu hay gặp
+_FOLD_CHARS = [ch for ch in dict.fromkeys(
+    'àáảãạăằắẳẵặâầấẩẫậèéẻẽẹêềếểễệìíỉĩịòóỏõọôồốổỗộơờớởỡợùúủũụưừứửữựỳýỷỹỵđ'
+    '\u0300\u0301\u0302\u0303\u0306\u0309\u031b\u0323'
+    + ''.join(map(chr, range(0xdf, 0x100))) + '\xa0–—…“”‘’«»°·•'
+) if len(_fold_char(ch)) <= 1][:128]
+# byte -> ký tự; các byte thừa lấy ký tự Private Use, cũng thành "\0"
+_FOLD_DECODING = ''.join(map(chr, range(128))) + ''.join(_FOLD_CHARS) + ''.join(chr(0xe000 + i) for i in range(128 - len(_FOLD_CHARS)))
+_FOLD_MAP = codecs.charmap_build(_FOLD_DECODING)
+_FOLD_TABLE = bytes(ord(_fold_char(ch) or '\0') for ch in _FOLD_DECODING)
+_FOLD_DELETE = bytes(b for b, ch in enumerate(_FOLD_DECODING) if not _fold_char(ch))
+
+def _fold_error(exc):
+    return ''.join(map(_fold_char, exc.object[exc.start:exc.end])), exc.end
+
+codecs.register_error('entity_matcher.fold', _fold_error)
+
+def fold(text: str) -> str:
+    text = text.lower()
+    if text.isascii():
+        return text
+    return codecs.charmap_encode(text, 'entity_matcher.fold', _FOLD_MAP)[0].translate(_FOLD_TABLE, _FOLD_DELETE).decode('ascii')
+
+class EntityMatcher:
+    """Accent-insensitive matcher over a fixed list of entity names: the automata are
+    built once over the normalized names and a lookup is one pass over the text per automaton.
+
+    With ahocorasick_rs the names, ranked longest first, are split into `tiers` automata and
+    longest() stops at the first tier with a match, so the many short names occurring in a
+    long text are only collected when no longer name does. The pure Python fallback keeps a
+    single automaton, as there a pass costs far more than the matches it reports."""
+    def __init__(self, names: Iterable[str], tiers=4):
+        self.names = list(names)
+        # distinct normalized names, ranked by their best name (the longest, the first in list
+        # order on ties); names that normalize to "" would match every text
+        groups = {}
+        for i in sorted(range(len(self.names)), key=lambda i: (-len(self.names[i]), i)):
+            key = normalize(self.names[i])
+            if key:
+                groups.setdefault(key, []).append(i)
+        self.keys = list(groups)
+        self.members = list(groups.values())
+        self.fold = fold if all(k.isascii() and '\0' not in k for k in self.keys) else normalize
+        if _HAS_AHOCORASICK_RS:
+            bounds = sorted({len(self.keys) * t // tiers for t in range(tiers + 1)})
+            self.automata = [(start, ahocorasick_rs.AhoCorasick(self.keys[start:end])) for start, end in zip(bounds, bounds[1:])]
+        else:
+            self.automata = [(0, AhoCorasick(self.keys))] if self.keys else []
+
+    def ranks(self, start: int, automaton, text: str) -> List[int]:
+        # indices in self.keys of the keys of one automaton occurring in the folded text
+        if _HAS_AHOCORASICK_RS:
+            return [start + j for j, _, _ in automaton.find_matches_as_indexes(text, overlapping=True)]
+        return [start + j for _, j in automaton.iter_matches(text)]
+
+    def find_all(self, text: str) -> List[str]:
+        # every name occurring in text, in list order
+        text = self.fold(text)
+        found = {j for start, automaton in self.automata for j in self.ranks(start, automaton, text)}
+        return [self.names[i] for i in sorted(i for j in found for i in self.members[j])]
+
+    def longest(self, text: str) -> Optional[str]:
+        # the longest name occurring in text (the first in list order on ties), or None
+        text = self.fold(text)
+        for start, automaton in self.automata:
+            ranks = self.ranks(start, automaton, text)
+            if ranks:
+                return self.names[self.members[min(ranks)][0]]
+        return None
@@ -5,18 +5,20 @@ from sentence_transformers import SentenceTransformer
 import numpy as np
 from sklearn.metrics import recall_score
 import torch
+from passage_store import open_passage_store
 
 model = SentenceTransformer("AITeamVN/Vietnamese_Embedding_v2")
 
 def load_id_map(idmap_path):
-    return json.load(open(idmap_path, "r", encoding="utf-8"))
+    # FAISS id -> passage id; a list maps row positions (indexes built before stable ids)
+    id_map = json.load(open(idmap_path, "r", encoding="utf-8"))
+    if isinstance(id_map, list):
+        return dict(enumerate(id_map))
+    return {int(k): v for k, v in id_map.items()}
 
 def load_passages(passages_jsonl):
-    data = {}
-    for line in open(passages_jsonl,"r",encoding="utf-8"):
-        j = json.loads(line)
-        data[j["id"]] = j
-    return data
+    # id -> passage record, memory-mapped (see passage_store.py)
+    return open_passage_store(passages_jsonl)
 
 if __name__ == "__main__":
     if len(sys.argv)<6:
@@ -1,13 +1,20 @@
+from functools import lru_cache
 from collections import defaultdict
-def assign_disease(passages, disease_list):
+from entity_matcher import EntityMatcher
+
+@lru_cache(maxsize=8)
+def disease_matcher(diseases):
+    # matcher của một danh sách bệnh (tuple), dựng một lần rồi dùng lại giữa các lần gọi
+    return EntityMatcher(diseases)
+
+def assign_disease(passages, disease_list, matcher=None):
+    # bệnh dài nhất xuất hiện trong passage (match không dấu), một lượt automaton cho mỗi passage;
+    # matcher: EntityMatcher dựng sẵn trên disease_list, mặc định lấy từ cache
+    if matcher is None:
+        matcher = disease_matcher(tuple(disease_list))
     groups = defaultdict(list)
     for p in passages:
-        text = p["text"].lower()
-        matched = None
-        for d in disease_list:
-            if d.lower() in text:
-                matched = d
-                break
+        matched = matcher.longest(p["text"])
         key = matched if matched else "other"
         groups[key].append(p)
     return groups
@@ -1,6 +1,7 @@
 import re
 import pandas as pd
 from collections import defaultdict
+from entity_matcher import AhoCorasick
 
 # -----------------------------
 # 1. Load article_id data
@@ -37,6 +38,27 @@ for line in neo4j_lines:
 # -----------------------------
 # 4. Map article_id cho entity_name theo substring match
 # -----------------------------
+# entity_name -> các root_name chứa nó (theo thứ tự của mapping), một lượt automaton cho mỗi root_name
+entity_names = list(all_entity_names)
+entity_matcher = AhoCorasick(entity_names)
+entity_roots = defaultdict(list)
+for root_name in mapping:
+    for i in entity_matcher.find(root_name):
+        entity_roots[entity_names[i]].append(root_name)
+
+# root_name -> article_id của các chunk có root_name chứa nó (theo thứ tự dòng của chunk_data.csv)
+root_names = list(mapping)
+root_matcher = AhoCorasick(root_names)
+root_article_ids = defaultdict(list)
+chunk_matches = {}
+for chunk_root, article_id in zip(articles_df['root_name'].tolist(), articles_df['article_id'].tolist()):
+    if not isinstance(chunk_root, str):
+        continue
+    if chunk_root not in chunk_matches:
+        chunk_matches[chunk_root] = root_matcher.find(chunk_root)
+    for i in chunk_matches[chunk_root]:
+        root_article_ids[root_names[i]].append(article_id)
+
 final_map = []
 
 for entity_name in all_entity_names:
@@ -44,17 +66,15 @@ for entity_name in all_entity_names:
     article_ids = set()
     entity_type = None
 
-    for root_name, layer_targets in mapping.items():
-        if entity_name in root_name:  # substring match
-            # gộp các target của các layer
-            for layer, targets in layer_targets.items():
-                layers_dict[layer].extend(targets)
-            # gán article_id nếu root_name chứa entity_name
-            ids = articles_df.loc[articles_df['root_name'].str.contains(re.escape(root_name)), 'article_id'].tolist()
-            article_ids.update(ids)
-            # lấy entity_type từ root_name (giữ lần đầu match)
-            if not entity_type:
-                entity_type = entity_types[root_name]
+    for root_name in entity_roots[entity_name]:
+        # gộp các target của các layer
+        for layer, targets in mapping[root_name].items():
+            layers_dict[layer].extend(targets)
+        # gán article_id nếu root_name chứa entity_name
+        article_ids.update(root_article_ids[root_name])
+        # lấy entity_type từ root_name (giữ lần đầu match)
+        if not entity_type:
+            entity_type = entity_types[root_name]
 
     # Gộp target names mỗi layer thành string
     layer_data = {layer: "; ".join(targets) for layer, targets in layers_dict.items()}
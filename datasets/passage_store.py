@@ -0,0 +1,225 @@
+# passage_store.py
+"""Compact, memory-mapped passage store built once from passages.jsonl.
+
+Layout of the store directory (default: passages.jsonl -> passages.store/):
+- texts.bin / titles.bin / ids.bin: concatenated UTF-8 strings, with
+  text_offsets.npy / title_offsets.npy / id_offsets.npy (int64, n + 1 entries)
+- chunk_index.npy, source_group.npy: per-row chunk index and source group
+- id_table.npy / id_hashes.npy: open-addressing hash table id -> row
+- source_*: the same for source_id -> group, with group_offsets.npy / group_rows.npy
+  listing the rows of every source in chunk order
+- meta.json: row count and the size / mtime of the passages.jsonl it was built from
+
+Everything is opened with mmap, so startup does not parse the corpus and lookups by
+passage id or source id are O(1) and only touch the bytes they return.
+"""
+import os
+import sys
+import json
+import mmap
+import hashlib
+import numpy as np
+
+def key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+def default_store_dir(passages_path):
+    return os.path.splitext(passages_path)[0] + ".store"
+
+def source_signature(passages_path):
+    st = os.stat(passages_path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+class StringWriter:
+    def __init__(self, path):
+        self.f = open(path, "wb")
+        self.offsets = [0]
+
+    def add(self, s):
+        data = s.encode("utf-8")
+        self.f.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def close(self, offsets_path):
+        self.f.close()
+        np.save(offsets_path, np.array(self.offsets, dtype=np.int64))
+
+def build_hash_table(keys):
+    # slots hold row + 1 (0 = empty); the table is at most half full
+    hashes = np.array([key_hash(k) for k in keys], dtype=np.uint64)
+    size = 1 << max(1, (2 * len(keys) - 1).bit_length())
+    table = [0] * size
+    mask = size - 1
+    for row, h in enumerate(hashes.tolist()):
+        slot = h & mask
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = row + 1
+    return np.array(table, dtype=np.int64), hashes
+
+def build_store(passages_path, store_dir=None):
+    store_dir = store_dir or default_store_dir(passages_path)
+    os.makedirs(store_dir, exist_ok=True)
+    if os.path.exists(os.path.join(store_dir, "meta.json")):
+        os.remove(os.path.join(store_dir, "meta.json"))
+    signature = source_signature(passages_path)
+    texts = StringWriter(os.path.join(store_dir, "texts.bin"))
+    titles = StringWriter(os.path.join(store_dir, "titles.bin"))
+    ids = StringWriter(os.path.join(store_dir, "ids.bin"))
+    sources = StringWriter(os.path.join(store_dir, "sources.bin"))
+    id_keys, chunk_index, source_group, group_rows, source_keys = [], [], [], {}, {}
+    with open(passages_path, "r", encoding="utf-8") as f:
+        for row, line in enumerate(f):
+            p = json.loads(line)
+            meta = p.get("meta", {})
+            texts.add(p["text"])
+            titles.add(meta.get("title", ""))
+            ids.add(p["id"])
+            id_keys.append(p["id"])
+            chunk_index.append(meta.get("chunk_index", 0))
+            sid = str(meta.get("source_id", ""))
+            if sid not in source_keys:
+                source_keys[sid] = len(source_keys)
+                sources.add(sid)
+                group_rows[sid] = []
+            source_group.append(source_keys[sid])
+            group_rows[sid].append(row)
+    for w, name in [(texts, "text"), (titles, "title"), (ids, "id"), (sources, "source")]:
+        w.close(os.path.join(store_dir, f"{name}_offsets.npy"))
+    np.save(os.path.join(store_dir, "chunk_index.npy"), np.array(chunk_index, dtype=np.int32))
+    np.save(os.path.join(store_dir, "source_group.npy"), np.array(source_group, dtype=np.int64))
+    # rows of every source, ordered by chunk index
+    rows = [sorted(group_rows[sid], key=lambda r: chunk_index[r]) for sid in source_keys]
+    np.save(os.path.join(store_dir, "group_offsets.npy"), np.cumsum([0] + [len(r) for r in rows]).astype(np.int64))
+    np.save(os.path.join(store_dir, "group_rows.npy"), np.array([r for g in rows for r in g], dtype=np.int64))
+    for name, keys in [("id", id_keys), ("source", list(source_keys))]:
+        table, hashes = build_hash_table(keys)
+        np.save(os.path.join(store_dir, f"{name}_table.npy"), table)
+        np.save(os.path.join(store_dir, f"{name}_hashes.npy"), hashes)
+    if len(set(id_keys)) != len(id_keys):
+        print(f"[Warning] {passages_path} has duplicate passage ids, lookups return the first one")
+    # meta.json last: a store without it is incomplete and gets rebuilt
+    with open(os.path.join(store_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"count": len(id_keys), "source": signature}, f)
+    print(f"Built passage store {store_dir} ({len(id_keys)} passages, {len(source_keys)} sources)")
+    return store_dir
+
+class Strings:
+    # memory-mapped concatenated UTF-8 strings
+    def __init__(self, store_dir, name, bin_name):
+        path = os.path.join(store_dir, bin_name)
+        self.offsets = np.load(os.path.join(store_dir, f"{name}_offsets.npy"), mmap_mode="r")
+        self.f = open(path, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+
+    def raw(self, i):
+        return self.mm[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def __getitem__(self, i):
+        return self.raw(i).decode("utf-8")
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.f.close()
+
+class HashIndex:
+    def __init__(self, store_dir, name, strings):
+        self.table = np.load(os.path.join(store_dir, f"{name}_table.npy"), mmap_mode="r")
+        self.hashes = np.load(os.path.join(store_dir, f"{name}_hashes.npy"), mmap_mode="r")
+        self.strings = strings
+        self.mask = len(self.table) - 1
+
+    def find(self, key):
+        # row of `key`, or -1
+        h = key_hash(key)
+        data = key.encode("utf-8")
+        slot = h & self.mask
+        while True:
+            row = int(self.table[slot]) - 1
+            if row < 0:
+                return -1
+            if int(self.hashes[row]) == h and self.strings.raw(row) == data:
+                return row
+            slot = (slot + 1) & self.mask
+
+class PassageStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.texts = Strings(store_dir, "text", "texts.bin")
+        self.titles = Strings(store_dir, "title", "titles.bin")
+        self.ids = Strings(store_dir, "id", "ids.bin")
+        self.sources = Strings(store_dir, "source", "sources.bin")
+        self.chunk_index = np.load(os.path.join(store_dir, "chunk_index.npy"), mmap_mode="r")
+        self.source_group = np.load(os.path.join(store_dir, "source_group.npy"), mmap_mode="r")
+        self.group_offsets = np.load(os.path.join(store_dir, "group_offsets.npy"), mmap_mode="r")
+        self.group_rows = np.load(os.path.join(store_dir, "group_rows.npy"), mmap_mode="r")
+        self.id_index = HashIndex(store_dir, "id", self.ids)
+        self.source_index = HashIndex(store_dir, "source", self.sources)
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def __contains__(self, pid):
+        return self.id_index.find(pid) >= 0
+
+    def row(self, i):
+        # the passages.jsonl record of row i
+        return {
+            "id": self.ids[i],
+            "text": self.texts[i],
+            "meta": {"source_id": self.sources[int(self.source_group[i])], "title": self.titles[i], "chunk_index": int(self.chunk_index[i])},
+        }
+
+    def __getitem__(self, pid):
+        i = self.id_index.find(pid)
+        if i < 0:
+            raise KeyError(pid)
+        return self.row(i)
+
+    def get(self, pid, default=None):
+        i = self.id_index.find(pid)
+        return self.row(i) if i >= 0 else default
+
+    def text(self, pid, default=None):
+        i = self.id_index.find(pid)
+        return self.texts[i] if i >= 0 else default
+
+    def by_source(self, source_id):
+        # passages of one source (article), in chunk order
+        g = self.source_index.find(str(source_id))
+        if g < 0:
+            return []
+        rows = self.group_rows[int(self.group_offsets[g]):int(self.group_offsets[g + 1])]
+        return [self.row(int(i)) for i in rows]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def close(self):
+        for s in (self.texts, self.titles, self.ids, self.sources):
+            s.close()
+
+def is_stale(passages_path, store_dir):
+    meta_path = os.path.join(store_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return True
+    with open(meta_path, "r", encoding="utf-8") as f:
+        return json.load(f).get("source") != source_signature(passages_path)
+
+def open_passage_store(passages_path, store_dir=None):
+    """Opens the store of `passages_path`, (re)building it first if it is missing or
+    older than the JSONL (e.g. after build_faiss.py --source_csv rewrote it)."""
+    store_dir = store_dir or default_store_dir(passages_path)
+    if is_stale(passages_path, store_dir):
+        build_store(passages_path, store_dir)
+    return PassageStore(store_dir)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python datasets/passage_store.py datasets/passages.jsonl [datasets/passages.store]")
+        sys.exit(1)
+    build_store(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
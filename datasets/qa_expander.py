@@ -0,0 +1,191 @@
+# qa_expander.py
+"""Lazy expansion of the synthetic query space of qna_generation.py.
+
+The space is a list of blocks. A block crosses its fillers (the values of `field` in the
+templates) with its parts, and a part crosses its contexts ({ctx}, or none) with its
+(template, labels) items:
+    for filler in block.fillers: for part in block.parts: for ctx in part.ctxs: for tpl, labels in part.items
+- expand() yields the rows (text, labels, has_ctx) one at a time in that order
+- sample() draws rows at random without replacement, weighted by label set, decoding each
+  drawn position into its row instead of enumerating the cross product
+- unique() drops repeated rows on the fly, keeping only a 64-bit hash per row
+- ShardedWriter writes the rows as JSONL or Parquet, optionally in shards of a fixed size
+
+    python datasets/qna_generation.py --sample 20000 --weights disease=2 --shard_size 5000 --format parquet
+"""
+import os
+import json
+import random
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from dedup_qas import hash64
+
+_HAS_PA=True
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except Exception:
+    _HAS_PA=False
+
+Row = Tuple[str, List[str], int]
+
+class Part(NamedTuple):
+    items: Sequence[Tuple[str, List[str]]]  # (template, labels)
+    has_ctx: int = 0
+    ctxs: Sequence[Optional[str]] = (None,)
+
+class Block(NamedTuple):
+    field: str  # placeholder the fillers go into, "main" or "x"
+    fillers: Sequence[str]
+    parts: Sequence[Part]
+
+def label_key(labels: Sequence[str]) -> str:
+    return "|".join(sorted(labels))
+
+def row_key(row: Row) -> int:
+    text, labels, has_ctx = row
+    return hash64(f"{text.lower()}\x1f{label_key(labels)}\x1f{has_ctx}")
+
+def render(block: Block, filler: str, part: Part, ctx: Optional[str], item: Tuple[str, List[str]]) -> Row:
+    tpl, labels = item
+    return tpl.format(**{block.field: filler, "ctx": ctx}), labels, part.has_ctx
+
+def space_size(blocks: Sequence[Block]) -> int:
+    return sum(len(b.fillers) * len(p.ctxs) * len(p.items) for b in blocks for p in b.parts)
+
+##### Expansion
+def expand(blocks: Iterable[Block]) -> Iterator[Row]:
+    for block in blocks:
+        for filler in block.fillers:
+            for part in block.parts:
+                for ctx in part.ctxs:
+                    for item in part.items:
+                        yield render(block, filler, part, ctx, item)
+
+def unique(rows: Iterable[Row]) -> Iterator[Row]:
+    # first occurrence of every (lowercased text, label set, has_ctx)
+    seen = set()
+    for row in rows:
+        h = row_key(row)
+        if h not in seen:
+            seen.add(h)
+            yield row
+
+def sample(blocks: Sequence[Block], weights: Optional[Dict[str, float]] = None, seed=0) -> Iterator[Row]:
+    """Rows of the space in random order, without replacement, until it is exhausted.
+
+    A row of label set L is drawn with probability proportional to weights.get(L, 1.0) (L as in
+    label_key, e.g. "cause|symptom"); rows of weight 0 are never drawn. The space is split into
+    units, one per (block, part, item), each a grid of fillers x contexts: a draw picks a unit
+    by weight x rows left, then an unused cell of it with a sparse Fisher-Yates shuffle, so
+    memory grows with the rows drawn, not with the size of the space."""
+    weights = weights or {}
+    rng = random.Random(seed)
+    units, unit_weights, left = [], [], []
+    for block in blocks:
+        for part in block.parts:
+            for item in part.items:
+                w = float(weights.get(label_key(item[1]), 1.0))
+                if w < 0:
+                    raise ValueError(f"Negative weight {w} for labels {label_key(item[1])}")
+                size = len(block.fillers) * len(part.ctxs)
+                if w > 0 and size > 0:
+                    units.append((block, part, item, {}))
+                    unit_weights.append(w)
+                    left.append(size)
+    if not units:
+        return
+    current = [w * n for w, n in zip(unit_weights, left)]
+    order = range(len(units))
+    total = sum(left)
+    while total:
+        u = rng.choices(order, weights=current)[0]
+        block, part, item, swapped = units[u]
+        # swap the drawn cell with the last unused one, only the moved cells are stored
+        j = rng.randrange(left[u])
+        left[u] -= 1
+        cell = swapped.get(j, j)
+        swapped[j] = swapped.pop(left[u], left[u])
+        current[u] = unit_weights[u] * left[u]
+        total -= 1
+        filler, ctx = divmod(cell, len(part.ctxs))
+        yield render(block, block.fillers[filler], part, part.ctxs[ctx], item)
+
+##### Writing
+def shard_path(path: str, index: int) -> str:
+    stem, ext = os.path.splitext(path)
+    return f"{stem}-{index:05d}{ext}"
+
+class ShardedWriter:
+    """Writes {"query", "labels", "has_ctx"} records to `path`, or with shard_size > 0 to
+    `<stem>-00000<ext>`, `<stem>-00001<ext>`, ... of shard_size records each (shards left
+    over from an earlier, longer run are removed). fmt: "jsonl" or "parquet" (needs pyarrow,
+    written in row groups of at most row_group_size records)."""
+    def __init__(self, path: str, shard_size=0, fmt="jsonl", row_group_size=50000):
+        if fmt not in ("jsonl", "parquet"):
+            raise ValueError(f"Unknown format {fmt}, expected jsonl or parquet")
+        if fmt == "parquet" and not _HAS_PA:
+            raise ValueError("Parquet output needs pyarrow (pip install pyarrow)")
+        self.path = path
+        self.shard_size = shard_size
+        self.fmt = fmt
+        self.row_group_size = min(row_group_size, shard_size) if shard_size else row_group_size
+        self.paths = []
+        self.f = None
+        self.in_shard = 0
+        self.buffer = []
+        self.stats = {"written": 0}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def open_shard(self):
+        path = shard_path(self.path, len(self.paths)) if self.shard_size else self.path
+        self.paths.append(path)
+        self.in_shard = 0
+        if self.fmt == "jsonl":
+            self.f = open(path, "w", encoding="utf-8")
+        else:
+            self.f = pq.ParquetWriter(path, pa.schema([("query", pa.string()), ("labels", pa.list_(pa.string())), ("has_ctx", pa.int8())]))
+
+    def write_buffer(self):
+        if self.buffer:
+            self.f.write_table(pa.Table.from_pylist(self.buffer, schema=self.f.schema))
+            self.buffer = []
+
+    def close_shard(self):
+        if self.fmt == "parquet":
+            self.write_buffer()
+        self.f.close()
+        self.f = None
+
+    def write(self, row: Row):
+        if self.f is None:
+            self.open_shard()
+        text, labels, has_ctx = row
+        record = {"query": text, "labels": labels, "has_ctx": has_ctx}
+        if self.fmt == "jsonl":
+            self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            self.buffer.append(record)
+            if len(self.buffer) >= self.row_group_size:
+                self.write_buffer()
+        self.in_shard += 1
+        self.stats["written"] += 1
+        if self.shard_size and self.in_shard >= self.shard_size:
+            self.close_shard()
+
+    def close(self):
+        if self.f is None and not self.paths:
+            self.open_shard()  # no rows: still leave an (empty) output
+        if self.f is not None:
+            self.close_shard()
+        if self.shard_size:
+            i = len(self.paths)
+            while os.path.exists(shard_path(self.path, i)):
+                os.remove(shard_path(self.path, i))
+                i += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
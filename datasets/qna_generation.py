@@ -1,10 +1,11 @@
 import pandas as pd
 import math, hashlib, unicodedata, random, argparse
-from typing import List, Sequence, Tuple, Dict
+from typing import List, Sequence, Tuple, Dict, Iterator
 import numpy as np
 import torch, torch.nn as nn, torch.optim as optim
 from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
-import json
+from itertools import islice
+from qa_expander import Block, Part, expand, unique, sample, label_key, space_size, ShardedWriter
 
 # sklearn metrics
 _HAS_SK=True
@@ -183,70 +184,69 @@ DISEASE_INTENT=["{x} là bệnh gì","{x} thuộc bệnh nào","{x} là biểu h
 
 
 # -------------------- Data builder --------------------
-def build_train_raw()->List[Tuple[str,List[str],int]]:
-    rows=[]
-
+def train_blocks()->List[Block]:
+    # không gian câu hỏi, theo đúng thứ tự sinh (xem qa_expander.py)
+    blocks=[]
     for k,tpls in TEMPLATES.items():
         if k == "disease":
             # 1. disease intent từ SYMPTOMY
-            for x in SYMPTOMY:
-                for tpl in tpls:
-                    if "{x}" in tpl:
-                        rows.append((tpl.format(x=x), [k], 0))
+            blocks.append(Block("x", SYMPTOMY, [Part([(tpl,[k]) for tpl in tpls if "{x}" in tpl])]))
             # 2. disease từ chính DISEASES
-            for d in DISEASES:
-                for tpl in tpls:
-                    if "{main}" in tpl:
-                        rows.append((tpl.format(main=d), [k], 0))
+            blocks.append(Block("main", DISEASES, [Part([(tpl,[k]) for tpl in tpls if "{main}" in tpl])]))
         else:
-            # các lớp khác dựa trên DISEASES
-            for d in DISEASES:
-                # single-label (no context)
-                for tpl in tpls:
-                    rows.append((tpl.format(main=d), [k], 0))
-
-                # single-label + context (nếu có trong TEMPLATES_CTX)
-                if k in TEMPLATES_CTX:
-                    for ctx in TOPICS+SUBTOPICS:
-                        for tpl_ctx in TEMPLATES_CTX[k]:
-                            rows.append((tpl_ctx.format(main=d, ctx=ctx), [k], 1))
-
-    # multi-label (no context)
-    for d in DISEASES:
-        for labs,tpls in MULTI_TEMPLATES:
-            for tpl in tpls:
-                rows.append((tpl.format(main=d), labs, 0))
-
+            # các lớp khác dựa trên DISEASES: single-label (no context), rồi + context (nếu có trong TEMPLATES_CTX)
+            parts=[Part([(tpl,[k]) for tpl in tpls])]
+            if k in TEMPLATES_CTX:
+                parts.append(Part([(tpl_ctx,[k]) for tpl_ctx in TEMPLATES_CTX[k]], 1, TOPICS+SUBTOPICS))
+            blocks.append(Block("main", DISEASES, parts))
+
+    blocks.append(Block("main", DISEASES, [
+        # multi-label (no context)
+        Part([(tpl,labs) for labs,tpls in MULTI_TEMPLATES for tpl in tpls]),
         # multi-label + context
-        for ctx in TOPICS+SUBTOPICS:
-            for labs,tpls in MULTI_TEMPLATES_CTX:
-                for tpl in tpls:
-                    rows.append((tpl.format(main=d, ctx=ctx), labs, 1))
-
+        Part([(tpl,labs) for labs,tpls in MULTI_TEMPLATES_CTX for tpl in tpls], 1, TOPICS+SUBTOPICS),
         # topic/subtopic root (cũng tính là có context)
-        for ctx in TOPICS:
-            rows.append((f"{d} trong {ctx}", ["topic"], 1))
-        for ctx in SUBTOPICS:
-            rows.append((f"{d} ở {ctx}", ["subtopic"], 1))
-
-    # dedup
-    seen=set(); out=[]
-    for text,labs,has_ctx in rows:
-        key=(text.lower(),"|".join(sorted(labs)),has_ctx)
-        if key not in seen:
-            seen.add(key)
-            out.append((text,labs,has_ctx))
-    return out
-
-
-def main():
-    qas = build_train_raw()
-    with open("datasets/synthetic_qas.jsonl", "w", encoding="utf-8") as f:
-        for q, labs, ctx in qas:
-            f.write(json.dumps(
-                {"query": q, "labels": labs, "has_ctx": ctx},
-                ensure_ascii=False
-            ) + "\n")
+        Part([("{main} trong {ctx}",["topic"])], 1, TOPICS),
+        Part([("{main} ở {ctx}",["subtopic"])], 1, SUBTOPICS),
+    ]))
+    return blocks
+
+def iter_train_raw()->Iterator[Tuple[str,List[str],int]]:
+    # từng dòng một, chưa dedup
+    return expand(train_blocks())
+
+def build_train_raw()->List[Tuple[str,List[str],int]]:
+    # dedup (hash 64-bit của key, xem qa_expander.row_key)
+    return list(unique(iter_train_raw()))
+
+def parse_weights(specs:Sequence[str])->Dict[str,float]:
+    # "symptom=2" "cause|symptom=0.5" -> {label_key: weight}
+    weights={}
+    for spec in specs:
+        labs,sep,w=spec.rpartition("=")
+        if not sep:
+            raise ValueError(f"Bad weight {spec}, expected labels=weight")
+        weights[label_key(labs.split("|"))]=float(w)
+    return weights
+
+def main(args):
+    blocks=train_blocks()
+    weights=parse_weights(args.weights)
+    if args.sample:
+        rows=islice(unique(sample(blocks, weights, args.seed)), args.sample)
+    else:
+        rows=unique(expand(blocks))
+    with ShardedWriter(args.output, args.shard_size, args.format) as writer:
+        for row in rows:
+            writer.write(row)
+    print(f"{writer.stats['written']} queries (space: {space_size(blocks)} rows) -> {', '.join(writer.paths)}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate the synthetic multi-label queries")
+    parser.add_argument("--output", default="datasets/synthetic_qas.jsonl")
+    parser.add_argument("--format", choices=["jsonl","parquet"], default="jsonl")
+    parser.add_argument("--shard_size", type=int, default=0, help="Queries per output shard (<stem>-00000<ext>, ...), 0: a single file")
+    parser.add_argument("--sample", type=int, default=0, help="Draw this many distinct queries at random instead of the full cross product")
+    parser.add_argument("--weights", nargs="*", default=[], help="Sampling weights per label set, e.g. disease=2 cause|symptom=0.5 (default 1)")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -3,16 +3,14 @@ import sys, json
 import faiss
 import numpy as np
 from sentence_transformers import SentenceTransformer
+from passage_store import open_passage_store
 
 def load_id_map(idmap_path):
-    return json.load(open(idmap_path, "r", encoding="utf-8"))
-
-def load_passage_by_idmap(passages_jsonl):
-    d = {}
-    for line in open(passages_jsonl, "r", encoding="utf-8"):
-        j = json.loads(line)
-        d[j["id"]] = j["text"]
-    return d
+    # FAISS id -> passage id; a list maps row positions (indexes built before stable ids)
+    id_map = json.load(open(idmap_path, "r", encoding="utf-8"))
+    if isinstance(id_map, list):
+        return dict(enumerate(id_map))
+    return {int(k): v for k, v in id_map.items()}
 
 def load_queries(qas_jsonl):
     return [json.loads(line) for line in open(qas_jsonl, "r", encoding="utf-8")]
@@ -31,7 +29,7 @@ if __name__ == "__main__":
     # Load FAISS index + id map + passages
     index = faiss.read_index(faiss_idx)
     ids = load_id_map(id_map)
-    id_to_text = load_passage_by_idmap(passages_jsonl)
+    store = open_passage_store(passages_jsonl)
 
     model = SentenceTransformer("D:/Documents/HuggingFace/Vietnamese_Embedding_v2")
     
@@ -48,6 +46,6 @@ if __name__ == "__main__":
         for rank, idx in enumerate(I[0]):
             pid = ids[idx]
             score = float(D[0][rank])
-            text = id_to_text.get(pid, "")
+            text = store.text(pid, "")
             print(f"  {rank+1}. id={pid}  score={score:.4f}")
             print("     ", text[:200].replace("\n", " "), "...")
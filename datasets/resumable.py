@@ -0,0 +1,164 @@
+# resumable.py
+"""JSONL writers for the generation jobs (test_gen.py, test_data_generation.py, synthesize.py).
+
+ResumableWriter makes a job restartable: records of completed input items are appended to
+the output in batches, and each committed batch is logged in a sidecar index
+`<output>.index.jsonl`:
+    {"keys": [input key hashes], "hashes": [dedup hashes], "end": size of the output after the batch}
+On open the output is truncated back to the last committed `end`, so after a crash or an abort
+the items in the index are exactly those whose records are in the output: a rerun skips them
+and redoes the rest, without duplicating records. Records whose dedup key (e.g. the question)
+was already written are dropped in O(1) while generating.
+"""
+import os
+import json
+import hashlib
+from typing import Callable, List, Optional
+
+def short_hash(value) -> str:
+    return hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).hexdigest()
+
+def index_path(output_path):
+    return f"{output_path}.index.jsonl"
+
+class JSONLWriter:
+    # plain streaming writer: every record is written as soon as it is added
+    def __init__(self, output_path, mode="a"):
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        self.f = open(output_path, mode, encoding="utf-8")
+        self.stats = {"written": 0}
+
+    def is_done(self, key):
+        return False
+
+    def add(self, key, records: List[dict]):
+        for r in records:
+            self.f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        self.f.flush()
+        self.stats["written"] += len(records)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ResumableWriter:
+    def __init__(self, output_path, dedup_key: Optional[Callable[[dict], str]] = None, batch_size=20, fsync=True):
+        self.output_path = output_path
+        self.index_path = index_path(output_path)
+        self.dedup_key = dedup_key
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.done = set()
+        self.seen = set()
+        self.batch_keys, self.batch_hashes, self.batch_lines = [], [], []
+        self.batch_key_set = set()
+        self.stats = {"resumed": 0, "written": 0, "duplicates": 0}
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        end = self.load_index()
+        if end is None and os.path.exists(output_path):
+            end = self.adopt_output()
+        self.truncate_output(end or 0)
+        self.stats["resumed"] = len(self.done)
+        self.out = open(output_path, "ab")
+        self.index = open(self.index_path, "a", encoding="utf-8")
+
+    def load_index(self):
+        # end of the last committed batch, or None without an index
+        if not os.path.exists(self.index_path):
+            return None
+        end, good = 0, 0
+        with open(self.index_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # cut off by a crash
+                entry = json.loads(line)
+                self.done.update(entry["keys"])
+                self.seen.update(entry["hashes"])
+                end = entry["end"]
+                good += len(line)
+        if good < os.path.getsize(self.index_path):
+            with open(self.index_path, "r+b") as f:
+                f.truncate(good)
+        return end
+
+    def adopt_output(self):
+        # an output written before the index existed: its complete lines count as committed
+        # (for dedup only, their input keys are unknown)
+        hashes, end = [], 0
+        with open(self.output_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                end += len(line)
+                if self.dedup_key and line.strip():
+                    hashes.append(short_hash(self.dedup_key(json.loads(line))))
+        self.seen.update(hashes)
+        with open(self.index_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"keys": [], "hashes": hashes, "end": end}) + "\n")
+        print(f"[Info] Adopted {len(hashes)} existing records of {self.output_path} into {self.index_path}")
+        return end
+
+    def truncate_output(self, end):
+        size = os.path.getsize(self.output_path) if os.path.exists(self.output_path) else 0
+        if size < end:
+            raise ValueError(f"{self.output_path} is shorter than recorded in {self.index_path}, remove the index to start over")
+        if size > end:
+            print(f"[Info] Dropping {size - end} bytes of {self.output_path} written after the last committed batch")
+            with open(self.output_path, "r+b") as f:
+                f.truncate(end)
+
+    def is_done(self, key):
+        h = short_hash(key)
+        return h in self.done or h in self.batch_key_set
+
+    def add(self, key, records: List[dict]):
+        # records of one completed input item; duplicates of already written records are dropped
+        for r in records:
+            if self.dedup_key:
+                h = short_hash(self.dedup_key(r))
+                if h in self.seen:
+                    self.stats["duplicates"] += 1
+                    continue
+                self.seen.add(h)
+                self.batch_hashes.append(h)
+            self.batch_lines.append(json.dumps(r, ensure_ascii=False) + "\n")
+        if key is not None:
+            self.batch_keys.append(short_hash(key))
+            self.batch_key_set.add(self.batch_keys[-1])
+        if max(len(self.batch_keys), len(self.batch_lines)) >= self.batch_size:
+            self.flush()
+
+    def sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def flush(self):
+        if not self.batch_keys and not self.batch_lines:
+            return
+        # records first, then the index entry that commits them
+        self.out.write("".join(self.batch_lines).encode("utf-8"))
+        self.sync(self.out)
+        entry = {"keys": self.batch_keys, "hashes": self.batch_hashes, "end": self.out.tell()}
+        self.index.write(json.dumps(entry) + "\n")
+        self.sync(self.index)
+        self.done.update(self.batch_keys)
+        self.stats["written"] += len(self.batch_lines)
+        self.batch_keys, self.batch_hashes, self.batch_lines = [], [], []
+        self.batch_key_set = set()
+
+    def close(self):
+        self.flush()
+        self.out.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,91 @@
+# stub_llm_server.py
+"""Offline OpenAI-compatible stub for the generation scripts (see async_llm.py).
+
+POST /v1/chat/completions answers deterministically from the prompt after `--latency` seconds,
+failing a `--fail_rate` fraction of requests with 429 or 500 to exercise the retries.
+GET /stats returns the request counters.
+
+    python datasets/stub_llm_server.py --port 8001 --latency 0.2 --fail_rate 0.1
+"""
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def stub_answer(prompt: str) -> str:
+    digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+    return f"Câu trả lời mẫu {digest}: {' '.join(prompt.split()[:30])}"
+
+def make_handler(latency=0.0, fail_rate=0.0, seed=0):
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    stats = {"requests": 0, "failed": 0, "in_flight": 0, "max_in_flight": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, obj, headers=()):
+            body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in headers:
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                with lock:
+                    self.send_json(200, dict(stats))
+            else:
+                self.send_json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_json(404, {"error": {"message": "not found"}})
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            with lock:
+                stats["requests"] += 1
+                stats["in_flight"] += 1
+                stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+                fail = rng.random() < fail_rate
+                status = rng.choice([429, 500]) if fail else 200
+            try:
+                time.sleep(latency)
+            finally:
+                with lock:
+                    stats["in_flight"] -= 1
+            if fail:
+                with lock:
+                    stats["failed"] += 1
+                self.send_json(status, {"error": {"message": "stub failure", "code": status}}, [("Retry-After", "0")] if status == 429 else ())
+                return
+            prompt = request["messages"][-1]["content"]
+            self.send_json(200, {
+                "id": f"stub-{stats['requests']}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": stub_answer(prompt)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": 30, "total_tokens": len(prompt.split()) + 30},
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server for offline generation runs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per request")
+    parser.add_argument("--fail_rate", type=float, default=0.0, help="Fraction of requests answered with 429/500")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args.latency, args.fail_rate, args.seed))
+    print(f"Stub LLM server on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
@@ -1,44 +1,48 @@
 import json
-from openai import OpenAI
+import asyncio
+import argparse
 from dotenv import load_dotenv
-import os
+from async_llm import add_llm_args, llm_from_args, run_jobs
+from resumable import JSONLWriter
 
 # -----------------------------
-# 1. OpenRouter setup
+# 1. OpenRouter setup (OPENROUTER_API_KEY từ .env, xem async_llm.py)
 # -----------------------------
 load_dotenv()
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-client = OpenAI(api_key=OPENROUTER_API_KEY, base_url="https://openrouter.ai/api/v1")
 
-def rephrase_answer(answer_text):
+async def rephrase_answer(llm, answer_text):
     """Dùng LLM để viết lại answer mượt mà, tự nhiên nhưng vẫn giữ nội dung."""
     prompt = f"Hãy viết lại câu trả lời sau cho mượt mà, rõ ràng, tự nhiên, vẫn giữ nguyên thông tin: {answer_text}"
-    resp = client.chat.completions.create(
-        model="qwen/qwen-2.5-72b-instruct",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.08,
-        max_tokens=500
-    )
-    return resp.choices[0].message.content.strip()
+    return await llm.complete(prompt, max_tokens=500, temperature=0.08)
+
+async def rephrase_record(llm, record):
+    answers = record.get("answers", [])
+    # các answer của một record được viết lại song song
+    results = await asyncio.gather(*(rephrase_answer(llm, ans) for ans in answers), return_exceptions=True)
+    new_answers = []
+    for ans, ans_smooth in zip(answers, results):
+        if isinstance(ans_smooth, Exception):
+            print(f"[Warning] Rephrase lỗi: {ans_smooth}, giữ nguyên answer")
+            ans_smooth = ans
+        new_answers.append(ans_smooth)
+    record["answers"] = new_answers
+    print(f"[Info] Rephrased question: {record['question']}")
+    return record
 
 # -----------------------------
 # 2. Load JSON
 # -----------------------------
-input_file = "datasets/qas_vi_existing_questions.jsonl"  # JSONL file cũ
-output_file = "datasets/qas_rag_rephrased.jsonl"
+async def main(args):
+    llm = llm_from_args(args)
+    with open(args.input_file, "r", encoding="utf-8") as fin, JSONLWriter(args.output_file, "w") as writer:
+        records = (json.loads(line) for line in fin)
+        await run_jobs(records, lambda r: rephrase_record(llm, r), writer, workers=2 * args.concurrency, ordered=not args.unordered)
+    await llm.aclose()
+    print(f"Done! {writer.stats['written']} records -> {args.output_file}, LLM: {llm.stats}")
 
-with open(input_file, "r", encoding="utf-8") as fin, open(output_file, "w", encoding="utf-8") as fout:
-    for line in fin:
-        record = json.loads(line)
-        answers = record.get("answers", [])
-        new_answers = []
-        for ans in answers:
-            try:
-                ans_smooth = rephrase_answer(ans)
-            except Exception as e:
-                print(f"[Warning] Rephrase lỗi: {e}, giữ nguyên answer")
-                ans_smooth = ans
-            new_answers.append(ans_smooth)
-        record["answers"] = new_answers
-        fout.write(json.dumps(record, ensure_ascii=False) + "\n")
-        print(f"[Info] Rephrased question: {record['question']}")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rephrase the answers of a QA JSONL file with an LLM")
+    parser.add_argument("--input_file", default="datasets/qas_vi_existing_questions.jsonl")  # JSONL file cũ
+    parser.add_argument("--output_file", default="datasets/qas_rag_rephrased.jsonl")
+    add_llm_args(parser)
+    asyncio.run(main(parser.parse_args()))
@@ -1,12 +1,15 @@
 import pandas as pd
 import json
 import requests
-from collections import defaultdict
 from underthesea import word_tokenize
 import ast
-from openai import OpenAI
+import asyncio
+import argparse
+from passage_store import open_passage_store
 from dotenv import load_dotenv
-import os
+from async_llm import add_llm_args, llm_from_args, run_jobs
+from resumable import ResumableWriter
+from token_overlap import TokenOverlapScorer
 
 # -----------------------------
 # 1. Load filtered entity file
@@ -17,36 +20,16 @@ df = pd.read_csv("datasets/data/5.csv")
 # 2. Load passages data
 # -----------------------------
 passages_file = "datasets/passages.jsonl"
-passages = []
-with open(passages_file, "r", encoding="utf-8") as f:
-    for line in f:
-        passages.append(json.loads(line))
-
-# Map source_id -> list of passages
-source_to_passages = defaultdict(list)
-for p in passages:
-    source_id = str(p["meta"]["source_id"])
-    source_to_passages[source_id].append(p)
+# source_id -> list of passages, memory-mapped (see passage_store.py)
+passage_store = open_passage_store(passages_file)
 
 # -----------------------------
-# 3. OpenRouter API setup
+# 3. OpenRouter API setup (OPENROUTER_API_KEY từ .env, xem async_llm.py)
 # -----------------------------
 load_dotenv()
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-client = OpenAI(api_key=OPENROUTER_API_KEY, base_url="https://openrouter.ai/api/v1")
-
-def call_llm(prompt, max_tokens=300):
-    resp = client.chat.completions.create(
-        model="qwen/qwen-2.5-72b-instruct",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.08,
-        max_tokens=max_tokens
-    )
-    print("Kết nối được với OPENROUTER")
-    return resp.choices[0].message.content.strip()
 
 # -----------------------------
-# 4. Function: compute_token_match
+# 4. Functions: search_passages, token match
 # -----------------------------
 def search_passages(entity_name, passages, top_k=3):
     """
@@ -59,16 +42,9 @@ def search_passages(entity_name, passages, top_k=3):
             results.append(p)
     return results[:top_k]  # lấy top_k
 
-def compute_token_match(answer_text, passage_text):
-    """
-    Tính token match score giữa answer và passage đơn lẻ
-    """
-    answer_tokens = set(word_tokenize(answer_text.lower()))
-    passage_tokens = set(word_tokenize(passage_text.lower()))
-    if not answer_tokens:
-        return 0.0
-    match_count = len(answer_tokens & passage_tokens)
-    return round(match_count / len(answer_tokens), 2)
+# token match score giữa answer và các passage (mỗi passage chỉ tokenize một lần, xem token_overlap.py)
+token_scorer = TokenOverlapScorer(word_tokenize)
+
 # -----------------------------
 # 5. Build dataset
 # -----------------------------
@@ -76,21 +52,24 @@ output_path = "D:\\Work\\side-projects\\rag-paper\\rag-system\\RRAG\\datasets\\q
 layer_cols = [c for c in df.columns if c not in ["entity_name","entity_type","article_ids"]]
 
 total_q = 0
-with open(output_path, "a", encoding="utf-8") as fout:
+
+def iter_layer_items():
+    # một item cho mỗi (entity, layer) có dữ liệu
     for idx, row in df.iterrows():
-        while 
         entity_name = row["entity_name"]
         article_ids = ast.literal_eval(row["article_ids"])
 
         for layer_name in layer_cols:
             layer_value = row[layer_name]
             if not pd.isna(layer_value) and layer_value != "":
-                
-                # -----------------
-                # Generate question chỉ dựa vào layer này
-                # -----------------
-                try:
-                    prompt_q = f"""Dựa vào entity '{entity_name}' với layer '{layer_name}', hãy viết 1 câu hỏi y tế ngắn gọn, rõ ràng. không cần dấu chấm hỏi cuối câu. Xem '{layer_name}' phù hợp với thông tin nào bên dưới 
+                yield entity_name, article_ids, layer_name, layer_value
+
+# -----------------
+# Generate question chỉ dựa vào layer này
+# -----------------
+async def generate_question(llm, entity_name, layer_name, placeholder=False):
+    try:
+        prompt_q = f"""Dựa vào entity '{entity_name}' với layer '{layer_name}', hãy viết 1 câu hỏi y tế ngắn gọn, rõ ràng. không cần dấu chấm hỏi cuối câu. Xem '{layer_name}' phù hợp với thông tin nào bên dưới 
 một số câu mẫu như sau
   "symptom": [
     "Khi nào thì biết mình đang mắc {entity_name}"
@@ -123,74 +102,111 @@ một số câu mẫu như sau
   "prevention": ["Thói quen giúp hạn chế {entity_name}"]
 
 KHÔNG DƯỢC GHI NHƯ SAU: "Dựa vào thông tin được cung cấp, đây là một câu hỏi y tế ngắn gọn và rõ ràng: ..." """
-                    question = call_llm(prompt_q)
-                except Exception as e:
-                    print(f"[Warning] Không tạo được question cho {entity_name}, layer {layer_name}: {e}")
-                    question = f"{entity_name} ({layer_name}) là gì?"
-
-                # -----------------
-                # Generate answer chỉ dựa vào layer này
-                # -----------------
-                try:
-                    prompt_a = f"""Dựa vào entity '{entity_name}' với layer '{layer_name}': "{layer_value}", hãy viết câu trả lời chi tiết, đúng sự thật, không thêm thông tin ngoài layer. Chỉ đưa ra câu trả lời bằng tiếng việt"""
-                    answer = call_llm(prompt_a, max_tokens=500)
-                except Exception as e:
-                    print(f"[Warning] Không tạo được answer cho {entity_name}, layer {layer_name}: {e}")
-                    answer = "Không có thông tin"
-
-                # -----------------
-                # Lấy tất cả passages từ article_ids
-                # -----------------
-                all_passages = []
-                for art_id in article_ids:
-                    source_id = str(int(art_id) - 1)  # theo rule trước đó
-                    all_passages.extend(source_to_passages.get(source_id, []))
-
-                # -----------------
-                # Tính token score & đánh dấu hasanswer/isgold
-                # -----------------
-                for p in all_passages:
-                    token_score = compute_token_match(answer, p['text'])
-                    p['_token_score'] = token_score
-                    p['_has_answer'] = token_score > 0.15
-                    p['_is_gold'] = p['_has_answer']
-
-                # -----------------
-                # Top 3 positive passages
-                # -----------------
-                positives = [p for p in all_passages if p['_has_answer']]
-                positives = sorted(positives, key=lambda x: x['_token_score'], reverse=True)[:3]
-
-                # Top 2 negative passages
-                negatives = [p for p in all_passages if not p['_has_answer']]
-                negatives = sorted(negatives, key=lambda x: x['_token_score'], reverse=True)[:2]
-
-                # Gộp lại
-                final_passages = positives + negatives
-
-                # Chuẩn hóa ctxs_list
-                ctxs_list = [
-                    {
-                        "id": p["id"],
-                        "title": p["meta"]["title"],
-                        "text": p["text"],
-                        "score": round(p['_token_score'], 2),
-                        "hasanswer": p['_has_answer'],
-                        "isgold": p['_is_gold']
-                    }
-                    for p in final_passages
-                ]
-
-                # -----------------
-                # Write one record per layer
-                # -----------------
-                example = {
-                    "question": question,
-                    "answers": [answer] if answer else [],
-                    "ctxs": ctxs_list
-                }
-                fout.write(json.dumps(example, ensure_ascii=False) + "\n")
-                total_q += 1
-                print(f"[Info] Tạo data thành công cho entity '{entity_name}', layer '{layer_name}' ({total_q} câu hỏi)")
-
-print(f"Done! Dataset saved tại: {output_path} (tổng câu hỏi: {total_q})")
+        return await llm.complete(prompt_q, max_tokens=300)
+    except Exception as e:
+        if not placeholder:
+            raise
+        print(f"[Warning] Không tạo được question cho {entity_name}, layer {layer_name}: {e}")
+        return f"{entity_name} ({layer_name}) là gì?"
+
+# -----------------
+# Generate answer chỉ dựa vào layer này
+# -----------------
+async def generate_answer(llm, entity_name, layer_name, layer_value, placeholder=False):
+    try:
+        prompt_a = f"""Dựa vào entity '{entity_name}' với layer '{layer_name}': "{layer_value}", hãy viết câu trả lời chi tiết, đúng sự thật, không thêm thông tin ngoài layer. Chỉ đưa ra câu trả lời bằng tiếng việt"""
+        return await llm.complete(prompt_a, max_tokens=500)
+    except Exception as e:
+        if not placeholder:
+            raise
+        print(f"[Warning] Không tạo được answer cho {entity_name}, layer {layer_name}: {e}")
+        return "Không có thông tin"
+
+async def generate_example(llm, item, placeholder=False):
+    global total_q
+    entity_name, article_ids, layer_name, layer_value = item
+    # question và answer không phụ thuộc nhau nên gọi song song; nếu LLM vẫn lỗi sau khi retry thì
+    # (mặc định) lỗi đi lên, run_jobs để item này chưa xong và lần chạy sau sinh lại
+    question, answer = await asyncio.gather(generate_question(llm, entity_name, layer_name, placeholder),
+                                            generate_answer(llm, entity_name, layer_name, layer_value, placeholder))
+
+    # -----------------
+    # Lấy tất cả passages từ article_ids
+    # -----------------
+    all_passages = []
+    for art_id in article_ids:
+        source_id = str(int(art_id) - 1)  # theo rule trước đó
+        all_passages.extend(passage_store.by_source(source_id))
+
+    # -----------------
+    # Tính token score & đánh dấu hasanswer/isgold
+    # -----------------
+    for p, token_score in zip(all_passages, token_scorer.scores(answer, all_passages)):
+        p['_token_score'] = token_score
+        p['_has_answer'] = token_score > 0.15
+        p['_is_gold'] = p['_has_answer']
+
+    # -----------------
+    # Top 3 positive passages
+    # -----------------
+    positives = [p for p in all_passages if p['_has_answer']]
+    positives = sorted(positives, key=lambda x: x['_token_score'], reverse=True)[:3]
+
+    # Top 2 negative passages
+    negatives = [p for p in all_passages if not p['_has_answer']]
+    negatives = sorted(negatives, key=lambda x: x['_token_score'], reverse=True)[:2]
+
+    # Gộp lại
+    final_passages = positives + negatives
+
+    # Chuẩn hóa ctxs_list
+    ctxs_list = [
+        {
+            "id": p["id"],
+            "title": p["meta"]["title"],
+            "text": p["text"],
+            "score": round(p['_token_score'], 2),
+            "hasanswer": p['_has_answer'],
+            "isgold": p['_is_gold']
+        }
+        for p in final_passages
+    ]
+
+    # -----------------
+    # Write one record per layer
+    # -----------------
+    example = {
+        "question": question,
+        "answers": [answer] if answer else [],
+        "ctxs": ctxs_list
+    }
+    total_q += 1
+    print(f"[Info] Tạo data thành công cho entity '{entity_name}', layer '{layer_name}' ({total_q} câu hỏi)")
+    return example
+
+# -----------------
+# Checkpoint: key của một (entity, layer), câu hỏi dùng để lọc trùng
+# -----------------
+def item_key(item):
+    entity_name, article_ids, layer_name, layer_value = item
+    return f"{entity_name}|{layer_name}"
+
+def question_key(example):
+    return " ".join(example["question"].lower().split())
+
+async def main(args):
+    llm = llm_from_args(args)
+    # các (entity, layer) đã xong (ghi trong output_path.index.jsonl) được bỏ qua khi chạy lại
+    with ResumableWriter(output_path, dedup_key=question_key, batch_size=args.commit_every) as writer:
+        stats = await run_jobs(iter_layer_items(), lambda item: generate_example(llm, item, args.placeholder), writer, workers=2 * args.concurrency,
+                               ordered=not args.unordered, key=item_key)
+    await llm.aclose()
+    print(f"Jobs: {stats}, output: {writer.stats}, LLM: {llm.stats}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate one QA example per (entity, layer) of datasets/data/5.csv")
+    add_llm_args(parser)
+    parser.add_argument("--commit_every", type=int, default=20, help="(entity, layer) items per atomic batch write")
+    parser.add_argument("--placeholder", action="store_true", help="Write a fallback question / \"Không có thông tin\" when the LLM still fails after all retries (the item then counts as done and is not regenerated)")
+    asyncio.run(main(parser.parse_args()))
+    print(f"Done! Dataset saved tại: {output_path} (tổng câu hỏi: {total_q})")
@@ -0,0 +1,63 @@
+# token_overlap.py
+"""Token-overlap scores of an answer against candidate passages (hasanswer / isgold labelling).
+
+score(answer, passage) = |tokens(answer) & tokens(passage)| / |tokens(answer)|, rounded to 2 decimals,
+where tokens(text) = set(word_tokenize(text.lower())).
+
+Every passage is tokenized once and kept as a row of integer token ids; the candidate passages
+of a question (the passages of its entity's articles, shared by many questions) form a binary
+CSR matrix, so the overlaps with all of them are one sparse matrix-vector product.
+"""
+from collections import OrderedDict
+from typing import Callable, List
+
+import numpy as np
+from scipy import sparse
+
+class TokenOverlapScorer:
+    def __init__(self, tokenize: Callable[[str], List[str]], max_matrices=1024):
+        self.tokenize = tokenize
+        self.vocab = {}
+        self.passage_tokens = {}  # passage id -> sorted unique token ids
+        self.matrices = OrderedDict()  # tuple of passage ids -> CSR matrix (LRU)
+        self.max_matrices = max_matrices
+
+    def token_set(self, text: str) -> set:
+        return set(self.tokenize(text.lower()))
+
+    def passage_row(self, passage: dict) -> np.ndarray:
+        row = self.passage_tokens.get(passage["id"])
+        if row is None:
+            ids = [self.vocab.setdefault(tok, len(self.vocab)) for tok in self.token_set(passage["text"])]
+            row = self.passage_tokens[passage["id"]] = np.array(sorted(ids), dtype=np.int64)
+        return row
+
+    def passage_matrix(self, passages: List[dict]):
+        key = tuple(p["id"] for p in passages)
+        m = self.matrices.get(key)
+        if m is not None:
+            self.matrices.move_to_end(key)
+            return m
+        rows = [self.passage_row(p) for p in passages]
+        indptr = np.cumsum([0] + [len(r) for r in rows])
+        indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        # columns: the vocabulary as of now; later tokens cannot occur in these passages
+        m = sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr), shape=(len(rows), len(self.vocab)))
+        self.matrices[key] = m
+        if len(self.matrices) > self.max_matrices:
+            self.matrices.popitem(last=False)
+        return m
+
+    def scores(self, answer: str, passages: List[dict]) -> List[float]:
+        if not passages:
+            return []
+        answer_tokens = self.token_set(answer)
+        if not answer_tokens:
+            return [0.0] * len(passages)
+        m = self.passage_matrix(passages)
+        vec = np.zeros(m.shape[1], dtype=np.int32)
+        ids = [self.vocab[tok] for tok in answer_tokens if tok in self.vocab]
+        vec[[i for i in ids if i < m.shape[1]]] = 1
+        counts = m @ vec
+        # python round (not np.round), so scores match a per-passage computation exactly
+        return [round(c / len(answer_tokens), 2) for c in counts.tolist()]
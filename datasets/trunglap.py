@@ -1,23 +1,25 @@
-import json
-from collections import defaultdict
+import sys
+from dedup_qas import iter_jsonl, hash64
 
-# Đọc file JSONL
-file_path = "datasets/qas_synthetic_vi.jsonl"
-data = []
-with open(file_path, "r", encoding="utf-8") as f:
-    for line in f:
-        data.append(json.loads(line))
+# Đọc file JSONL theo từng dòng, chỉ giữ hash 64-bit của mỗi câu hỏi
+# (ghi file đã lọc trùng: python datasets/dedup_qas.py <in.jsonl> <out.jsonl>)
+file_path = sys.argv[1] if len(sys.argv) > 1 else "datasets/qas_synthetic_vi.jsonl"
 
 # Tìm duplicate dựa trên 'question'
-question_map = defaultdict(list)
-for idx, item in enumerate(data):
-    question_map[item["question"]].append(idx)
-
-# Liệt kê các câu hỏi trùng lặp
-duplicates = {q: idxs for q, idxs in question_map.items() if len(idxs) > 1}
+first_idx = {}    # hash -> dòng đầu tiên
+duplicates = {}   # hash -> (question, các dòng trùng lặp)
+for idx, _, item in iter_jsonl(file_path):
+    h = hash64(item["question"])
+    if h not in first_idx:
+        first_idx[h] = idx
+        continue
+    if h not in duplicates:
+        duplicates[h] = (item["question"], [first_idx[h]])
+    duplicates[h][1].append(idx)
 
+# Liệt kê các câu hỏi trùng lặp (theo thứ tự xuất hiện đầu tiên)
 print(f"Tìm thấy {len(duplicates)} câu hỏi trùng lặp.\n")
 
-for q, idxs in duplicates.items():
+for q, idxs in sorted(duplicates.values(), key=lambda d: d[1][0]):
     print(f"Câu hỏi: {q}")
     print(f"Dòng trùng lặp: {idxs}\n")
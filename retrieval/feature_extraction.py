@@ -16,6 +16,7 @@ def seed_it(seed):
     torch.manual_seed(seed)
 seed_it(42)
 
+import csv
 import pickle
 from xopen import xopen
 from tqdm import tqdm
@@ -80,8 +81,29 @@ def load_data_jsonl(input_path, dataset_seed=42):
     print(f'prepare dataset, train size: {len(train_data)}, test size: {len(test_data)}')
     return train_data, test_data
 
+##### Evaluation
+def write_rerank_csv(metrics, output_path, at_k=10):
+    # the file and columns RerankingEvaluator writes to output_path, so both evaluation modes leave the same results
+    os.makedirs(output_path, exist_ok=True)
+    csv_path = os.path.join(output_path, f'RerankingEvaluator_results_@{at_k}.csv')
+    output_file_exists = os.path.isfile(csv_path)
+    with open(csv_path, newline='', mode='a' if output_file_exists else 'w', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        if not output_file_exists:
+            writer.writerow(['epoch', 'steps', 'MAP', f'MRR@{at_k}', f'NDCG@{at_k}'])
+        writer.writerow([-1, -1, metrics['map'], metrics['mrr'], metrics['ndcg']])
+
+def evaluate_retriever(model, test_samples, output_path, batched_eval=False):
+    if batched_eval:
+        r = compute_rerank_metrics_from_samples(model, test_samples, batch_size=32, show_progress_bar=True)
+        print(r)
+        write_rerank_csv(r, output_path)
+        return r
+    dev_evaluator = RerankingEvaluator(test_samples, batch_size=32, show_progress_bar=True)
+    return dev_evaluator(model, output_path)
+
 ##### Feature Extration and Save
-def main(dataset_name, input_path, train_data_path, test_data_path, model_name, save_path, save_train_path, save_test_path, output_path):
+def main(dataset_name, input_path, train_data_path, test_data_path, model_name, save_path, save_train_path, save_test_path, output_path, batched_eval=False):
     ##### Load Retriever
     model = SentenceTransformer(model_name)
     if not os.path.exists(output_path):
@@ -93,8 +115,7 @@ def main(dataset_name, input_path, train_data_path, test_data_path, model_name,
         ##### Evaluation
         test_samples = get_dual_dev(examples, test_index)
 
-        dev_evaluator = RerankingEvaluator(test_samples, batch_size=32, show_progress_bar=True)
-        r = dev_evaluator(model, output_path) 
+        r = evaluate_retriever(model, test_samples, output_path, batched_eval)
 
         dataset = get_dual_sim(examples, all_index, model)
         with open(save_path, 'wb') as fin:
@@ -106,8 +127,7 @@ def main(dataset_name, input_path, train_data_path, test_data_path, model_name,
         train_data, test_data = load_data_json(input_path)
         test_samples = get_dual_dev_hotpotqa(test_data)
 
-        dev_evaluator = RerankingEvaluator(test_samples, batch_size=32, show_progress_bar=True)
-        r = dev_evaluator(model, output_path) 
+        r = evaluate_retriever(model, test_samples, output_path, batched_eval)
 
         dataset = get_dual_sim_hotpotqa(train_data, model)
         dataset_test = get_dual_sim_hotpotqa(test_data, model)
@@ -123,8 +143,7 @@ def main(dataset_name, input_path, train_data_path, test_data_path, model_name,
         train_data, test_data = load_data_jsonl(input_path)
         test_samples = get_dual_dev_musique(test_data)
 
-        dev_evaluator = RerankingEvaluator(test_samples, batch_size=32, show_progress_bar=True)
-        r = dev_evaluator(model, output_path) 
+        r = evaluate_retriever(model, test_samples, output_path, batched_eval)
 
         dataset = get_dual_sim_musique(train_data, model)
         dataset_test = get_dual_sim_musique(test_data, model)
@@ -148,7 +167,8 @@ if __name__ == "__main__":
     parser.add_argument('--save_train_path', type=str, required=False, help='Path to save train dataset')
     parser.add_argument('--save_test_path', type=str, required=False, help='Path to save test dataset')
     parser.add_argument('--output_path', type=str, required=False, default='temp_result', help='Path to save the evluation results')
+    parser.add_argument('--batched_eval', action='store_true', help='Evaluate the retriever with the batched MRR/nDCG/MAP engine instead of sentence-transformers RerankingEvaluator')
     args = parser.parse_args()
 
-    main(args.dataset_name, args.input_path, args.train_data_path, args.test_data_path, args.model_name, args.save_path, args.save_train_path, args.save_test_path, args.output_path)
+    main(args.dataset_name, args.input_path, args.train_data_path, args.test_data_path, args.model_name, args.save_path, args.save_train_path, args.save_test_path, args.output_path, args.batched_eval)
     
@@ -27,11 +27,10 @@ from tqdm import tqdm, trange
 from copy import deepcopy
 from sentence_transformers.util import cos_sim
 from sentence_transformers.evaluation import SentenceEvaluator
-from sklearn.metrics import average_precision_score, ndcg_score
 from typing import Callable, Optional
 from openai import OpenAI
 
-from retrieval_utils import get_precedent_sim, get_nb_sim
+from retrieval_utils import get_precedent_sim, get_nb_sim, compute_rerank_metrics
 
 def getClient()->OpenAI:
     client = OpenAI(
@@ -98,6 +97,7 @@ class RerankingEvaluator(SentenceEvaluator):
         use_batched_encoding: bool = True,
         truncate_dim: Optional[int] = None,
         mrr_at_k: Optional[int] = None,
+        device: Optional[str] = None,
     ):
 
         if mrr_at_k is not None:
@@ -110,60 +110,41 @@ class RerankingEvaluator(SentenceEvaluator):
         self.show_progress_bar = show_progress_bar
         self.use_batched_encoding = use_batched_encoding
         self.truncate_dim = truncate_dim
+        self.device = device if device is not None else ('cuda' if torch.cuda.is_available() else 'cpu')
 
     def compute_metrices_from_embeds(self, dataset, dataset_embeds):
         """
-        Embeds every (query, positive, negative) tuple individually.
-        Is slower than the batched version, but saves memory as only the
-        embeddings for one tuple are needed. Useful when you have
-        a really large test set
+        Stacks the (query, documents) embeddings of `batch_size` samples into
+        padded tensors and computes similarity, ranking, MRR@k, nDCG@k and MAP
+        for the whole batch at once, on CPU or GPU. Agrees with the per-sample
+        sklearn `ndcg_score` / `average_precision_score` numbers, ties included.
         """
-        all_mrr_scores = []
-        all_ndcg_scores = []
-        all_ap_scores = []
         if len(dataset) != len(dataset_embeds):
             raise ValueError()
 
-        for idx in trange(len(dataset), desc="Samples"):
+        query_embeds = []
+        docs_embeds = []
+        labels = []
+        for idx in range(len(dataset)):
             data = dataset[idx]
-            ctxs = data['ctxs']
             is_relevant = [1 if d['isgold'] else 0 for d in data['ctxs']]
-            instance = dataset_embeds[idx]
-            query_embeds = instance["query_embeds"]
-            ctxs_embeds = [ctx['embeds'] for ctx in instance['ctxs']]
-
             if sum(is_relevant) == 0 or sum(is_relevant) == len(is_relevant):
                 raise ValueError()
-
-            query_emb = torch.Tensor(query_embeds).cuda()
-            docs_emb = torch.Tensor(ctxs_embeds).cuda()
-
-            pred_scores = self.similarity_fct(query_emb, docs_emb)
-            if len(pred_scores.shape) > 1:
-                pred_scores = pred_scores[0]
-
-            pred_scores_argsort = torch.argsort(-pred_scores)  # Sort in decreasing order
-            pred_scores = pred_scores.cpu().tolist()
-
-            # Compute MRR score
-            mrr_score = 0
-            for rank, index in enumerate(pred_scores_argsort[0 : self.at_k]):
-                if is_relevant[index]:
-                    mrr_score = 1 / (rank + 1)
-                    break
-            all_mrr_scores.append(mrr_score)
-
-            # Compute NDCG score
-            all_ndcg_scores.append(ndcg_score([is_relevant], [pred_scores], k=self.at_k))
-
-            # Compute AP
-            all_ap_scores.append(average_precision_score(is_relevant, pred_scores))
-
-        mean_ap = np.mean(all_ap_scores)
-        mean_mrr = np.mean(all_mrr_scores)
-        mean_ndcg = np.mean(all_ndcg_scores)
-
-        return {"map": mean_ap, "mrr": mean_mrr, "ndcg": mean_ndcg}
+            instance = dataset_embeds[idx]
+            query_embeds.append(instance["query_embeds"])
+            docs_embeds.append([ctx['embeds'] for ctx in instance['ctxs']])
+            labels.append(is_relevant)
+
+        return compute_rerank_metrics(
+            query_embeds,
+            docs_embeds,
+            labels,
+            at_k=self.at_k,
+            similarity_fct=self.similarity_fct,
+            batch_size=self.batch_size,
+            device=self.device,
+            show_progress_bar=self.show_progress_bar,
+        )
 
 def main(dataset_name, input_path, model_name, emb_save_path, dataset_save_path, dataset_seed=42):
     ##### Load Data
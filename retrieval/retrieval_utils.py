@@ -219,4 +219,107 @@ def get_dual_sim_musique(dataset, retrival_model):
             ctxs.append(ctx)
         data['paragraphs'] = ctxs
         dataset_new.append(data)
-    return dataset_new
\ No newline at end of file
+    return dataset_new
+
+##### Batched reranking metrics
+def _as_float_tensor(embeds):
+    if torch.is_tensor(embeds):
+        return embeds.float()
+    if len(embeds) > 0 and torch.is_tensor(embeds[0]):
+        return torch.stack(list(embeds)).float()
+    return torch.tensor(np.asarray(embeds, dtype=np.float32))
+
+def pad_rerank_batch(query_embeds, docs_embeds, labels, device='cpu'):
+    num_docs = max(len(d) for d in docs_embeds)
+    q_emb = _as_float_tensor(query_embeds).to(device)
+    d_emb = torch.zeros(len(docs_embeds), num_docs, q_emb.shape[-1], device=device)
+    relevance = torch.zeros(len(docs_embeds), num_docs, dtype=torch.float64, device=device)
+    mask = torch.zeros(len(docs_embeds), num_docs, dtype=torch.bool, device=device)
+    for i, (embs, label) in enumerate(zip(docs_embeds, labels)):
+        n = len(embs)
+        d_emb[i, :n] = _as_float_tensor(embs).to(device)
+        relevance[i, :n] = torch.tensor([1.0 if l else 0.0 for l in label], dtype=torch.float64)
+        mask[i, :n] = True
+    return q_emb, d_emb, relevance, mask
+
+def batched_similarity(q_emb, d_emb, similarity_fct=cos_sim):
+    # q_emb: [B, dim], d_emb: [B, n, dim] -> [B, n]
+    if similarity_fct is cos_sim:
+        q_emb = torch.nn.functional.normalize(q_emb, p=2, dim=-1)
+        d_emb = torch.nn.functional.normalize(d_emb, p=2, dim=-1)
+    elif similarity_fct is not util.dot_score:
+        return torch.stack([similarity_fct(q_emb[i], d_emb[i]).reshape(-1) for i in range(q_emb.shape[0])])
+    return torch.bmm(d_emb, q_emb.unsqueeze(-1)).squeeze(-1)
+
+def batched_rerank_metrics(scores, relevance, mask, at_k=10):
+    # Same definitions as the per-sample loop: MRR@k on the ranking, sklearn ndcg_score(k=at_k)
+    # and average_precision_score, both of which average over tied scores.
+    # Exact ties in the ranking are broken by document order (stable sort).
+    scores = scores.double().masked_fill(~mask, float('-inf'))
+    relevance = relevance.double() * mask
+    batch_size, num_docs = scores.shape
+    ranks = torch.arange(num_docs, device=scores.device)
+
+    sorted_scores, order = torch.sort(scores, dim=1, descending=True, stable=True)
+    sorted_rel = relevance.gather(1, order)
+
+    # MRR@k
+    hit = sorted_rel[:, :at_k] > 0
+    first_hit = hit.double().argmax(dim=1)
+    mrr = torch.where(hit.any(dim=1), 1.0 / (first_hit + 1).double(), torch.zeros_like(first_hit, dtype=torch.float64))
+
+    # tie groups over the sorted scores
+    new_group = torch.ones_like(sorted_scores, dtype=torch.bool)
+    new_group[:, 1:] = sorted_scores[:, 1:] != sorted_scores[:, :-1]
+    group = new_group.long().cumsum(dim=1) - 1
+    group_rel = torch.zeros_like(sorted_rel).scatter_add_(1, group, sorted_rel)
+    group_size = torch.zeros_like(sorted_rel).scatter_add_(1, group, torch.ones_like(sorted_rel))
+
+    # nDCG@k
+    discount = 1.0 / torch.log2(ranks.double() + 2)
+    discount[at_k:] = 0.0
+    tied_gain = group_rel.gather(1, group) / group_size.gather(1, group)
+    dcg = (tied_gain * discount).sum(dim=1)
+    ideal_dcg = (torch.sort(relevance, dim=1, descending=True).values * discount).sum(dim=1)
+    ndcg = torch.where(ideal_dcg > 0, dcg / ideal_dcg.clamp(min=1e-12), torch.zeros_like(dcg))
+
+    # AP: precision at the end of every tie group, weighted by the recall gained in that group
+    group_end = torch.ones_like(sorted_scores, dtype=torch.bool)
+    group_end[:, :-1] = sorted_scores[:, :-1] != sorted_scores[:, 1:]
+    precision = sorted_rel.cumsum(dim=1) / (ranks + 1).double()
+    ap = (group_end * precision * group_rel.gather(1, group)).sum(dim=1) / relevance.sum(dim=1).clamp(min=1.0)
+    return mrr, ndcg, ap
+
+def compute_rerank_metrics(query_embeds, docs_embeds, labels, at_k=10, similarity_fct=cos_sim, batch_size=64, device=None, show_progress_bar=False):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if not (len(query_embeds) == len(docs_embeds) == len(labels)):
+        raise ValueError('query_embeds, docs_embeds and labels must have the same length')
+    all_mrr_scores, all_ndcg_scores, all_ap_scores = [], [], []
+    for start in tqdm(range(0, len(query_embeds), batch_size), desc="Batches", disable=not show_progress_bar):
+        end = start + batch_size
+        q_emb, d_emb, relevance, mask = pad_rerank_batch(query_embeds[start:end], docs_embeds[start:end], labels[start:end], device)
+        with torch.no_grad():
+            scores = batched_similarity(q_emb, d_emb, similarity_fct)
+            mrr, ndcg, ap = batched_rerank_metrics(scores, relevance, mask, at_k)
+        all_mrr_scores.append(mrr.cpu())
+        all_ndcg_scores.append(ndcg.cpu())
+        all_ap_scores.append(ap.cpu())
+    mean_ap = torch.cat(all_ap_scores).mean().item()
+    mean_mrr = torch.cat(all_mrr_scores).mean().item()
+    mean_ndcg = torch.cat(all_ndcg_scores).mean().item()
+    return {"map": mean_ap, "mrr": mean_mrr, "ndcg": mean_ndcg}
+
+def compute_rerank_metrics_from_samples(model, samples, at_k=10, batch_size=64, device=None, show_progress_bar=False):
+    # samples: [{'query': str, 'positive': [str], 'negative': [str]}], as built by get_dual_dev*
+    samples = [s for s in samples if len(s['positive']) > 0 and len(s['negative']) > 0]
+    queries = [s['query'] for s in samples]
+    docs = [s['positive'] + s['negative'] for s in samples]
+    labels = [[1] * len(s['positive']) + [0] * len(s['negative']) for s in samples]
+    q_emb = model.encode(queries, batch_size=batch_size, convert_to_tensor=True, show_progress_bar=show_progress_bar)
+    flat_emb = model.encode([d for ds in docs for d in ds], batch_size=batch_size, convert_to_tensor=True, show_progress_bar=show_progress_bar)
+    docs_embeds, offset = [], 0
+    for ds in docs:
+        docs_embeds.append(flat_emb[offset:offset+len(ds)])
+        offset += len(ds)
+    return compute_rerank_metrics(q_emb, docs_embeds, labels, at_k=at_k, batch_size=batch_size, device=device, show_progress_bar=show_progress_bar)
@@ -1,7 +1,7 @@
 import torch
 import numpy as np
 import random, os
-os.environ['CUDA_VISIBLE_DEVICES'] = '1'
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '1')
 print(torch.cuda.is_available())
 def seed_it(seed):
     os.environ["PYTHONSEED"] = str(seed)
@@ -18,27 +18,37 @@ seed_it(42)
 
 
 from tqdm import tqdm
+import time
 import pickle
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from transformers import AutoTokenizer
 from datasets import Dataset
 from transformers import TrainingArguments
 from peft import LoraConfig, prepare_model_for_kbit_training, get_peft_model, TaskType
 
+from RRAG.dataset import load_nq, load_hotpotqa, load_musique
 from RRAG.dataset.load_nq import load_nq_dataset, get_nq_ans
 from RRAG.dataset.load_hotpotqa import load_hotpotqa_dataset, get_hotpotqa_ans
 from RRAG.dataset.load_musique import load_musique_dataset, get_musique_ans
 from RRAG.models.modeling_rrag import RRAGLlamaForCausalLM, RRAGLlamaConfig
 from RRAG.models.modeling_rag import RAGLlamaForCausalLM, RAGLlamaConfig
+from RRAG.models.continuous_batching import ContinuousBatchingScheduler
+from RRAG.models.model_families import MODEL_FAMILIES, INSTRUCTION_TEMPLATE, get_model_family, detect_model_family, setup_tokenizer
 from RRAG.utils.trainer import RRAGTrainer
-from RRAG.utils.metrics import evaluation_from_list
+from RRAG.utils.train_config import OPTIMIZER_STATE_BYTES, TrainingPlan, plan_training, get_precision, resolve_optimizer, apply_gradient_checkpointing
+from RRAG.utils.metrics import evaluation_from_list, get_metrics_for_example, get_metrics_for_dataset
+from RRAG.utils.eval_log import EvalResultLog
+from RRAG.utils.profiling import profiler
 
 class RRAGRunner:
     RETRIEVAL_TOKEN = '<R>'
     UNK_TOKEN = '<unk>'
     UNK_TOKEN_ID = 0
     instruction_type = 'instruction'
+    chat_template = MODEL_FAMILIES['llama'].chat_template
 
     def __init__(
         self,
@@ -53,12 +63,14 @@ class RRAGRunner:
 
         use_rrag=True,
         input_dim=3,
-        hidden_size=4096,
+        hidden_size=None,
         RETRIEVAL_TOKEN='<R>',
-        UNK_TOKEN='<unk>',
-        UNK_TOKEN_ID = 0,
+        UNK_TOKEN=None,
+        UNK_TOKEN_ID=None,
+        model_family=None,
 
         num_k=10,
+        d_model=256,
         use_lora=False,
         use_training=False,
         freeze_llm=True,
@@ -66,6 +78,13 @@ class RRAGRunner:
         pretrained_model_name='',
         num_train_epochs=2,
         per_device_train_batch_size=2,
+        gradient_accumulation_steps=2,
+        checkpoint_every=None,
+        optim=None,
+        auto_train_config=False,
+        train_batch_size=None,
+        train_memory_budget=None,
+        train_memory_fraction=0.9,
 
         use_evaluation=True,
         max_new_tokens=100,
@@ -73,7 +92,27 @@ class RRAGRunner:
         beam_num=5,
         save_results=False,
         instruction_type='instruction',
+        results_log=None,
+        resume=False,
+        num_eval_workers=1,
+        eval_devices=None,
+        device_map='auto',
+        profile=False,
+        profile_dir='output/profile',
+        torch_profiler=False,
+        fused_rformer=False,
+        compile_rformer=False,
+        prune_threshold=None,
+        prune_top_m=None,
+        prune_min_keep=1,
+        pack_prompts=True,
+        static_generation=False,
+        static_generation_buckets='256,512,1024,2048,4096',
+        compile_decode=True,
+        continuous_batching=False,
+        max_batch_size=8,
     ):
+        self.init_args = {k: v for k, v in locals().items() if k != 'self'}
         self.dataset_name = dataset_name # 
         self.input_path = input_path
         self.max_prompt_length = max_prompt_length
@@ -88,11 +127,14 @@ class RRAGRunner:
         self.input_dim = input_dim
         self.hidden_size = hidden_size
         RRAGRunner.set_retrieval_token(RETRIEVAL_TOKEN)
-        RRAGRunner.set_unk_token(UNK_TOKEN)
-        RRAGRunner.set_unk_token_id(UNK_TOKEN_ID)
+        # UNK_TOKEN / UNK_TOKEN_ID default to the model family's retrieval placeholder, see load_tokenizer
+        self.unk_token = UNK_TOKEN
+        self.unk_token_id = UNK_TOKEN_ID
+        self.model_family = model_family
         RRAGRunner.set_instruction_type(instruction_type)
 
         self.num_k = num_k
+        self.d_model = d_model
         self.use_training = use_training
         self.freeze_llm = freeze_llm
         self.load_from_pretrained = load_from_pretrained
@@ -100,12 +142,40 @@ class RRAGRunner:
         self.use_lora = use_lora
         self.num_train_epochs = num_train_epochs
         self.per_device_train_batch_size = per_device_train_batch_size
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.checkpoint_every = checkpoint_every
+        self.optim = optim
+        self.auto_train_config = auto_train_config
+        self.train_batch_size = train_batch_size
+        self.train_memory_budget = train_memory_budget
+        self.train_memory_fraction = train_memory_fraction
 
         self.use_evaluation = use_evaluation
         self.max_new_tokens = max_new_tokens
         self.use_beam = use_beam
         self.beam_num = beam_num
         self.save_results = save_results
+        self.results_log = results_log
+        self.resume = resume
+        self.num_eval_workers = num_eval_workers
+        self.eval_devices = eval_devices
+        self.device_map = device_map
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.torch_profiler = torch_profiler
+        self.fused_rformer = fused_rformer
+        self.compile_rformer = compile_rformer
+        self.prune_threshold = prune_threshold
+        self.prune_top_m = prune_top_m
+        self.prune_min_keep = prune_min_keep
+        self.pack_prompts = pack_prompts
+        self.static_generation = static_generation
+        self.static_generation_buckets = static_generation_buckets
+        self.compile_decode = compile_decode
+        self.continuous_batching = continuous_batching
+        self.max_batch_size = max_batch_size
+        self.use_pruning = prune_threshold is not None or prune_top_m is not None
+        self.prune_stats = {'docs': 0, 'kept_docs': 0, 'prompt_tokens': 0, 'unpruned_prompt_tokens': 0}
 
     @classmethod
     def set_unk_token(cls, token):
@@ -123,48 +193,57 @@ class RRAGRunner:
     def set_instruction_type(cls, instruction_type):
         cls.instruction_type = instruction_type
 
+    @classmethod
+    def set_chat_template(cls, chat_template):
+        cls.chat_template = chat_template
+
+    @staticmethod
+    def get_prompt_template():
+        if RRAGRunner.instruction_type == 'instruction':
+            return INSTRUCTION_TEMPLATE
+        elif RRAGRunner.instruction_type == 'chat':
+            return RRAGRunner.chat_template
+        raise ValueError(RRAGRunner.instruction_type)
+
     @staticmethod
     def format_instruction(example):
         output_texts = []
+        prompt_template = RRAGRunner.get_prompt_template()
         for i in range(len(example['instruction'])):
-            if RRAGRunner.instruction_type == 'instruction':
-                text = "### Instruction: \n{instruction}\n\n### Response:\n{output}".format(
-                    instruction=example['instruction'][i],
-                    output=example['output'][i]
-                )
-            elif RRAGRunner.instruction_type == 'chat':
-                text = "[INST] {instruction} [/INST]{output}".format(
-                    instruction=example['instruction'][i],
-                    output=example['output'][i]
-                )
+            text = prompt_template.format(instruction=example['instruction'][i]) + example['output'][i]
             text = text.replace(RRAGRunner.RETRIEVAL_TOKEN, RRAGRunner.UNK_TOKEN)
             output_texts.append(text)
         return output_texts
     
     @staticmethod
     def format_instruction_for_response(prompt):
-        if RRAGRunner.instruction_type == 'instruction':
-            text = "### Instruction: \n{instruction}\n\n### Response:\n".format(
-                instruction=prompt,
-                )
-        elif RRAGRunner.instruction_type == 'chat':
-            text = "[INST] {instruction} [/INST]".format(
-                instruction=prompt,
-                )
+        text = RRAGRunner.get_prompt_template().format(instruction=prompt)
         text = text.replace(RRAGRunner.RETRIEVAL_TOKEN, RRAGRunner.UNK_TOKEN)
         return text
     
+    def load_model_family(self):
+        if self.model_family is not None:
+            family = get_model_family(self.model_family)
+        elif self.dataset_name == 'dureader': # Qwen
+            family = get_model_family('qwen')
+        else:
+            family = detect_model_family(self.model_name)
+        print(f'model_family: {family.name}')
+        self.family = family
+        RRAGRunner.set_chat_template(family.chat_template)
+        return family
+
     def load_tokenizer(self):
-        if self.dataset_name == 'dureader': # Qwen
-            tokenizer = AutoTokenizer.from_pretrained(self.model_name, use_auth_token=True, trust_remote_code=True)
-            tokenizer.padding_side = "left"
-            tokenizer.unk_token = '<|im_end|>'
-            tokenizer.pad_token = tokenizer.eos_token
-            RRAGRunner.set_unk_token_id(tokenizer.unk_token_id)
-        else: # Llama
-            tokenizer = AutoTokenizer.from_pretrained(self.model_name, use_auth_token=True)
-            tokenizer.padding_side = "left"
-            tokenizer.pad_token = tokenizer.eos_token
+        family = self.load_model_family()
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name, use_auth_token=True, trust_remote_code=family.trust_remote_code)
+        unk_token, unk_token_id = setup_tokenizer(tokenizer, family)
+        if self.unk_token is not None:
+            unk_token = self.unk_token
+            unk_token_id = tokenizer.convert_tokens_to_ids(unk_token)
+        if self.unk_token_id is not None:
+            unk_token_id = self.unk_token_id
+        RRAGRunner.set_unk_token(unk_token)
+        RRAGRunner.set_unk_token_id(unk_token_id)
         self.tokenizer = tokenizer
 
     def load_dataset(self):
@@ -177,9 +256,42 @@ class RRAGRunner:
             _load_dataset = load_hotpotqa_dataset
         elif self.dataset_name == 'musique':
             _load_dataset = load_musique_dataset
-        self.instruction_dataset_train, self.instruction_dataset_test = _load_dataset(self.input_path, self.max_prompt_length, self.tokenizer, retrieval_aware=self.retrieval_aware, RETRIEVAL_TOKEN=self.RETRIEVAL_TOKEN)
+        self.instruction_dataset_train, self.instruction_dataset_test = _load_dataset(
+            self.input_path, self.max_prompt_length, self.tokenizer, retrieval_aware=self.retrieval_aware, RETRIEVAL_TOKEN=self.RETRIEVAL_TOKEN,
+            pack_prompts=self.pack_prompts, reserved_tokens=self.get_reserved_tokens(),
+        )
+
+    def get_reserved_tokens(self):
+        # tokens the instruction wrapper adds around the prompt, so packed prompts are not truncated by the trainer
+        return len(self.tokenizer(RRAGRunner.format_instruction({'instruction': [''], 'output': ['']})[0], add_special_tokens=False)['input_ids'])
+
+    def build_sample(self, example):
+        # one raw example in the dataset's feature-extraction format (question + scored documents,
+        # answers optional) -> an instruction sample as in `instruction_dataset_test`, for serving
+        example = dict(example)
+        args = dict(max_prompt_length=self.max_prompt_length, tokenizer=self.tokenizer, retrieval_aware=self.retrieval_aware,
+                    use_cot=False, RETRIEVAL_TOKEN=self.RETRIEVAL_TOKEN, pack_prompts=self.pack_prompts, reserved_tokens=self.get_reserved_tokens())
+        if 'nq' in self.dataset_name:
+            example.setdefault('answers', [''])
+            example['ctxs'] = [dict({'isgold': False}, **ctx) for ctx in example['ctxs']]
+            samples = load_nq.get_embeds(load_nq.get_instruction_dataset([example], [0], **args))
+        elif self.dataset_name == 'hotpotqa' or self.dataset_name == '2wiki':
+            example.setdefault('answer', '')
+            example.setdefault('supporting_facts', [])
+            samples = load_hotpotqa.get_embeds(load_hotpotqa.get_instruction_dataset([example], **args))
+        elif self.dataset_name == 'musique':
+            example.setdefault('answer', '')
+            example.setdefault('answer_aliases', [])
+            example['paragraphs'] = [dict({'is_supporting': False}, **p) for p in example['paragraphs']]
+            samples = load_musique.get_embeds(load_musique.get_instruction_dataset([example], **args))
+        else:
+            raise ValueError(self.dataset_name)
+        if not samples:
+            raise ValueError(f'prompt does not fit in max_prompt_length {self.max_prompt_length}')
+        return samples[0]
     
-    def load_model(self):
+    def load_model(self, llama_model=None):
+        # `llama_model`: an already loaded base LLM to reuse instead of loading `model_name`
         print('##############################  load_model  ##############################')
         if self.use_rrag:
             config = RRAGLlamaConfig(
@@ -191,19 +303,24 @@ class RRAGRunner:
                 unk_token_id=self.UNK_TOKEN_ID,
                 freeze_llm=self.freeze_llm,
                 num_k=self.num_k,
+                d_model=self.d_model,
+                device_map=self.device_map,
+                trust_remote_code=self.family.trust_remote_code,
                 )
             if self.load_from_pretrained:
                 print(f'load_from_pretrained: {self.pretrained_model_name}')
-                self.model = RRAGLlamaForCausalLM.from_pretrained(self.pretrained_model_name, config=config)
+                self.model = RRAGLlamaForCausalLM.from_pretrained(self.pretrained_model_name, config=config, llama_model=llama_model)
             else:
-                self.model = RRAGLlamaForCausalLM(config)
+                self.model = RRAGLlamaForCausalLM(config, llama_model=llama_model)
         else:
             config = RAGLlamaConfig(
                 model_name_or_path=self.model_name,
                 load_in_8bit=self.load_in_8bit,
                 freeze_llm=self.freeze_llm,
+                device_map=self.device_map,
+                trust_remote_code=self.family.trust_remote_code,
                 )
-            self.model = RAGLlamaForCausalLM(config)
+            self.model = RAGLlamaForCausalLM(config, llama_model=llama_model)
         print(config)
         print(self.model)
     
@@ -215,31 +332,52 @@ class RRAGRunner:
                 bias="none",
                 inference_mode=False,
                 task_type=TaskType.CAUSAL_LM, 
-                target_modules=["q_proj", "v_proj"]
+                target_modules=self.family.lora_target_modules
         )
         print(peft_config)
-        self.model.llama_model = prepare_model_for_kbit_training(self.model.llama_model)
+        if self.load_in_8bit:
+            # gradient checkpointing is set up by start_training from the training plan
+            self.model.llama_model = prepare_model_for_kbit_training(self.model.llama_model, use_gradient_checkpointing=False)
         self.model.llama_model = get_peft_model(self.model.llama_model, peft_config)
         self.model.llama_model.print_trainable_parameters()
         return peft_config
     
+    def get_training_plan(self):
+        device = self.model.llama_model.device
+        if self.auto_train_config:
+            global_batch_size = self.train_batch_size or self.per_device_train_batch_size * self.gradient_accumulation_steps
+            memory_budget = int(self.train_memory_budget * 2**30) if self.train_memory_budget else None
+            return plan_training(
+                self.model, self.model.llama_model, device, self.max_prompt_length, global_batch_size,
+                memory_budget=memory_budget, memory_fraction=self.train_memory_fraction,
+                optim=self.optim, checkpoint_every=self.checkpoint_every,
+            )
+        bf16, fp16, tf32 = get_precision(device)
+        return TrainingPlan(
+            per_device_train_batch_size=self.per_device_train_batch_size,
+            gradient_accumulation_steps=self.gradient_accumulation_steps,
+            checkpoint_every=1 if self.checkpoint_every is None else self.checkpoint_every,
+            optim=resolve_optimizer(self.optim or 'paged_adamw_32bit', device),
+            bf16=bf16, fp16=fp16, tf32=tf32,
+            estimated_bytes=0, budget_bytes=0,
+        )
+
     def start_training(self):
         print('##############################  start_training  ##############################')
+        plan = self.get_training_plan()
+        print('training_plan', plan)
         args = TrainingArguments(
             output_dir=self.output_dir,
             num_train_epochs=self.num_train_epochs,
-            per_device_train_batch_size=self.per_device_train_batch_size,
-            gradient_accumulation_steps=2,
-            gradient_checkpointing=True,
-            optim="paged_adamw_32bit",
+            # checkpointing is applied per layer below, see apply_gradient_checkpointing
+            gradient_checkpointing=False,
             logging_steps=10,
             save_strategy="epoch",
             learning_rate=2e-4,
-            bf16=True,
-            tf32=True,
             max_grad_norm=0.3,
             warmup_ratio=0.03,
             lr_scheduler_type="constant",
+            **plan.training_arguments(),
             # disable_tqdm=True # disable tqdm since with packing values are in correct
         )
         dataset_train = Dataset.from_list(self.instruction_dataset_train[:])
@@ -255,6 +393,7 @@ class RRAGRunner:
             formatting_func=RRAGRunner.format_instruction,
             args=args,
         )
+        apply_gradient_checkpointing(self.model.llama_model, plan.checkpoint_every)
         seed_it(42)
         trainer.train()
         # save model
@@ -264,18 +403,74 @@ class RRAGRunner:
         else:
             print('dont save_model')
 
-    def get_response(self, sample, prompt_key='instruction'):
-        prompt = RRAGRunner.format_instruction_for_response(sample[prompt_key])
+    def get_prune_fn(self):
+        if 'nq' in self.dataset_name:
+            return load_nq.get_pruned_instruction
+        elif self.dataset_name == 'hotpotqa' or self.dataset_name == '2wiki':
+            return load_hotpotqa.get_pruned_instruction
+        elif self.dataset_name == 'musique':
+            return load_musique.get_pruned_instruction
+        raise ValueError(self.dataset_name)
+
+    def prune_documents(self, sample, prompt_key='instruction'):
+        # score every document with the R-Former relevance head, keep the selected ones and
+        # rebuild the prompt with one retrieval slot per kept document; the injected embeddings
+        # come from the same pass over all num_k documents, so rows stay aligned with the slots
+        embeds = torch.tensor(sample['embeds'], device=self.model.llama_proj.weight.device)
+        if embeds.dim() == 1:
+            embeds = embeds.unsqueeze(0)
+        inject_embeds, scores = self.model.score_retrieval_data(embeds.unsqueeze(0))
+        doc_mask = sample.get('doc_mask') or [1] * scores.shape[-1]
+        keep = select_documents(scores[0], self.prune_threshold, self.prune_top_m, self.prune_min_keep)
+        keep = [i for i in keep if doc_mask[i]] or [i for i in range(len(doc_mask)) if doc_mask[i]][:self.prune_min_keep]
+        prompt = self.get_prune_fn()(sample, keep, self.RETRIEVAL_TOKEN)
+        num_tokens = len(self.tokenizer(RRAGRunner.format_instruction_for_response(prompt), add_special_tokens=False)['input_ids'])
+        unpruned_tokens = len(self.tokenizer(RRAGRunner.format_instruction_for_response(sample[prompt_key]), add_special_tokens=False)['input_ids'])
+        if num_tokens > self.max_prompt_length:
+            # kept passages of a packed prompt no longer fit untruncated, use the packed prompt
+            keep = [i for i in range(len(doc_mask)) if doc_mask[i]]
+            prompt, num_tokens = sample[prompt_key], unpruned_tokens
+        self.prune_stats['docs'] += scores.shape[-1]
+        self.prune_stats['kept_docs'] += len(keep)
+        self.prune_stats['prompt_tokens'] += num_tokens
+        self.prune_stats['unpruned_prompt_tokens'] += unpruned_tokens
+        return prompt, inject_embeds[:, keep]
+
+    def print_prune_stats(self):
+        stats = self.prune_stats
+        if not stats['docs']:
+            return
+        print(f"pruning: kept {stats['kept_docs']}/{stats['docs']} documents ({stats['kept_docs'] / stats['docs']:.1%}), "
+              f"prompt tokens {stats['prompt_tokens']}/{stats['unpruned_prompt_tokens']} "
+              f"({stats['prompt_tokens'] / max(1, stats['unpruned_prompt_tokens']):.1%} of unpruned)")
+
+    def build_inputs(self, sample, prompt_key='instruction'):
+        # tokenized prompt plus retrieval features / injected embeddings, as taken by `model.generate`
+        inject_embeds = None
+        if self.use_rrag and self.use_pruning:
+            prompt, inject_embeds = self.prune_documents(sample, prompt_key)
+        else:
+            prompt = sample[prompt_key]
+        prompt = RRAGRunner.format_instruction_for_response(prompt)
         # print(prompt)
-        input_tokens = self.tokenizer(
-                    prompt,
-                    return_tensors="pt",
-                    padding="longest",
-                    truncation=True,
-                    max_length=self.max_prompt_length,
-                    add_special_tokens=False,
-                ).to('cuda')
-        if self.use_rrag:
+        with profiler.stage('tokenize'):
+            input_tokens = self.tokenizer(
+                        prompt,
+                        return_tensors="pt",
+                        padding="longest",
+                        truncation=True,
+                        max_length=self.max_prompt_length,
+                        add_special_tokens=False,
+                    ).to(self.model.llama_model.device)
+        if profiler.enabled:
+            num_tokens = int(input_tokens['attention_mask'].sum())
+            profiler.count('batches')
+            profiler.count('prompt_tokens', num_tokens)
+            profiler.count('padded_tokens', input_tokens['attention_mask'].numel())
+            profiler.count('pad_tokens', input_tokens['attention_mask'].numel() - num_tokens)
+        if inject_embeds is not None:
+            inputs = {"input_ids": input_tokens['input_ids'], 'attention_mask': input_tokens['attention_mask'], 'inject_embeds': inject_embeds}
+        elif self.use_rrag:
             embeds = torch.tensor(sample['embeds']).to(input_tokens.input_ids.device)
             label = torch.tensor(sample['label']).to(input_tokens.input_ids.device)
             if embeds.dim() == 1:
@@ -283,9 +478,14 @@ class RRAGRunner:
             if label.dim() == 1:
                 label = label.unsqueeze(0)
             inputs = {"input_ids": input_tokens['input_ids'], 'attention_mask': input_tokens['attention_mask'], 'embeds': embeds, 'label': label}
+            if not all(sample.get('doc_mask') or [1]):
+                inputs['doc_mask'] = torch.tensor(sample['doc_mask'], device=embeds.device).unsqueeze(0)
         else:
             inputs = {"input_ids": input_tokens['input_ids'], 'attention_mask': input_tokens['attention_mask']}
+        return inputs
 
+    def get_response(self, sample, prompt_key='instruction'):
+        inputs = self.build_inputs(sample, prompt_key)
         outputs = self.model.generate(
             inputs=inputs,
             max_new_tokens=100,
@@ -301,14 +501,23 @@ class RRAGRunner:
         output_text = [text.strip() for text in output_text]
         return output_text
     
+    def get_ans_fn(self):
+        if 'nq' in self.dataset_name:
+            return get_nq_ans
+        elif self.dataset_name == 'hotpotqa' or self.dataset_name == '2wiki':
+            return get_hotpotqa_ans
+        elif self.dataset_name == 'musique':
+            return get_musique_ans
+        raise ValueError(self.dataset_name)
+
     def eval(self):
         print('##############################  evaluation_from_list  ##############################')
-        self.model.eval()
-        self.model.llama_model.eval()
-        res = []
-        for data in tqdm(self.instruction_dataset_test[:], desc='get_response'):
-            cur_res = self.get_response(data)[0]
-            res.append(cur_res)
+        gt_ans = self.get_ans_fn()(self.instruction_dataset_test)
+        if self.num_eval_workers > 1:
+            res = self.eval_sharded(gt_ans)
+        else:
+            self.prepare_for_inference()
+            res = self.generate_responses(self.instruction_dataset_test, gt_ans, self.results_log)
         if self.save_results:
             save_pkl_file = f'res_' + datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
             if not os.path.exists('output'):
@@ -318,23 +527,174 @@ class RRAGRunner:
             with open(pkl_save_path, 'wb') as f:
                 pickle.dump(res, f)
                 f.close()
-        if 'nq' in self.dataset_name:
-            get_ans = get_nq_ans
-        elif self.dataset_name == 'hotpotqa' or self.dataset_name == '2wiki':
-            get_ans = get_hotpotqa_ans
-        elif self.dataset_name == 'musique':
-            get_ans = get_musique_ans
-        gt_ans = get_ans(self.instruction_dataset_test)
-        m = evaluation_from_list(res[:], gt_ans[:len(res)], self.dataset_name)
-    
+        with profiler.stage('metrics'):
+            m = evaluation_from_list(res[:], gt_ans[:len(res)], self.dataset_name)
+        self.print_prune_stats()
+        # averaged metrics, as printed by evaluation_from_list
+        return {name: sum(example_metrics[name] for example_metrics, _ in m) / max(1, len(m)) for _, name in get_metrics_for_dataset(self.dataset_name)}
+
+    def prepare_for_inference(self):
+        self.model.eval()
+        self.model.llama_model.eval()
+        if self.use_rrag and (self.fused_rformer or self.compile_rformer):
+            self.model.build_inference_rformer(with_scores=self.use_pruning, compile=self.compile_rformer)
+        if self.static_generation:
+            buckets = [int(b) for b in self.static_generation_buckets.split(',') if b.strip()]
+            self.model.enable_static_generation(buckets=buckets, compile=self.compile_decode)
+
+    def get_scheduler(self):
+        return ContinuousBatchingScheduler(self.model, max_batch_size=self.max_batch_size, max_new_tokens=self.max_new_tokens)
+
+    def iter_responses(self, samples, indices, pbar):
+        # yields (index, response) in dataset order, or in completion order with continuous batching
+        if not self.continuous_batching:
+            for i in indices:
+                yield i, self.get_response(samples[i])[0]
+                pbar.update()
+            return
+        requests = ((i, self.build_inputs(samples[i])) for i in indices)
+        for i, tokens in self.get_scheduler().run(requests):
+            yield i, self.tokenizer.decode(tokens, skip_special_tokens=True).strip()
+            pbar.update()
+
+    def generate_responses(self, samples, gt_ans, results_log=None, meta=None, desc='get_response'):
+        if not results_log:
+            res = [None] * len(samples)
+            with tqdm(total=len(samples), desc=desc) as pbar:
+                for i, cur_res in self.iter_responses(samples, range(len(samples)), pbar):
+                    res[i] = cur_res
+            return res
+        # stream every finished sample to `results_log`, resuming from the indices already in it
+        METRICS = get_metrics_for_dataset(self.dataset_name)
+        meta = dict({'dataset_name': self.dataset_name, 'num_examples': len(samples), 'use_rrag': self.use_rrag}, **(meta or {}))
+        with EvalResultLog(results_log, meta=meta, resume=self.resume) as log:
+            indices = [i for i in range(len(samples)) if i not in log]
+            with tqdm(total=len(samples), initial=len(samples) - len(indices), desc=desc) as pbar:
+                for i, cur_res in self.iter_responses(samples, indices, pbar):
+                    example_metrics, _ = get_metrics_for_example({'model_answer': cur_res, 'answers': gt_ans[i]}, METRICS)
+                    log.write(i, cur_res, example_metrics)
+                    pbar.set_postfix(log.running_means())
+            responses = log.responses()
+        return [responses[i] for i in range(len(samples))]
+
+    def get_eval_devices(self):
+        if self.eval_devices:
+            return [d.strip() for d in self.eval_devices.split(',') if d.strip()]
+        if torch.cuda.is_available():
+            return [f'cuda:{i}' for i in range(torch.cuda.device_count())]
+        return ['cpu']
+
+    def eval_sharded(self, gt_ans):
+        # split the test set over `num_eval_workers` processes (round-robin over `eval_devices`),
+        # each loading the model once, then merge the responses back in dataset order
+        num_workers = self.num_eval_workers
+        devices = self.get_eval_devices()
+        worker_devices = [devices[rank % len(devices)] for rank in range(num_workers)]
+        cpu_workers = sum(1 for d in worker_devices if d == 'cpu')
+        num_threads = max(1, (os.cpu_count() or 1) // max(1, cpu_workers))
+        worker_args = dict(self.init_args, num_eval_workers=1)
+        if self.use_training:
+            # workers reload the trained R-Former/projection from `output_dir`
+            worker_args.update(load_from_pretrained=True, pretrained_model_name=self.output_dir)
+        shards = [list(range(len(self.instruction_dataset_test)))[rank::num_workers] for rank in range(num_workers)]
+        print(f'eval_sharded: {num_workers} workers on {worker_devices}')
+
+        start_time = time.perf_counter()
+        res = [None] * len(self.instruction_dataset_test)
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = []
+            for rank, shard in enumerate(shards):
+                shard_log = f'{self.results_log}.shard{rank}-of-{num_workers}' if self.results_log else None
+                futures.append(executor.submit(
+                    eval_shard, worker_args, worker_devices[rank], num_threads, rank,
+                    [self.instruction_dataset_test[i] for i in shard], [gt_ans[i] for i in shard], shard_log,
+                ))
+            for shard, future in zip(shards, futures):
+                shard_res, shard_prune_stats = future.result()
+                for i, cur_res in zip(shard, shard_res):
+                    res[i] = cur_res
+                for key, value in shard_prune_stats.items():
+                    self.prune_stats[key] += value
+        elapsed = time.perf_counter() - start_time
+        print(f'eval_sharded: {len(res)} samples in {elapsed:.1f}s ({len(res) / elapsed:.2f} samples/s)')
+        return res
+
     def run(self):
+        if self.use_pruning and not self.use_rrag:
+            raise ValueError('document pruning needs the R-Former relevance head, set --use_rrag')
+        if self.continuous_batching and (self.use_beam or self.static_generation):
+            raise ValueError('continuous batching decodes greedily with its own KV cache, drop --use_beam / --static_generation')
+        if self.num_eval_workers > 1 and self.use_training and not self.save_model:
+            raise ValueError('sharded evaluation after training needs --save_model so workers can load the trained model')
+        if self.profile:
+            profiler.enable(use_torch_profiler=self.torch_profiler)
         self.load_dataset()
-        self.load_model()
+        if self.use_training or self.num_eval_workers <= 1:
+            self.load_model()
         print(self.use_training, self.use_evaluation)
         if self.use_training:
             self.start_training()
         if self.use_evaluation:
             self.eval()
+        if self.profile:
+            profiler.save(self.profile_dir)
+
+def select_documents(scores, threshold=None, top_m=None, min_keep=1):
+    # indices (in retriever order) of the documents to keep given the relevance logits
+    # of one example: sigmoid(score) >= threshold, then the top_m best, never fewer than min_keep
+    scores = scores.float()
+    order = torch.argsort(scores, descending=True, stable=True).tolist()
+    keep = order
+    if threshold is not None:
+        probs = torch.sigmoid(scores)
+        keep = [i for i in order if probs[i] >= threshold]
+    if top_m is not None:
+        keep = keep[:top_m]
+    if len(keep) < min_keep:
+        keep = order[:min_keep]
+    return sorted(keep)
+
+def eval_shard(runner_args, device, num_threads, rank, samples, gt_ans, results_log=None):
+    if device == 'cpu':
+        torch.set_num_threads(num_threads)
+    runner = RRAGRunner(**dict(runner_args, device_map={'': device}))
+    runner.load_tokenizer()
+    runner.load_model()
+    runner.prepare_for_inference()
+    if runner.profile:
+        profiler.enable(use_torch_profiler=runner.torch_profiler)
+    meta = {'shard': rank}
+    res = runner.generate_responses(samples, gt_ans, results_log, meta=meta, desc=f'get_response[{rank}]')
+    if runner.profile:
+        profiler.save(os.path.join(runner.profile_dir, f'shard{rank}'))
+    return res, runner.prune_stats
+
+def add_model_args(parser):
+    # arguments that select the model and how its prompts are built, shared with serve.py
+    parser.add_argument('--max_prompt_length', type=int, default=4096, help='Maximum prompt length')
+    parser.add_argument('--model_name', type=str, required=True, help='Name of LLM')
+    parser.add_argument('--load_in_8bit', action='store_true', help='Load in 8-bit precision')
+    parser.add_argument('--use_rrag', action='store_true', help='Whether to use RRAG or not')
+    parser.add_argument('--input_dim', type=int, default=3, help='Input features')
+    parser.add_argument('--hidden_size', type=int, default=None, help='Size of the LLM hidden layer (default: read from the base model config)')
+    parser.add_argument('--RETRIEVAL_TOKEN', type=str, default='<R>', help='Token for retrieval')
+    parser.add_argument('--UNK_TOKEN', type=str, default=None, help='Placeholder token replaced by the R-Former output (default: from the model family)')
+    parser.add_argument('--UNK_TOKEN_ID', type=int, default=None, help='Placeholder token ID (default: looked up in the tokenizer)')
+    parser.add_argument('--model_family', type=str, default=None, choices=list(MODEL_FAMILIES), help='Tokenizer / template settings of the base LLM (default: detected from its config)')
+    parser.add_argument('--num_k', type=int, default=10, help='Number of K in retrieval')
+    parser.add_argument('--d_model', type=int, default=256, help='Hidden size of the R-Former')
+    parser.add_argument('--freeze_llm', action='store_true', help='Freeze LLM')
+    parser.add_argument('--load_from_pretrained', action='store_true', help='Load from RRAG pretrained model')
+    parser.add_argument('--pretrained_model_name', type=str, required=False, help='Name of RRAG pretrained model')
+    parser.add_argument('--max_new_tokens', type=int, default=100, help='Maximum new tokens')
+    parser.add_argument('--instruction_type', default='instruction', choices=['chat', 'instruction'], help='instruction_type: the generic instruction template or the model family chat template')
+    parser.add_argument('--fused_rformer', action='store_true', help='Run the R-Former + projection through the fused batch-first inference module for generation')
+    parser.add_argument('--compile_rformer', action='store_true', help='Also torch.compile the fused R-Former (implies --fused_rformer)')
+    parser.add_argument('--prune_threshold', type=float, default=None, help='Drop documents whose R-Former relevance probability is below this before building the prompt')
+    parser.add_argument('--prune_top_m', type=int, default=None, help='Keep only the top-m documents by R-Former relevance before building the prompt')
+    parser.add_argument('--prune_min_keep', type=int, default=1, help='With pruning, always keep at least this many documents')
+    parser.add_argument('--no_pack_prompts', dest='pack_prompts', action='store_false', help='Skip over-long examples instead of truncating their passages to fit --max_prompt_length')
+    return parser
 
 def main(dataset_name, input_path, train_data_path, test_data_path, **args):
     if dataset_name in ['hotpotqa', 'musique', '2wiki']:
@@ -354,35 +714,39 @@ if __name__ == "__main__":
     parser.add_argument('--input_path', type=str, default=None, help='Path for nq or dureader datasets')
     parser.add_argument('--train_data_path', type=str, default=None, help='Path for the hotpotqa, musique, 2wiki')
     parser.add_argument('--test_data_path', type=str, default=None, help='Path for the hotpotqa, musique, 2wiki')
-    parser.add_argument('--max_prompt_length', type=int, default=4096, help='Maximum prompt length')
+    add_model_args(parser)
 
-    parser.add_argument('--model_name', type=str, required=True, help='Name of LLM')
-    parser.add_argument('--load_in_8bit', action='store_true', help='Load in 8-bit precision')
     parser.add_argument('--save_model', action='store_true', help='If set, the trained model will be saved to outputdir')
     parser.add_argument('--output_dir', type=str, required=False, help='Directory to save model')
 
-    parser.add_argument('--use_rrag', action='store_true', help='Whether to use RRAG or not')
-    parser.add_argument('--input_dim', type=int, default=3, help='Input features')
-    parser.add_argument('--hidden_size', type=int, default=4096, help='Size of the LLM hidden layer')
-    parser.add_argument('--RETRIEVAL_TOKEN', type=str, default='<R>', help='Token for retrieval')
-    parser.add_argument('--UNK_TOKEN', type=str, default='<unk>', help='Token for unknown tokens')
-    parser.add_argument('--UNK_TOKEN_ID', type=int, default=0, help='Unknown token ID')
-
-    parser.add_argument('--num_k', type=int, default=10, help='Number of K in retrieval')
     parser.add_argument('--use_training', action='store_true', help='Use for training')
-    parser.add_argument('--freeze_llm', action='store_true', help='Freeze LLM')
-    parser.add_argument('--load_from_pretrained', action='store_true', help='Load from RRAG pretrained model')
-    parser.add_argument('--pretrained_model_name', type=str, required=False, help='Name of RRAG pretrained model')
     parser.add_argument('--use_lora', action='store_true', help='Use LoRA')
     parser.add_argument('--num_train_epochs', type=int, default=2, help='Number of training epochs')
     parser.add_argument('--per_device_train_batch_size', type=int, default=2, help='Batch size per device')
+    parser.add_argument('--gradient_accumulation_steps', type=int, default=2, help='Gradient accumulation steps')
+    parser.add_argument('--checkpoint_every', type=int, default=None, help='Gradient-checkpoint every k-th decoder layer (1: all, 0: none; default: 1, or searched with --auto_train_config)')
+    parser.add_argument('--optim', type=str, default=None, choices=list(OPTIMIZER_STATE_BYTES), help='Optimizer (default: paged_adamw_32bit, or searched with --auto_train_config); unsupported ones fall back to adamw_torch(_fused)')
+    parser.add_argument('--auto_train_config', action='store_true', help='Pick micro batch, accumulation, checkpointing and optimizer to fit the device memory')
+    parser.add_argument('--train_batch_size', type=int, default=None, help='With --auto_train_config, effective batch size per device (default: per_device_train_batch_size * gradient_accumulation_steps)')
+    parser.add_argument('--train_memory_budget', type=float, default=None, help='With --auto_train_config, memory budget in GiB (default: probed free memory * --train_memory_fraction)')
+    parser.add_argument('--train_memory_fraction', type=float, default=0.9, help='Fraction of the probed free memory used by --auto_train_config')
 
     parser.add_argument('--use_evaluation', action='store_true', help='Use for evaluation')
-    parser.add_argument('--max_new_tokens', type=int, default=100, help='Maximum new tokens')
     parser.add_argument('--use_beam', action='store_true', help='Use beam search')
     parser.add_argument('--beam_num', type=int, default=5, help='Number of beams in beam search')
     parser.add_argument('--save_results', action='store_true', help='Save results')
-    parser.add_argument('--instruction_type', default='instruction', choices=['chat', 'instruction'], help='instruction_type, llama or mistral')
+    parser.add_argument('--results_log', type=str, default=None, help='Append-only JSONL log of (index, response, metrics) rows, written as samples finish')
+    parser.add_argument('--resume', action='store_true', help='Resume from --results_log, skipping samples already in it')
+    parser.add_argument('--num_eval_workers', type=int, default=1, help='Number of processes to shard evaluation over, each loading its own model replica')
+    parser.add_argument('--profile', action='store_true', help='Time tokenization, R-Former, embedding injection, prefill/decode and metrics; write a JSON summary and Chrome trace to --profile_dir')
+    parser.add_argument('--profile_dir', type=str, default='output/profile', help='Directory for profile_summary.json and trace.json')
+    parser.add_argument('--torch_profiler', action='store_true', help='With --profile, also record a torch.profiler trace')
+    parser.add_argument('--static_generation', action='store_true', help='Greedy decoding with prompt-length buckets, a static KV cache and a compiled decode step (falls back to generate when unsupported)')
+    parser.add_argument('--static_generation_buckets', type=str, default='256,512,1024,2048,4096', help='Comma-separated prompt-length buckets for --static_generation')
+    parser.add_argument('--no_compile_decode', dest='compile_decode', action='store_false', help='With --static_generation, run the decode step eagerly instead of torch.compile-ing it per bucket')
+    parser.add_argument('--continuous_batching', action='store_true', help='Greedy decoding with a running batch that admits new samples as others finish (see RRAG/models/continuous_batching.py)')
+    parser.add_argument('--max_batch_size', type=int, default=8, help='Maximum number of sequences decoded together with --continuous_batching')
+    parser.add_argument('--eval_devices', type=str, default=None, help='Comma-separated devices assigned round-robin to eval workers, e.g. cuda:0,cuda:1 or cpu (default: all GPUs, else cpu)')
 
     args = parser.parse_args()
     main(**vars(args))
@@ -1,6 +1,6 @@
 import pandas as pd
 import math, hashlib, unicodedata, random, argparse
-from typing import List, Sequence, Tuple, Dict
+from typing import List, Sequence, Tuple, Dict, Iterator
 import numpy as np
 import torch, torch.nn as nn, torch.optim as optim
 from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
@@ -182,59 +182,58 @@ DISEASE_INTENT=["{x} là bệnh gì","{x} thuộc bệnh nào","{x} là biểu h
 
 
 # -------------------- Data builder --------------------
-def build_train_raw()->List[Tuple[str,List[str],int]]:
-    rows=[]
-
+def iter_train_raw()->Iterator[Tuple[str,List[str],int]]:
+    # sinh lần lượt từng dòng (chưa dedup), không dựng cả tích Descartes trong list
     for k,tpls in TEMPLATES.items():
         if k == "disease":
             # 1. disease intent từ SYMPTOMY
             for x in SYMPTOMY:
                 for tpl in tpls:
                     if "{x}" in tpl:
-                        rows.append((tpl.format(x=x), [k], 0))
+                        yield (tpl.format(x=x), [k], 0)
             # 2. disease từ chính DISEASES
             for d in DISEASES:
                 for tpl in tpls:
                     if "{main}" in tpl:
-                        rows.append((tpl.format(main=d), [k], 0))
+                        yield (tpl.format(main=d), [k], 0)
         else:
             # các lớp khác dựa trên DISEASES
             for d in DISEASES:
                 # single-label (no context)
                 for tpl in tpls:
-                    rows.append((tpl.format(main=d), [k], 0))
+                    yield (tpl.format(main=d), [k], 0)
 
                 # single-label + context (nếu có trong TEMPLATES_CTX)
                 if k in TEMPLATES_CTX:
                     for ctx in TOPICS+SUBTOPICS:
                         for tpl_ctx in TEMPLATES_CTX[k]:
-                            rows.append((tpl_ctx.format(main=d, ctx=ctx), [k], 1))
+                            yield (tpl_ctx.format(main=d, ctx=ctx), [k], 1)
 
     # multi-label (no context)
     for d in DISEASES:
         for labs,tpls in MULTI_TEMPLATES:
             for tpl in tpls:
-                rows.append((tpl.format(main=d), labs, 0))
+                yield (tpl.format(main=d), labs, 0)
 
         # multi-label + context
         for ctx in TOPICS+SUBTOPICS:
             for labs,tpls in MULTI_TEMPLATES_CTX:
                 for tpl in tpls:
-                    rows.append((tpl.format(main=d, ctx=ctx), labs, 1))
+                    yield (tpl.format(main=d, ctx=ctx), labs, 1)
 
         # topic/subtopic root (cũng tính là có context)
         for ctx in TOPICS:
-            rows.append((f"{d} trong {ctx}", ["topic"], 1))
+            yield (f"{d} trong {ctx}", ["topic"], 1)
         for ctx in SUBTOPICS:
-            rows.append((f"{d} ở {ctx}", ["subtopic"], 1))
+            yield (f"{d} ở {ctx}", ["subtopic"], 1)
 
-    # dedup
+def build_train_raw()->List[Tuple[str,List[str],int]]:
+    # dedup ngay khi sinh, chỉ giữ hash 64-bit của key
     seen=set(); out=[]
-    for text,labs,has_ctx in rows:
-        key=(text.lower(),"|".join(sorted(labs)),has_ctx)
+    for text,labs,has_ctx in iter_train_raw():
+        key=hashlib.blake2b(f'{text.lower()}\x1f{"|".join(sorted(labs))}\x1f{has_ctx}'.encode("utf-8"),digest_size=8).digest()
         if key not in seen:
             seen.add(key)
             out.append((text,labs,has_ctx))
     return out
 
-
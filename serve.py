@@ -0,0 +1,140 @@
+"""Online RRAG generation server backed by the continuous-batching scheduler.
+
+Loads the model once like `runner.py` and serves
+
+    POST /generate  {"question": ..., "ctxs": [{"title", "text", "rerank_score", ...}]}  ->  {"answer": ...}
+    GET  /health
+
+The request body is one example in the dataset's feature-extraction format
+(`ctxs` for nq, `context` for hotpotqa/2wiki, `paragraphs` for musique).
+Requests from all HTTP threads go to a single generation thread, which keeps
+up to --max_batch_size of them decoding together and admits new ones as
+others finish:
+
+    python serve.py --dataset_name nq_10 --model_name meta-llama/Llama-2-7b-hf --use_rrag \\
+        --load_from_pretrained --pretrained_model_name output/rrag/Rrag-Llama-2-7b --port 8000
+"""
+import json
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from runner import RRAGRunner, add_model_args
+
+
+class GenerationServer:
+    def __init__(self, runner):
+        self.runner = runner
+        self.scheduler = runner.get_scheduler()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, example):
+        future = Future()
+        self.requests.put((future, example))
+        return future
+
+    def admit(self, future, example):
+        # prompts are built on the generation thread, which owns the model; requests that would
+        # fail in the prefill are rejected here, before they can join the running batch
+        runner = self.runner
+        try:
+            sample = runner.build_sample(example)
+            if runner.use_rrag and len(sample['embeds']) != runner.num_k:
+                raise ValueError(f"expected {runner.num_k} documents (--num_k), got {len(sample['embeds'])}")
+            inputs = runner.build_inputs(sample)
+            prompt_length = inputs['input_ids'].shape[1]
+            if prompt_length >= runner.max_prompt_length:
+                raise ValueError(f'prompt of {prompt_length} tokens reaches max_prompt_length {runner.max_prompt_length} and would be truncated')
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self.scheduler.submit(future, inputs)
+
+    def loop(self):
+        while True:
+            if not self.scheduler.has_work():
+                self.admit(*self.requests.get())
+            while True:
+                try:
+                    self.admit(*self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                finished = self.scheduler.step()
+            except Exception as e:
+                # fail the running batch, keep serving
+                for row in self.scheduler.running:
+                    row['id'].set_exception(e)
+                self.scheduler.reset()
+                continue
+            while self.scheduler.failed:
+                future, e = self.scheduler.failed.pop()
+                future.set_exception(e)
+            for future, tokens in finished:
+                future.set_result(self.runner.tokenizer.decode(tokens, skip_special_tokens=True).strip())
+
+
+def make_handler(server, timeout):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self.send_json(404, {'error': 'not found'})
+            self.send_json(200, {'status': 'ok', 'running': len(server.scheduler.running), 'waiting': server.requests.qsize()})
+
+        def do_POST(self):
+            if self.path != '/generate':
+                return self.send_json(404, {'error': 'not found'})
+            try:
+                example = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError as e:
+                return self.send_json(400, {'error': f'invalid json: {e}'})
+            try:
+                answer = server.submit(example).result(timeout=timeout)
+            except (ValueError, KeyError, TypeError) as e:
+                return self.send_json(400, {'error': f'{type(e).__name__}: {e}'})
+            except Exception as e:
+                return self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+            self.send_json(200, {'answer': answer})
+
+    return Handler
+
+
+def main(host, port, timeout, **args):
+    runner = RRAGRunner(**args)
+    runner.load_tokenizer()
+    runner.load_model()
+    runner.prepare_for_inference()
+    server = GenerationServer(runner)
+    httpd = ThreadingHTTPServer((host, port), make_handler(server, timeout))
+    print(f'serving on http://{host}:{port} (max_batch_size={runner.max_batch_size})')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve RRAG generation over HTTP with continuous batching")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to bind')
+    parser.add_argument('--port', type=int, default=8000, help='Port to bind')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds a request may wait for its answer')
+
+    parser.add_argument('--dataset_name', type=str, default='nq_10', choices=['nq_10', 'nq_20', 'nq_30', 'hotpotqa', 'musique', '2wiki'], help='Format of the request examples')
+    add_model_args(parser)
+    parser.add_argument('--max_batch_size', type=int, default=8, help='Maximum number of requests decoded together')
+
+    args = parser.parse_args()
+    main(**vars(args), continuous_batching=True)
@@ -0,0 +1,155 @@
+"""Experiment sweeps that load the base LLM, tokenizer and datasets once.
+
+Each `runner.py` invocation reloads everything, so ablations over the R-Former
+`d_model`, `instruction_type` or decoding settings mostly measure loading
+time. A sweep takes a JSON file with the shared `base` runner arguments and
+either a `grid` (every combination is run) or an explicit list of `runs`:
+
+    {
+        "base": {"dataset_name": "nq_10", "input_path": "retrieval/dataset/nq-open-10_total_documents_gold_at_0_bert.pkl",
+                 "model_name": "meta-llama/Llama-2-7b-hf", "use_rrag": true, "freeze_llm": true, "use_training": true},
+        "grid": {"d_model": [128, 256], "instruction_type": ["instruction", "chat"], "prune_top_m": [null, 5]}
+    }
+
+    python sweep.py --config sweep.json --output output/sweep_nq.csv
+
+Between runs only the R-Former/projection heads (trained or loaded per run),
+the prompts (datasets are cached per prompt-building setting) and the decoding
+settings change; the base LLM stays loaded and frozen. Every run adds one
+row (its settings, metrics and timings) to the consolidated CSV table.
+"""
+import os
+import csv
+import json
+import time
+import argparse
+import itertools
+from datetime import datetime
+
+import torch
+
+from runner import RRAGRunner, seed_it
+
+# settings that select the base LLM or the dataset files, shared by every run
+FIXED_KEYS = ['dataset_name', 'input_path', 'model_name', 'load_in_8bit', 'device_map', 'model_family', 'UNK_TOKEN', 'UNK_TOKEN_ID', 'hidden_size', 'freeze_llm']
+# settings the instruction datasets are built from (instruction_type: packing reserves room for its wrapper)
+DATASET_KEYS = ['max_prompt_length', 'pack_prompts', 'RETRIEVAL_TOKEN', 'use_rrag', 'instruction_type']
+# runner-level settings with no effect inside a sweep
+UNSUPPORTED_KEYS = ['num_eval_workers', 'resume', 'use_lora', 'profile']
+
+
+def expand_runs(config):
+    # list of per-run overrides of `config['base']`
+    if 'runs' in config:
+        return [dict(run) for run in config['runs']]
+    grid = config.get('grid', {})
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def check_run(base, overrides):
+    fixed = [k for k in overrides if k in FIXED_KEYS]
+    if fixed:
+        raise ValueError(f'{fixed} select the base LLM or the dataset and must be set in "base", not per run')
+    args = dict(base, **overrides)
+    unsupported = [k for k in UNSUPPORTED_KEYS if args.get(k)]
+    if unsupported:
+        raise ValueError(f'{unsupported} are not supported in a sweep')
+    # the LLM of the first run is reused by all the others: neither training nor a fine-tuned LLM
+    # loaded from a checkpoint (load_from_pretrained without freeze_llm) may replace the base LLM
+    if not args.get('freeze_llm', True):
+        raise ValueError('all runs of a sweep share the base LLM, freeze_llm must be set (only the R-Former heads are trained or loaded per run)')
+
+
+class Sweep:
+    def __init__(self, base, runs, output):
+        self.base = base
+        self.runs = runs
+        self.output = output
+        self.llama_model = None
+        self.tokenizer = None
+        self.family = None
+        self.datasets = {}
+
+    def get_runner(self, overrides):
+        runner = RRAGRunner(**dict(self.base, **overrides))
+        if self.tokenizer is None:
+            runner.load_tokenizer()
+            self.tokenizer, self.family = runner.tokenizer, runner.family
+        runner.tokenizer, runner.family = self.tokenizer, self.family
+        key = tuple(getattr(runner, 'retrieval_aware' if k == 'use_rrag' else k) for k in DATASET_KEYS)
+        if key not in self.datasets:
+            runner.load_dataset()
+            self.datasets[key] = (runner.instruction_dataset_train, runner.instruction_dataset_test)
+        runner.instruction_dataset_train, runner.instruction_dataset_test = self.datasets[key]
+        return runner
+
+    def run_one(self, index, overrides):
+        print(f'##############################  sweep run {index + 1}/{len(self.runs)}: {overrides}  ##############################')
+        seed_it(42)
+        start = time.perf_counter()
+        runner = self.get_runner(overrides)
+        runner.load_model(llama_model=self.llama_model)
+        self.llama_model = runner.model.llama_model
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if runner.use_training:
+            runner.start_training()
+        train_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        metrics = runner.eval() if runner.use_evaluation else {}
+        eval_time = time.perf_counter() - start
+        del runner.model
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return dict(
+            {'run': index, 'config': json.dumps(overrides, sort_keys=True)},
+            **overrides, **metrics,
+            num_test_examples=len(runner.instruction_dataset_test),
+            load_time_s=round(load_time, 2), train_time_s=round(train_time, 2), eval_time_s=round(eval_time, 2),
+        )
+
+    def write_table(self, rows):
+        columns = []
+        for row in rows:
+            columns += [c for c in row if c not in columns]
+        os.makedirs(os.path.dirname(self.output) or '.', exist_ok=True)
+        with open(self.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def run(self):
+        for overrides in self.runs:
+            check_run(self.base, overrides)
+        rows = []
+        for index, overrides in enumerate(self.runs):
+            rows.append(self.run_one(index, overrides))
+            # rewrite after every run so finished runs survive a crash
+            self.write_table(rows)
+        print('sweep_results_path', self.output)
+        for row in rows:
+            print(row)
+        return rows
+
+
+def main(config, output):
+    with open(config) as f:
+        config = json.load(f)
+    base = dict(config['base'])
+    # as with runner.py's --load_from_pretrained flag, heads are only loaded when asked for
+    base.setdefault('load_from_pretrained', False)
+    if base.get('dataset_name') in ['hotpotqa', 'musique', '2wiki']:
+        base['input_path'] = {'train_data_path': base.pop('train_data_path'), 'test_data_path': base.pop('test_data_path')}
+    output = output or f'output/sweep_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.csv'
+    Sweep(base, expand_runs(config), output).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a grid of runner configurations with one loaded LLM")
+    parser.add_argument('--config', type=str, required=True, help='JSON file with "base" runner arguments and a "grid" or a list of "runs"')
+    parser.add_argument('--output', type=str, default=None, help='CSV file for the consolidated results table (default: output/sweep_<time>.csv)')
+    args = parser.parse_args()
+    main(**vars(args))